@@ -0,0 +1,96 @@
+
+const { getDatabase } = require('../database/init');
+const { removePlayers } = require('./rankIndex');
+const { forgetUsers } = require('./userCache');
+const { startQuery } = require('./metrics');
+
+// Players who have not logged in for INACTIVE_DAYS are moved to
+// users_archive and game_progress_archive, keeping the live tables (and
+// the pages SQLite caches for them) down to the active players. The login
+// statement moves them back, so the archive is invisible to the client.
+const INACTIVE_DAYS = Math.max(1, parseInt(process.env.ARCHIVE_INACTIVE_DAYS) || 30);
+const ARCHIVE_INTERVAL = parseInt(process.env.ARCHIVE_INTERVAL) || 3600000;
+const BATCH_SIZE = parseInt(process.env.ARCHIVE_BATCH_SIZE) || 1000;
+
+// One statement picks the batch and moves it through the archive_moves
+// trigger: the players are chosen once, against a single 'now', and
+// copied and deleted together or not at all. The writer connection is
+// shared with the prepared statements, so no explicit transaction is used.
+const ARCHIVE_SQL = `
+    INSERT INTO archive_moves (user_id, telegram_id)
+    SELECT id, telegram_id FROM users
+    WHERE last_active < datetime('now', ?)
+    ORDER BY last_active, id
+    LIMIT ?
+    RETURNING user_id AS id, telegram_id
+`;
+
+let archiveTimer = null;
+let archiving = false;
+
+// Move one batch; calls back with the archived { id, telegram_id } rows
+function archiveBatch(callback) {
+    getDatabase().all(ARCHIVE_SQL, [`-${INACTIVE_DAYS} days`, BATCH_SIZE], (err, rows) => {
+        callback(err, err ? [] : rows);
+    });
+}
+
+// Archive batches until no inactive players are left
+function archiveInactivePlayers(callback) {
+    const done = callback || (() => {});
+
+    if (archiving) {
+        return done(null, 0);
+    }
+    archiving = true;
+
+    const finishQuery = startQuery('archivePlayers');
+    let total = 0;
+
+    const next = () => archiveBatch((err, archived) => {
+        if (err) {
+            archiving = false;
+            finishQuery();
+            console.error('Player archive error:', err);
+            return done(err, total);
+        }
+
+        if (archived.length > 0) {
+            removePlayers(archived.map((row) => row.id));
+            forgetUsers(archived.map((row) => row.telegram_id));
+        }
+        total += archived.length;
+
+        if (archived.length === BATCH_SIZE) {
+            return setImmediate(next);
+        }
+
+        archiving = false;
+        finishQuery();
+        if (total > 0) {
+            console.log(`Archived ${total} players inactive for over ${INACTIVE_DAYS} days`);
+        }
+        done(null, total);
+    });
+
+    next();
+}
+
+// Runs on the process that owns the writer
+function startArchiveJob() {
+    if (!archiveTimer) {
+        archiveTimer = setInterval(archiveInactivePlayers, ARCHIVE_INTERVAL);
+        archiveInactivePlayers();
+    }
+}
+
+function stopArchiveJob() {
+    clearInterval(archiveTimer);
+    archiveTimer = null;
+}
+
+module.exports = {
+    archiveInactivePlayers,
+    startArchiveJob,
+    stopArchiveJob
+};
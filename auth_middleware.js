@@ -0,0 +1,59 @@
+
+const jwt = require('jsonwebtoken');
+const crypto = require('crypto');
+
+// The token is the only proof of identity on authenticated routes, so
+// refuse to start rather than sign with a guessable key
+const JWT_SECRET = process.env.JWT_SECRET;
+if (!JWT_SECRET) {
+    throw new Error('JWT_SECRET is not set');
+}
+const TOKEN_EXPIRES_IN = process.env.JWT_EXPIRES_IN || '7d';
+
+// Session token carrying the internal user id, so authenticated routes
+// never need to resolve a telegram_id
+function signToken(user) {
+    return jwt.sign(
+        { sub: String(user.id), tid: String(user.telegram_id) },
+        JWT_SECRET,
+        { algorithm: 'HS256', expiresIn: TOKEN_EXPIRES_IN }
+    );
+}
+
+// Verify the Bearer token in-process and attach the user to the request
+function requireAuth(req, res, next) {
+    const header = req.headers.authorization || '';
+    const token = header.startsWith('Bearer ') ? header.slice(7) : null;
+
+    if (!token) {
+        return res.status(401).json({ error: 'Missing token' });
+    }
+
+    try {
+        const payload = jwt.verify(token, JWT_SECRET, { algorithms: ['HS256'] });
+        req.user = { id: Number(payload.sub), telegramId: payload.tid };
+        next();
+    } catch (error) {
+        res.status(401).json({ error: 'Invalid token' });
+    }
+}
+
+// Operator-only routes: the Bearer token must equal ADMIN_TOKEN. With no
+// ADMIN_TOKEN configured these routes are disabled.
+function requireAdmin(req, res, next) {
+    const expected = Buffer.from(process.env.ADMIN_TOKEN || '');
+    const header = req.headers.authorization || '';
+    const token = Buffer.from(header.startsWith('Bearer ') ? header.slice(7) : '');
+
+    if (expected.length === 0 || token.length !== expected.length || !crypto.timingSafeEqual(token, expected)) {
+        return res.status(403).json({ error: 'Forbidden' });
+    }
+
+    next();
+}
+
+module.exports = {
+    signToken,
+    requireAuth,
+    requireAdmin
+};
@@ -1,35 +1,73 @@
 
 const express = require('express');
-const crypto = require('crypto');
-const { getDatabase } = require('../database/init');
+const statements = require('../database/statements');
+const { queueLastActive } = require('../database/writeBuffer');
+const { upsertPlayer } = require('../services/rankIndex');
+const { rememberUser } = require('../services/userCache');
+const { evaluateTasks } = require('../services/taskEngine');
+const { verifyInitData } = require('../services/telegramAuth');
+const { signToken } = require('../middleware/auth');
+const { jsonBody } = require('../middleware/validate');
+const { compileSerializer } = require('../services/schema');
 const router = express.Router();
 
-// Validate Telegram WebApp init data
-function validateTelegramWebAppData(initData, botToken) {
-    const urlParams = new URLSearchParams(initData);
-    const hash = urlParams.get('hash');
-    urlParams.delete('hash');
-
-    const dataCheckString = Array.from(urlParams.entries())
-        .sort(([a], [b]) => a.localeCompare(b))
-        .map(([key, value]) => `${key}=${value}`)
-        .join('\n');
-
-    const secretKey = crypto.createHmac('sha256', 'WebAppData').update(botToken).digest();
-    const calculatedHash = crypto.createHmac('sha256', secretKey).update(dataCheckString).digest('hex');
-
-    return calculatedHash === hash;
-}
+// Telegram's initData is a short query string; 4 KB leaves ample room
+const loginBody = jsonBody({
+    type: 'object',
+    properties: { initData: { type: 'string', minLength: 1, maxLength: 4096 } },
+    required: ['initData'],
+    additionalProperties: false
+}, { limit: '8kb', error: 'No user data found' });
+
+const text = { type: ['string', 'null'] };
+const integer = { type: 'integer' };
+
+const serializeLogin = compileSerializer({
+    type: 'object',
+    properties: {
+        user: {
+            type: 'object',
+            properties: {
+                id: integer,
+                telegram_id: { type: 'string' },
+                username: text,
+                first_name: text,
+                last_name: text,
+                created_at: text,
+                last_active: text
+            }
+        },
+        progress: {
+            type: 'object',
+            properties: {
+                id: integer,
+                user_id: integer,
+                coins: integer,
+                energy: integer,
+                max_energy: integer,
+                coins_per_tap: integer,
+                energy_regen_rate: integer,
+                total_earned: integer,
+                total_taps: integer,
+                last_save: text,
+                boosters: { type: 'string' },
+                version: integer,
+                energy_updated_at: integer,
+                friend_count: integer
+            }
+        },
+        token: { type: 'string' }
+    }
+});
 
 // Login/Register user
-router.post('/login', async (req, res) => {
+router.post('/login', loginBody, async (req, res) => {
     try {
         const { initData } = req.body;
 
-        // In production, uncomment this validation
-        // if (!validateTelegramWebAppData(initData, process.env.BOT_TOKEN)) {
-        //     return res.status(401).json({ error: 'Invalid Telegram data' });
-        // }
+        if (process.env.NODE_ENV === 'production' && !verifyInitData(initData)) {
+            return res.status(401).json({ error: 'Invalid Telegram data' });
+        }
 
         const urlParams = new URLSearchParams(initData);
         const userParam = urlParams.get('user');
@@ -39,87 +77,75 @@ router.post('/login', async (req, res) => {
         }
 
         const userData = JSON.parse(userParam);
-        const db = getDatabase();
-
-        // Check if user exists
-        db.get('SELECT * FROM users WHERE telegram_id = ?', [userData.id], (err, existingUser) => {
-            if (err) {
-                return res.status(500).json({ error: 'Database error' });
-            }
-
-            if (existingUser) {
-                // Update last active
-                db.run('UPDATE users SET last_active = CURRENT_TIMESTAMP WHERE id = ?', [existingUser.id]);
 
-                // Get game progress
-                db.get('SELECT * FROM game_progress WHERE user_id = ?', [existingUser.id], (err, progress) => {
-                    if (err) {
-                        return res.status(500).json({ error: 'Database error' });
+        // Registers new players, restores archived ones and returns every
+        // known player with their progress
+        statements.all(
+            'loginUser',
+            [String(userData.id), userData.username || null, userData.first_name || null, userData.last_name || null],
+            (err, rows) => {
+                if (err) {
+                    return res.status(500).json({ error: 'Database error' });
+                }
+
+                const { progress, restored, ...user } = rows[0];
+                rememberUser(user.telegram_id, user.id);
+                evaluateTasks([{ userId: user.id, input: 'logins', from: 0, to: 1 }]);
+
+                if (progress) {
+                    const playerProgress = JSON.parse(progress);
+
+                    if (restored) {
+                        // Archiving took the player off the leaderboard
+                        upsertPlayer({
+                            userId: user.id,
+                            telegramId: user.telegram_id,
+                            username: user.username,
+                            firstName: user.first_name,
+                            totalEarned: playerProgress.total_earned,
+                            totalTaps: playerProgress.total_taps
+                        });
+                    } else {
+                        queueLastActive(user.id);
                     }
 
-                    res.json({
-                        user: existingUser,
-                        progress: progress || null,
-                        token: generateToken(existingUser.id)
-                    });
+                    return res.type('json').send(serializeLogin({
+                        user,
+                        progress: playerProgress,
+                        token: signToken(user)
+                    }));
+                }
+
+                upsertPlayer({
+                    userId: user.id,
+                    telegramId: user.telegram_id,
+                    username: user.username,
+                    firstName: user.first_name
                 });
-            } else {
-                // Create new user
-                db.run(
-                    'INSERT INTO users (telegram_id, username, first_name, last_name) VALUES (?, ?, ?, ?)',
-                    [userData.id, userData.username || null, userData.first_name || null, userData.last_name || null],
-                    function(err) {
-                        if (err) {
-                            return res.status(500).json({ error: 'Database error' });
-                        }
-
-                        const userId = this.lastID;
-
-                        // Create initial game progress
-                        db.run(
-                            'INSERT INTO game_progress (user_id) VALUES (?)',
-                            [userId],
-                            (err) => {
-                                if (err) {
-                                    return res.status(500).json({ error: 'Database error' });
-                                }
-
-                                const newUser = {
-                                    id: userId,
-                                    telegram_id: userData.id,
-                                    username: userData.username,
-                                    first_name: userData.first_name,
-                                    last_name: userData.last_name
-                                };
-
-                                res.json({
-                                    user: newUser,
-                                    progress: {
-                                        coins: 0,
-                                        energy: 100,
-                                        max_energy: 100,
-                                        coins_per_tap: 1,
-                                        energy_regen_rate: 1800000,
-                                        total_earned: 0,
-                                        total_taps: 0,
-                                        boosters: '{"energyCapacity":0,"energyRegen":0,"coinsPerTap":0}'
-                                    },
-                                    token: generateToken(userId)
-                                });
-                            }
-                        );
-                    }
-                );
+
+                res.type('json').send(serializeLogin({
+                    user,
+                    progress: {
+                        coins: 0,
+                        energy: 100,
+                        max_energy: 100,
+                        coins_per_tap: 1,
+                        energy_regen_rate: 1800000,
+                        total_earned: 0,
+                        total_taps: 0,
+                        version: 0,
+                        energy_updated_at: Date.now(),
+                        friend_count: 0,
+                        boosters: '{"energyCapacity":0,"energyRegen":0,"coinsPerTap":0}'
+                    },
+                    token: signToken(user)
+                }));
             }
-        });
+        );
     } catch (error) {
         console.error('Auth error:', error);
         res.status(500).json({ error: 'Server error' });
     }
 });
 
-function generateToken(userId) {
-    return crypto.createHash('sha256').update(userId + process.env.JWT_SECRET || 'fallback-secret').digest('hex');
-}
-
 module.exports = router;
@@ -0,0 +1,195 @@
+
+require('dotenv').config();
+const http = require('http');
+const crypto = require('crypto');
+
+// Drive a running local server with a weighted mix of API calls from the
+// players created by bench/seed.js, then report throughput and latency
+// percentiles per route. Start the server with `npm run bench:serve`: it
+// uses the scratch bench.db and lifts the per-IP limit, which would
+// otherwise answer most of the unauthenticated calls.
+const BASE_URL = new URL(process.env.BENCH_URL || 'http://localhost:3000');
+const USERS = parseInt(process.env.BENCH_USERS) || 10000;
+const DURATION = parseInt(process.env.BENCH_DURATION) || 30000;
+const CONCURRENCY = parseInt(process.env.BENCH_CONCURRENCY) || 50;
+const TELEGRAM_ID_BASE = 9000000000;
+
+const agent = new http.Agent({ keepAlive: true, maxSockets: CONCURRENCY });
+
+// Same derivation Telegram uses, so login also works with NODE_ENV=production
+const secretKey = crypto.createHmac('sha256', 'WebAppData')
+    .update(process.env.BOT_TOKEN || '')
+    .digest();
+
+function initDataFor(index) {
+    const params = new URLSearchParams({
+        auth_date: String(Math.floor(Date.now() / 1000)),
+        user: JSON.stringify({ id: TELEGRAM_ID_BASE + index, username: `bench_${index}`, first_name: `Bench ${index}` })
+    });
+    const dataCheckString = Array.from(params.entries())
+        .sort(([a], [b]) => (a < b ? -1 : a > b ? 1 : 0))
+        .map(([key, value]) => `${key}=${value}`)
+        .join('\n');
+
+    params.set('hash', crypto.createHmac('sha256', secretKey).update(dataCheckString).digest('hex'));
+    return params.toString();
+}
+
+function request(method, path, body, token) {
+    return new Promise((resolve) => {
+        const payload = body ? JSON.stringify(body) : null;
+        const headers = {};
+        if (payload) {
+            headers['Content-Type'] = 'application/json';
+            headers['Content-Length'] = Buffer.byteLength(payload);
+        }
+        if (token) {
+            headers.Authorization = `Bearer ${token}`;
+        }
+
+        const started = process.hrtime.bigint();
+        const req = http.request({
+            agent,
+            method,
+            hostname: BASE_URL.hostname,
+            port: BASE_URL.port,
+            path,
+            headers
+        }, (res) => {
+            const chunks = [];
+            res.on('data', (chunk) => chunks.push(chunk));
+            res.on('end', () => {
+                let json = null;
+                try {
+                    json = JSON.parse(Buffer.concat(chunks).toString());
+                } catch {
+                    // Non-JSON bodies are only counted
+                }
+                resolve({ status: res.statusCode, json, ms: Number(process.hrtime.bigint() - started) / 1e6 });
+            });
+        });
+
+        req.on('error', () => resolve({ status: 0, json: null, ms: Number(process.hrtime.bigint() - started) / 1e6 }));
+        if (payload) {
+            req.write(payload);
+        }
+        req.end();
+    });
+}
+
+// Per-player session state kept between calls
+const sessions = new Map();
+
+const results = new Map();
+function record(route, response) {
+    if (!results.has(route)) {
+        results.set(route, { latencies: [], statuses: new Map() });
+    }
+    const result = results.get(route);
+    result.latencies.push(response.ms);
+    result.statuses.set(response.status, (result.statuses.get(response.status) || 0) + 1);
+}
+
+async function login(index) {
+    const response = await request('POST', '/api/auth/login', { initData: initDataFor(index) });
+    record('POST /api/auth/login', response);
+
+    if (response.status === 200 && response.json) {
+        const session = {
+            token: response.json.token,
+            telegramId: String(TELEGRAM_ID_BASE + index)
+        };
+        sessions.set(index, session);
+        return session;
+    }
+    return null;
+}
+
+const randomPlayer = () => Math.floor(Math.random() * USERS);
+const boosterTypes = ['energyCapacity', 'energyRegen', 'coinsPerTap'];
+
+// [weight, route label, action(session, index)]
+const mix = [
+    [25, 'POST /api/game/taps', (s) => request('POST', '/api/game/taps', { taps: 1 + Math.floor(Math.random() * 50) }, s.token)],
+    [10, 'GET /api/game/load', (s) => request('GET', '/api/game/load', null, s.token)],
+    [5, 'POST /api/game/purchase-booster', (s) => request('POST', '/api/game/purchase-booster', {
+        booster_type: boosterTypes[Math.floor(Math.random() * boosterTypes.length)]
+    }, s.token)],
+    [15, 'GET /api/leaderboard/top', () => request('GET', '/api/leaderboard/top/50')],
+    [10, 'GET /api/leaderboard/rank', (s) => request('GET', `/api/leaderboard/rank/${s.telegramId}`)],
+    [5, 'GET /api/leaderboard/around', (s) => request('GET', `/api/leaderboard/around/${s.telegramId}`)],
+    [10, 'GET /api/friends/list', (s) => request('GET', `/api/friends/list/${s.telegramId}`)],
+    [5, 'POST /api/friends/add', (s) => request('POST', '/api/friends/add', {
+        friend_telegram_id: String(TELEGRAM_ID_BASE + randomPlayer())
+    }, s.token)]
+];
+const totalWeight = mix.reduce((sum, [weight]) => sum + weight, 0);
+
+function pickAction() {
+    let roll = Math.random() * totalWeight;
+    for (const entry of mix) {
+        roll -= entry[0];
+        if (roll < 0) {
+            return entry;
+        }
+    }
+    return mix[mix.length - 1];
+}
+
+async function virtualClient(deadline) {
+    while (Date.now() < deadline) {
+        const index = randomPlayer();
+        const session = sessions.get(index) || await login(index);
+        if (!session) {
+            continue;
+        }
+
+        const [, route, action] = pickAction();
+        record(route, await action(session, index));
+    }
+}
+
+function percentile(sorted, p) {
+    return sorted.length === 0 ? 0 : sorted[Math.min(sorted.length - 1, Math.ceil(p / 100 * sorted.length) - 1)];
+}
+
+function report(elapsed) {
+    const rows = [];
+    let total = 0;
+
+    results.forEach(({ latencies, statuses }, route) => {
+        const sorted = latencies.slice().sort((a, b) => a - b);
+        total += sorted.length;
+        rows.push({
+            route,
+            requests: sorted.length,
+            'req/s': Math.round(sorted.length / (elapsed / 1000)),
+            'p50 ms': percentile(sorted, 50).toFixed(2),
+            'p95 ms': percentile(sorted, 95).toFixed(2),
+            'p99 ms': percentile(sorted, 99).toFixed(2),
+            statuses: Array.from(statuses.entries()).map(([status, count]) => `${status}:${count}`).join(' ')
+        });
+    });
+
+    console.table(rows);
+    console.log(`${total} requests in ${(elapsed / 1000).toFixed(1)}s (${Math.round(total / (elapsed / 1000))} req/s) with ${CONCURRENCY} clients`);
+}
+
+async function main() {
+    const health = await request('GET', '/health');
+    if (health.status !== 200) {
+        console.error(`No server answering at ${BASE_URL.href}; start it first`);
+        process.exitCode = 1;
+        return;
+    }
+
+    console.log(`Running ${CONCURRENCY} clients for ${DURATION / 1000}s against ${BASE_URL.href}`);
+    const started = Date.now();
+    const deadline = started + DURATION;
+
+    await Promise.all(Array.from({ length: CONCURRENCY }, () => virtualClient(deadline)));
+    report(Date.now() - started);
+    agent.destroy();
+}
+
+main();
@@ -0,0 +1,97 @@
+
+require('dotenv').config();
+const sqlite3 = require('sqlite3');
+const path = require('path');
+const { runMigrations } = require('../migrations/init');
+
+// Seed the database at DATABASE_PATH with benchmark players. `npm run
+// bench:seed` points it at a scratch bench.db, never the game's database.
+// Players are recognised by their bench_ username, so re-running only adds
+// what is missing.
+const USERS = parseInt(process.env.BENCH_USERS) || 10000;
+const FRIENDS_PER_USER = parseInt(process.env.BENCH_FRIENDS_PER_USER) || 5;
+const TELEGRAM_ID_BASE = 9000000000;
+
+const dbPath = process.env.DATABASE_PATH || path.join(__dirname, '../bench.db');
+const db = new sqlite3.Database(dbPath);
+
+function fail(err) {
+    console.error('Seed error:', err);
+    process.exitCode = 1;
+    db.close();
+}
+
+function seedUsers(callback) {
+    db.serialize(() => {
+        db.run('BEGIN');
+
+        const insertUser = db.prepare('INSERT OR IGNORE INTO users (telegram_id, username, first_name) VALUES (?, ?, ?)');
+        for (let i = 0; i < USERS; i++) {
+            insertUser.run(String(TELEGRAM_ID_BASE + i), `bench_${i}`, `Bench ${i}`);
+        }
+        insertUser.finalize();
+
+        // Spread scores so the leaderboard has a realistic shape. The
+        // progress rows come from the users trigger; only untouched ones
+        // are scored, so players from an earlier run keep theirs.
+        db.run(`
+            UPDATE game_progress
+            SET coins = abs(random()) % 50000,
+                total_earned = abs(random()) % 100000,
+                total_taps = abs(random()) % 100000
+            WHERE version = 0 AND total_taps = 0
+                AND user_id IN (SELECT id FROM users WHERE username GLOB 'bench_*')
+        `);
+
+        db.run('COMMIT', callback);
+    });
+}
+
+function seedFriends(callback) {
+    db.all("SELECT id FROM users WHERE username GLOB 'bench_*'", (err, rows) => {
+        if (err) {
+            return callback(err);
+        }
+
+        const ids = rows.map((row) => row.id);
+
+        db.serialize(() => {
+            db.run('BEGIN');
+
+            const insertFriend = db.prepare('INSERT OR IGNORE INTO friends (user_id, friend_id) VALUES (?, ?)');
+            ids.forEach((userId) => {
+                for (let i = 0; i < FRIENDS_PER_USER; i++) {
+                    const friendId = ids[Math.floor(Math.random() * ids.length)];
+                    if (friendId !== userId) {
+                        insertFriend.run(userId, friendId);
+                    }
+                }
+            });
+            insertFriend.finalize();
+
+            db.run('COMMIT', callback);
+        });
+    });
+}
+
+runMigrations(db, (err) => {
+    if (err) {
+        return fail(err);
+    }
+
+    const started = Date.now();
+    seedUsers((err) => {
+        if (err) {
+            return fail(err);
+        }
+
+        seedFriends((err) => {
+            if (err) {
+                return fail(err);
+            }
+
+            console.log(`Seeded ${USERS} players with up to ${FRIENDS_PER_USER} friends each in ${Date.now() - started}ms`);
+            db.close();
+        });
+    });
+});
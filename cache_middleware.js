@@ -0,0 +1,110 @@
+
+const crypto = require('crypto');
+const coordinator = require('../database/coordinator');
+
+const MAX_ENTRIES = parseInt(process.env.RESPONSE_CACHE_SIZE) || 10000; // per namespace
+
+// namespace -> Map of key -> { body, etag, expiresAt }. Bodies are kept as
+// serialized Buffers so a hit skips both the query and JSON.stringify.
+const namespaces = new Map();
+
+function entriesFor(namespace) {
+    if (!namespaces.has(namespace)) {
+        namespaces.set(namespace, new Map());
+    }
+    return namespaces.get(namespace);
+}
+
+function etagMatches(req, etag) {
+    const header = req.headers['if-none-match'];
+    if (!header) {
+        return false;
+    }
+    return header === '*' || header.split(',').some((tag) => tag.trim() === etag);
+}
+
+function send(req, res, entry) {
+    res.set('ETag', entry.etag);
+    res.set('Cache-Control', 'no-cache');
+
+    if (etagMatches(req, entry.etag)) {
+        return res.status(304).end();
+    }
+
+    res.set('Content-Type', 'application/json; charset=utf-8');
+    res.end(entry.body);
+}
+
+// Cache successful JSON responses for `ttl` ms. Entries are keyed by the
+// request URL unless `options.key(req)` is given, and are shared by every
+// client, so only use this on routes whose response does not depend on
+// who is asking.
+function cacheResponse(namespace, ttl, options = {}) {
+    const keyFor = options.key || ((req) => req.originalUrl);
+
+    return (req, res, next) => {
+        const entries = entriesFor(namespace);
+        const key = keyFor(req);
+        const cached = entries.get(key);
+
+        if (cached && cached.expiresAt > Date.now()) {
+            return send(req, res, cached);
+        }
+
+        const json = res.json.bind(res);
+        res.json = (payload) => {
+            if (res.statusCode !== 200) {
+                return json(payload);
+            }
+
+            const body = Buffer.from(JSON.stringify(payload));
+            const entry = {
+                body,
+                etag: `"${crypto.createHash('sha1').update(body).digest('base64url')}"`,
+                expiresAt: Date.now() + ttl
+            };
+
+            entries.delete(key);
+            entries.set(key, entry);
+            if (entries.size > MAX_ENTRIES) {
+                entries.delete(entries.keys().next().value);
+            }
+
+            send(req, res, entry);
+        };
+
+        next();
+    };
+}
+
+function dropEntries({ namespace, key }) {
+    const entries = namespaces.get(namespace);
+    if (!entries) {
+        return;
+    }
+
+    if (key === undefined) {
+        entries.clear();
+    } else {
+        entries.delete(key);
+    }
+}
+
+// Drop a whole namespace, or one key of it, in every cluster worker
+function invalidate(namespace, key) {
+    coordinator.publish('cache:invalidate', { namespace, key });
+}
+
+// Drop a namespace whenever `event` is delivered. Use this for coordinator
+// events that already reach every worker, such as rank index updates.
+function invalidateOn(event, namespace) {
+    coordinator.subscribe(event, () => dropEntries({ namespace }));
+}
+
+coordinator.subscribe('cache:invalidate', dropEntries);
+
+module.exports = {
+    cacheResponse,
+    invalidate,
+    invalidateOn
+};
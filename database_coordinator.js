@@ -0,0 +1,157 @@
+
+const cluster = require('cluster');
+
+// In cluster mode the primary process is the write coordinator: it owns the
+// only SQLite writer connection and serves no HTTP traffic. Workers send it
+// write operations over IPC and receive replies and broadcast events back.
+// Without cluster mode every call here runs in-process.
+
+const handlers = new Map();
+const subscribers = new Map();
+const pendingReplies = new Map();
+let nextRequestId = 0;
+let shuttingDown = false;
+
+// Workers forked by startCoordinator carry the coordinator's pid; checking
+// it rather than cluster.isWorker keeps PM2 cluster instances standalone
+function isWorker() {
+    return cluster.isWorker && Boolean(process.env.WRITE_COORDINATOR_PID);
+}
+
+// Register an operation workers may invoke; `reply(err, result)` answers it
+function handle(op, handler) {
+    handlers.set(op, handler);
+}
+
+function deliver(event, payload) {
+    (subscribers.get(event) || []).forEach((subscriber) => subscriber(payload));
+}
+
+function subscribe(event, subscriber) {
+    if (!subscribers.has(event)) {
+        subscribers.set(event, []);
+    }
+    subscribers.get(event).push(subscriber);
+}
+
+// Apply an event locally and fan it out to every other process
+function publish(event, payload) {
+    deliver(event, payload);
+
+    if (isWorker()) {
+        process.send({ type: 'publish', event, payload });
+    } else {
+        broadcast(null, event, payload);
+    }
+}
+
+function broadcast(origin, event, payload) {
+    Object.values(cluster.workers || {}).forEach((worker) => {
+        if (worker !== origin && worker.isConnected()) {
+            worker.send({ type: 'event', event, payload });
+        }
+    });
+}
+
+// Run an operation on the coordinator. Omit the callback for fire-and-forget
+// writes; no reply is sent for those.
+function request(op, payload, callback) {
+    if (!isWorker()) {
+        return handlers.get(op)(payload, callback || (() => {}));
+    }
+
+    const message = { type: 'request', op, payload };
+    if (callback) {
+        message.id = ++nextRequestId;
+        pendingReplies.set(message.id, callback);
+    }
+    process.send(message);
+}
+
+function onCoordinatorMessage(worker, message) {
+    if (message.type === 'publish') {
+        deliver(message.event, message.payload);
+        return broadcast(worker, message.event, message.payload);
+    }
+
+    if (message.type !== 'request') {
+        return;
+    }
+
+    const handler = handlers.get(message.op);
+    const reply = (err, result) => {
+        if (message.id !== undefined && worker.isConnected()) {
+            worker.send({
+                type: 'reply',
+                id: message.id,
+                error: err ? err.message : null,
+                result
+            });
+        }
+    };
+
+    if (!handler) {
+        return reply(new Error(`Unknown operation: ${message.op}`));
+    }
+
+    try {
+        handler(message.payload, reply);
+    } catch (error) {
+        console.error('Coordinator operation error:', error);
+        reply(error);
+    }
+}
+
+function forkWorker() {
+    return cluster.fork({ WRITE_COORDINATOR_PID: String(process.pid) });
+}
+
+function startCoordinator(workerCount) {
+    cluster.on('message', onCoordinatorMessage);
+
+    cluster.on('exit', (worker, code, signal) => {
+        if (!shuttingDown) {
+            console.error(`Worker ${worker.process.pid} exited (${signal || code}), restarting`);
+            forkWorker();
+        }
+    });
+
+    for (let i = 0; i < workerCount; i++) {
+        forkWorker();
+    }
+
+    console.log(`Write coordinator ${process.pid} started ${workerCount} workers`);
+}
+
+function stopWorkers(callback) {
+    shuttingDown = true;
+    cluster.disconnect(callback);
+}
+
+function startWorkerChannel() {
+    process.on('message', (message) => {
+        if (message.type === 'reply') {
+            const callback = pendingReplies.get(message.id);
+            pendingReplies.delete(message.id);
+            if (callback) {
+                callback(message.error ? new Error(message.error) : null, message.result);
+            }
+        } else if (message.type === 'event') {
+            deliver(message.event, message.payload);
+        }
+    });
+
+    // Without the coordinator there is nowhere to send writes
+    process.on('disconnect', () => process.exit(1));
+}
+
+module.exports = {
+    isWorker,
+    handle,
+    request,
+    publish,
+    subscribe,
+    startCoordinator,
+    stopWorkers,
+    startWorkerChannel
+};
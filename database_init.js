@@ -1,104 +1,146 @@
 
 const sqlite3 = require('sqlite3').verbose();
 const path = require('path');
+const { runMigrations } = require('../migrations/init');
 
-const dbPath = path.join(__dirname, '../nzi_coin.db');
-let db;
+const dbPath = process.env.DATABASE_PATH || path.join(__dirname, '../nzi_coin.db');
+
+const READ_POOL_SIZE = parseInt(process.env.DB_READ_POOL_SIZE) || 4;
+const CACHE_SIZE_KB = parseInt(process.env.DB_CACHE_SIZE_KB) || 20000;
+const MMAP_SIZE = parseInt(process.env.DB_MMAP_SIZE) || 268435456;
+const BUSY_TIMEOUT = parseInt(process.env.DB_BUSY_TIMEOUT) || 5000;
+
+let db; // the single writer connection
+let readers = [];
+let nextReader = 0;
+
+function tuneConnection(connection, pragmas, callback) {
+    connection.exec(pragmas.map((pragma) => `PRAGMA ${pragma}`).join('; '), callback);
+}
+
+// Opens the writer, migrates, then opens the read pool. The cluster
+// coordinator passes readPoolSize: 0 since it serves no reads.
+function initDatabase(callback, options = {}) {
+    const readPoolSize = options.readPoolSize !== undefined ? options.readPoolSize : READ_POOL_SIZE;
 
-function initDatabase() {
     db = new sqlite3.Database(dbPath, (err) => {
         if (err) {
             console.error('Error opening database:', err.message);
-        } else {
-            console.log('Connected to SQLite database');
-            createTables();
+            return;
         }
+
+        console.log('Connected to SQLite database');
+
+        // WAL lets the read pool run alongside the writer instead of queueing behind it
+        tuneConnection(db, [
+            'journal_mode = WAL',
+            'synchronous = NORMAL',
+            `cache_size = -${CACHE_SIZE_KB}`,
+            `mmap_size = ${MMAP_SIZE}`,
+            `busy_timeout = ${BUSY_TIMEOUT}`,
+            'temp_store = MEMORY'
+        ], (err) => {
+            if (err) {
+                console.error('Error tuning database:', err.message);
+            }
+
+            createTables((err) => {
+                if (err) {
+                    return callback && callback(err);
+                }
+                openReaders(readPoolSize, callback);
+            });
+        });
     });
 }
 
-function createTables() {
-    // Users table
-    db.run(`
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            telegram_id TEXT UNIQUE NOT NULL,
-            username TEXT,
-            first_name TEXT,
-            last_name TEXT,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            last_active DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    `);
-
-    // Game progress table
-    db.run(`
-        CREATE TABLE IF NOT EXISTS game_progress (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            coins INTEGER DEFAULT 0,
-            energy INTEGER DEFAULT 100,
-            max_energy INTEGER DEFAULT 100,
-            coins_per_tap INTEGER DEFAULT 1,
-            energy_regen_rate INTEGER DEFAULT 1800000,
-            total_earned INTEGER DEFAULT 0,
-            total_taps INTEGER DEFAULT 0,
-            last_save DATETIME DEFAULT CURRENT_TIMESTAMP,
-            boosters TEXT DEFAULT '{"energyCapacity":0,"energyRegen":0,"coinsPerTap":0}',
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    `);
-
-    // Friends/referrals table
-    db.run(`
-        CREATE TABLE IF NOT EXISTS friends (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            friend_id INTEGER NOT NULL,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            bonus_claimed BOOLEAN DEFAULT FALSE,
-            FOREIGN KEY (user_id) REFERENCES users (id),
-            FOREIGN KEY (friend_id) REFERENCES users (id),
-            UNIQUE(user_id, friend_id)
-        )
-    `);
-
-    // Tasks/achievements table
-    db.run(`
-        CREATE TABLE IF NOT EXISTS user_tasks (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            task_id TEXT NOT NULL,
-            completed BOOLEAN DEFAULT FALSE,
-            progress INTEGER DEFAULT 0,
-            completed_at DATETIME,
-            FOREIGN KEY (user_id) REFERENCES users (id),
-            UNIQUE(user_id, task_id)
-        )
-    `);
-
-    // Leaderboard view
-    db.run(`
-        CREATE VIEW IF NOT EXISTS leaderboard AS
-        SELECT 
-            u.telegram_id,
-            u.username,
-            u.first_name,
-            gp.total_earned,
-            gp.total_taps,
-            RANK() OVER (ORDER BY gp.total_earned DESC) as rank
-        FROM users u
-        JOIN game_progress gp ON u.id = gp.user_id
-        ORDER BY gp.total_earned DESC
-    `);
-
-    console.log('Database tables created successfully');
+// Read-only connections are opened after migrations so they see the final schema
+function openReaders(count, callback) {
+    let remaining = count;
+    let failed = null;
+
+    if (count === 0) {
+        return callback && callback(null);
+    }
+
+    for (let i = 0; i < count; i++) {
+        const reader = new sqlite3.Database(dbPath, sqlite3.OPEN_READONLY, (err) => {
+            if (err) {
+                failed = err;
+            } else {
+                readers.push(reader);
+            }
+
+            tuneConnection(reader, [
+                `cache_size = -${CACHE_SIZE_KB}`,
+                `mmap_size = ${MMAP_SIZE}`,
+                `busy_timeout = ${BUSY_TIMEOUT}`
+            ], () => {
+                if (--remaining === 0) {
+                    if (failed) {
+                        console.error('Error opening read connection:', failed.message);
+                    }
+                    console.log(`Opened ${readers.length} read connections`);
+                    if (callback) callback(null);
+                }
+            });
+        });
+    }
+}
+
+function createTables(callback) {
+    runMigrations(db, (err) => {
+        if (!err) {
+            console.log('Database tables created successfully');
+        }
+        if (callback) callback(err);
+    });
+}
+
+// Cluster workers only open the read pool; writes go to the coordinator
+function initReadPool(callback) {
+    openReaders(READ_POOL_SIZE, callback);
 }
 
 function getDatabase() {
     return db;
 }
 
+// Round-robin over the read pool; falls back to the writer until it is open
+function getReader() {
+    if (readers.length === 0) {
+        return db;
+    }
+
+    nextReader = (nextReader + 1) % readers.length;
+    return readers[nextReader];
+}
+
+function getReaders() {
+    return readers;
+}
+
+function closeDatabase(callback) {
+    const connections = [...readers, db].filter(Boolean);
+    let remaining = connections.length;
+
+    readers = [];
+    if (remaining === 0) {
+        return callback && callback();
+    }
+
+    connections.forEach((connection) => connection.close(() => {
+        if (--remaining === 0 && callback) {
+            callback();
+        }
+    }));
+}
+
 module.exports = {
     initDatabase,
-    getDatabase
+    initReadPool,
+    getDatabase,
+    getReader,
+    getReaders,
+    closeDatabase
 };
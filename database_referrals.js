@@ -0,0 +1,47 @@
+
+const { getDatabase } = require('./init');
+const coordinator = require('./coordinator');
+const { startQuery } = require('../services/metrics');
+
+// Insert every referral pair, given as a JSON array of [user, friend]
+// telegram ids, in one statement. Unknown users are skipped by the joins,
+// existing friendships by OR IGNORE, and the friends_referral_bonus
+// trigger credits every inserted pair. A single statement is atomic, so a
+// failure leaves no pair imported.
+const IMPORT_SQL = `
+    INSERT OR IGNORE INTO friends (user_id, friend_id)
+    SELECT u.id, f.id
+    FROM json_each(?) AS r
+    JOIN users u ON u.telegram_id = json_extract(r.value, '$[0]')
+    JOIN users f ON f.telegram_id = json_extract(r.value, '$[1]')
+    WHERE u.id != f.id
+    ORDER BY r.key
+`;
+
+// Import [userTelegramId, friendTelegramId] pairs all or nothing. Calls
+// back with the number of new friendships. Safe to retry after an error:
+// pairs already imported are ignored.
+function importReferrals(pairs, callback) {
+    if (coordinator.isWorker()) {
+        return coordinator.request('referrals:import', pairs, callback);
+    }
+
+    const finishQuery = startQuery('importReferrals');
+    const json = JSON.stringify(pairs.map((pair) => pair.map(String)));
+
+    getDatabase().run(IMPORT_SQL, [json], function(err) {
+        finishQuery();
+        if (err) {
+            console.error('Referral import error:', err);
+            return callback(err, 0);
+        }
+
+        callback(null, this.changes);
+    });
+}
+
+coordinator.handle('referrals:import', importReferrals);
+
+module.exports = {
+    importReferrals
+};
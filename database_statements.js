@@ -0,0 +1,559 @@
+
+const { getDatabase, getReader, getReaders } = require('./init');
+const coordinator = require('./coordinator');
+const { startQuery } = require('../services/metrics');
+const { boosters } = require('../config/game');
+
+// Energy is stored as of energy_updated_at (Unix ms) and regenerates one
+// point per energy_regen_rate ms up to max_energy. It is only brought up to
+// date when a row is read or written, so there are no per-player timers.
+const NOW_MS = "CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER)";
+
+function regeneratedSql(prefix = '') {
+    return `((${NOW_MS} - ${prefix}energy_updated_at) / ${prefix}energy_regen_rate)`;
+}
+
+function currentEnergySql(prefix = '') {
+    return `MIN(${prefix}max_energy, ${prefix}energy + ${regeneratedSql(prefix)})`;
+}
+
+// New value for energy_updated_at when energy is materialized. The clock
+// only advances by whole regenerated points so progress towards the next
+// one is kept; a full bar restarts it from now.
+function energyClockSql() {
+    const regenerated = regeneratedSql();
+    return `CASE WHEN energy + ${regenerated} >= max_energy THEN ${NOW_MS}
+        ELSE energy_updated_at + ${regenerated} * energy_regen_rate END`;
+}
+
+const PROGRESS_COLUMNS = [
+    'id', 'user_id', 'coins', 'max_energy', 'coins_per_tap', 'energy_regen_rate',
+    'total_earned', 'total_taps', 'last_save', 'boosters', 'version', 'energy_updated_at', 'friend_count'
+];
+
+function progressColumns(prefix = '') {
+    return PROGRESS_COLUMNS.map((column) => prefix + column).concat(`${currentEnergySql(prefix)} AS energy`).join(', ');
+}
+
+// The same columns as one JSON object, for returning a row alongside another
+function progressObjectSql(prefix = '') {
+    return `json_object(${PROGRESS_COLUMNS.map((column) => `'${column}', ${prefix}${column}`).join(', ')}, 'energy', ${currentEnergySql(prefix)})`;
+}
+
+const SNAPSHOT_COLUMNS =
+    's.user_id, s.telegram_id, s.username, s.first_name, s.total_earned, s.total_taps, s.rank';
+
+// Every fixed query the routes run, prepared once per connection at startup.
+// Reader statements are prepared on each read-only connection; writer
+// statements only on the writer.
+const definitions = {
+    // Users
+    userIdByTelegramId: {
+        reader: true,
+        sql: 'SELECT id FROM users WHERE telegram_id = ?'
+    },
+    // Register, refresh or restore a player in one statement. Existing and
+    // archived players keep their id, so no AUTOINCREMENT value is spent on
+    // a conflict. RETURNING runs before the AFTER INSERT triggers, so
+    // progress is NULL exactly when the player was just created and
+    // restored is set when they came back from users_archive.
+    // last_active is normally left to the write buffer, but a player away
+    // for over a day is marked at once so the archive job cannot take them.
+    loginUser: {
+        sql: `
+            INSERT INTO users (id, telegram_id, username, first_name, last_name, created_at)
+            VALUES (
+                COALESCE(
+                    (SELECT id FROM users WHERE telegram_id = ?1),
+                    (SELECT id FROM users_archive WHERE telegram_id = ?1)
+                ),
+                ?1, ?2, ?3, ?4,
+                COALESCE((SELECT created_at FROM users_archive WHERE telegram_id = ?1), CURRENT_TIMESTAMP)
+            )
+            ON CONFLICT (id) DO UPDATE
+            SET username = excluded.username,
+                first_name = excluded.first_name,
+                last_name = excluded.last_name,
+                last_active = CASE WHEN users.last_active < datetime('now', '-1 day')
+                    THEN CURRENT_TIMESTAMP ELSE users.last_active END
+            RETURNING id, telegram_id, username, first_name, last_name, created_at, last_active,
+                (SELECT ${progressObjectSql('gp.')} FROM game_progress gp WHERE gp.user_id = users.id) AS progress,
+                EXISTS (SELECT 1 FROM users_archive a WHERE a.id = users.id) AS restored
+        `
+    },
+
+    // Game progress
+    progressByUserId: {
+        reader: true,
+        sql: `SELECT ${progressColumns()} FROM game_progress WHERE user_id = ?`
+    },
+    progressForUpdate: {
+        sql: 'SELECT * FROM game_progress WHERE user_id = ?'
+    },
+    loadProgress: {
+        reader: true,
+        sql: `
+            SELECT ${progressColumns('gp.')}, u.username, u.first_name
+            FROM game_progress gp
+            JOIN users u ON gp.user_id = u.id
+            WHERE gp.user_id = ?
+        `
+    },
+
+    // Leaderboard
+    leaderboardTop: {
+        reader: true,
+        sql: `
+            SELECT
+                gp.user_id,
+                u.telegram_id,
+                u.username,
+                u.first_name,
+                gp.total_earned,
+                gp.total_taps,
+                RANK() OVER (ORDER BY gp.total_earned DESC) as rank
+            FROM users u
+            JOIN game_progress gp ON u.id = gp.user_id
+            ORDER BY gp.total_earned DESC, gp.user_id
+            LIMIT ?
+        `
+    },
+    leaderboardRank: {
+        reader: true,
+        sql: `
+            SELECT rank, total_earned, total_taps
+            FROM leaderboard
+            WHERE telegram_id = ?
+        `
+    },
+    snapshotTop: {
+        reader: true,
+        sql: `
+            SELECT ${SNAPSHOT_COLUMNS}
+            FROM leaderboard_snapshot_meta m
+            JOIN leaderboard_snapshot s ON s.slot = m.slot
+            WHERE m.id = 1 AND s.position <= ?
+            ORDER BY s.position
+        `
+    },
+    // Rows after a (total_earned, user_id) cursor: the rest of the cursor's
+    // score tie, then lower scores. Both halves are index seeks, so deep
+    // pages cost the same as the first.
+    snapshotPage: {
+        reader: true,
+        sql: `
+            SELECT * FROM (
+                SELECT ${SNAPSHOT_COLUMNS} FROM leaderboard_snapshot s
+                WHERE s.slot = (SELECT slot FROM leaderboard_snapshot_meta WHERE id = 1)
+                    AND s.total_earned = ?1 AND s.user_id > ?2
+                ORDER BY s.user_id
+                LIMIT ?3
+            )
+            UNION ALL
+            SELECT * FROM (
+                SELECT ${SNAPSHOT_COLUMNS} FROM leaderboard_snapshot s
+                WHERE s.slot = (SELECT slot FROM leaderboard_snapshot_meta WHERE id = 1)
+                    AND s.total_earned < ?1
+                ORDER BY s.total_earned DESC, s.user_id
+                LIMIT ?3
+            )
+            ORDER BY total_earned DESC, user_id
+            LIMIT ?3
+        `
+    },
+    snapshotAround: {
+        reader: true,
+        sql: `
+            SELECT ${SNAPSHOT_COLUMNS}
+            FROM leaderboard_snapshot_meta m
+            JOIN leaderboard_snapshot me ON me.slot = m.slot AND me.telegram_id = ?1
+            JOIN leaderboard_snapshot s ON s.slot = m.slot
+                AND s.position BETWEEN me.position - ?2 AND me.position + ?2
+            WHERE m.id = 1
+            ORDER BY s.position
+        `
+    },
+    snapshotRank: {
+        reader: true,
+        sql: `
+            SELECT s.rank, s.total_earned, s.total_taps
+            FROM leaderboard_snapshot_meta m
+            JOIN leaderboard_snapshot s ON s.slot = m.slot
+            WHERE m.id = 1 AND s.telegram_id = ?
+        `
+    },
+    snapshotMeta: {
+        sql: 'SELECT slot, taken_at, player_count FROM leaderboard_snapshot_meta WHERE id = 1'
+    },
+    clearSnapshotSlot: {
+        sql: 'DELETE FROM leaderboard_snapshot WHERE slot = ?'
+    },
+    // One sorted pass: ties share a RANK() but get consecutive positions in
+    // user id order, which is the order page cursors follow
+    fillSnapshotSlot: {
+        sql: `
+            INSERT INTO leaderboard_snapshot
+                (slot, position, rank, user_id, telegram_id, username, first_name, total_earned, total_taps)
+            SELECT ?, ROW_NUMBER() OVER (ORDER BY gp.total_earned DESC, gp.user_id),
+                RANK() OVER (ORDER BY gp.total_earned DESC),
+                u.id, u.telegram_id, u.username, u.first_name, gp.total_earned, gp.total_taps
+            FROM game_progress gp
+            JOIN users u ON u.id = gp.user_id
+        `
+    },
+    activateSnapshotSlot: {
+        sql: 'UPDATE leaderboard_snapshot_meta SET slot = ?, taken_at = ?, player_count = ? WHERE id = 1'
+    },
+    rankIndexPlayers: {
+        reader: true,
+        sql: `
+            SELECT u.id, u.telegram_id, u.username, u.first_name, gp.total_earned, gp.total_taps
+            FROM users u
+            JOIN game_progress gp ON u.id = gp.user_id
+        `
+    },
+
+    // Friends
+    // Both players must be live: an archived id can still be cached in a
+    // worker until the eviction reaches it
+    insertFriend: {
+        sql: `
+            INSERT OR IGNORE INTO friends (user_id, friend_id)
+            SELECT ?1, ?2
+            WHERE EXISTS (SELECT 1 FROM game_progress WHERE user_id = ?1)
+                AND EXISTS (SELECT 1 FROM game_progress WHERE user_id = ?2)
+        `
+    },
+    // friend_count is kept up to date by the friends_referral_bonus trigger
+    friendCount: {
+        reader: true,
+        sql: 'SELECT friend_count AS count FROM game_progress WHERE user_id = ?'
+    },
+    friendCountsByTelegramId: {
+        reader: true,
+        sql: `
+            SELECT gp.user_id, gp.friend_count AS count
+            FROM users u
+            JOIN game_progress gp ON gp.user_id = u.id
+            WHERE u.telegram_id IN (SELECT value FROM json_each(?)) AND gp.friend_count > 0
+        `
+    },
+    // Players referred directly (depth 1) or through others, per level up
+    // to the given depth. Archived players count but earn nothing.
+    referralLevels: {
+        reader: true,
+        sql: `
+            SELECT rt.depth, COUNT(*) AS players, COALESCE(SUM(gp.total_earned), 0) AS total_earned
+            FROM referral_tree rt
+            LEFT JOIN game_progress gp ON gp.user_id = rt.descendant_id
+            WHERE rt.ancestor_id = ? AND rt.depth <= ?
+            GROUP BY rt.depth
+            ORDER BY rt.depth
+        `
+    },
+
+    // Tasks
+    userTasks: {
+        reader: true,
+        sql: `
+            SELECT task_id, completed_at, date(completed_at) = date('now') AS completed_today
+            FROM user_tasks
+            WHERE user_id = ? AND completed
+        `
+    },
+    // Scores of a JSON array of user ids, read back after rewards are paid
+    progressTotals: {
+        sql: `
+            SELECT user_id, total_earned, total_taps
+            FROM game_progress
+            WHERE user_id IN (SELECT value FROM json_each(?))
+        `
+    },
+
+    // Keyset page of a user's friends after the (total_earned, user_id) of
+    // the previous page's last row; pass NULLs for the first page
+    friendsPage: {
+        reader: true,
+        sql: `
+            SELECT
+                gp.user_id,
+                u.telegram_id,
+                u.username,
+                u.first_name,
+                gp.total_earned,
+                f.created_at as friend_since
+            FROM friends f
+            JOIN users u ON f.friend_id = u.id
+            JOIN game_progress gp ON u.id = gp.user_id
+            WHERE f.user_id = ?1
+                AND (?2 IS NULL OR gp.total_earned < ?2 OR (gp.total_earned = ?2 AND gp.user_id > ?3))
+            ORDER BY gp.total_earned DESC, gp.user_id
+            LIMIT ?4
+        `
+    }
+};
+
+// Buying a booster is a single conditional UPDATE per booster type: the
+// price and the new stat value are looked up from the current level inside
+// SQLite, so no read-modify-write window exists. An empty result means the
+// player cannot afford it or the booster is maxed out.
+function purchaseBoosterSql(type) {
+    const { column, levels, costs } = boosters[type];
+    const level = `COALESCE(json_extract(COALESCE(boosters, '{}'), '$.${type}'), 0)`;
+    const cost = `CASE ${level} ${costs.map((price, i) => `WHEN ${i} THEN ${price}`).join(' ')} END`;
+    const nextValue = `CASE ${level} ${levels.slice(1).map((value, i) => `WHEN ${i} THEN ${value}`).join(' ')} END`;
+    const energy = currentEnergySql();
+
+    const assignments = [
+        `coins = coins - (${cost})`,
+        `boosters = json_set(COALESCE(boosters, '{}'), '$.${type}', ${level} + 1)`,
+        `${column} = ${nextValue}`,
+        'version = version + 1',
+        `energy_updated_at = ${energyClockSql()}`
+    ];
+
+    // Energy is settled at the old rate and capacity first. A full energy
+    // bar stays full when capacity grows, as on the client.
+    if (column === 'max_energy') {
+        assignments.push(`energy = CASE WHEN ${energy} = max_energy THEN ${nextValue} ELSE ${energy} END`);
+    } else {
+        assignments.push(`energy = ${energy}`);
+    }
+
+    return `
+        UPDATE game_progress
+        SET ${assignments.join(', ')}
+        WHERE user_id = ? AND coins >= (${cost})
+        RETURNING coins, boosters, energy, max_energy, energy_regen_rate, coins_per_tap, version
+    `;
+}
+
+Object.keys(boosters).forEach((type) => {
+    definitions[`purchaseBooster:${type}`] = { sql: purchaseBoosterSql(type) };
+});
+
+let writerStatements = new Map();
+let readerStatements = [];
+let nextReader = 0;
+
+function prepareOn(connection, names, callback) {
+    const prepared = new Map();
+    let remaining = names.length;
+    let failed = null;
+
+    if (remaining === 0) {
+        return callback(null, prepared);
+    }
+
+    names.forEach((name) => {
+        const statement = connection.prepare(definitions[name].sql, (err) => {
+            if (err) {
+                failed = failed || new Error(`Failed to prepare ${name}: ${err.message}`);
+            } else {
+                prepared.set(name, statement);
+            }
+
+            if (--remaining === 0) {
+                callback(failed, prepared);
+            }
+        });
+    });
+}
+
+// Prepare every definition on the connections this process owns. Call once
+// the schema is migrated and the read pool is open. Cluster workers have no
+// writer connection; their writer statements run on the coordinator.
+function prepareStatements(callback) {
+    const names = Object.keys(definitions);
+    const readerNames = names.filter((name) => definitions[name].reader);
+    const writerNames = getDatabase() ? names.filter((name) => !definitions[name].reader) : [];
+    const readers = getReaders();
+    let remaining = readers.length + 1;
+    let failed = null;
+
+    const preparedReaders = new Array(readers.length);
+    const finish = (err) => {
+        failed = failed || err;
+        if (--remaining > 0) {
+            return;
+        }
+
+        readerStatements = preparedReaders.filter(Boolean);
+        if (failed) {
+            console.error('Statement preparation error:', failed.message);
+        } else {
+            console.log(`Prepared ${names.length} statements`);
+        }
+        if (callback) callback(failed);
+    };
+
+    prepareOn(getDatabase(), writerNames, (err, prepared) => {
+        writerStatements = prepared;
+        finish(err);
+    });
+
+    readers.forEach((reader, i) => {
+        prepareOn(reader, readerNames, (err, prepared) => {
+            preparedReaders[i] = prepared;
+            finish(err);
+        });
+    });
+}
+
+function definitionFor(name) {
+    const definition = definitions[name];
+    if (!definition) {
+        throw new Error(`Unknown statement: ${name}`);
+    }
+    return definition;
+}
+
+function lookup(name) {
+    const definition = definitionFor(name);
+
+    if (!definition.reader) {
+        return writerStatements.get(name);
+    }
+    if (readerStatements.length === 0) {
+        return undefined;
+    }
+
+    nextReader = (nextReader + 1) % readerStatements.length;
+    return readerStatements[nextReader].get(name);
+}
+
+// Until statements are prepared, queries run as raw SQL
+function fallbackConnection(name) {
+    return definitions[name].reader ? getReader() : getDatabase();
+}
+
+// Writer statements in a cluster worker are forwarded to the coordinator
+function forwardToCoordinator(method, name, params, callback) {
+    if (!callback) {
+        return coordinator.request('statement', { method, name, params });
+    }
+
+    coordinator.request('statement', { method, name, params }, (err, result) => {
+        if (method === 'run') {
+            return callback.call(result || {}, err);
+        }
+        callback(err, result);
+    });
+}
+
+// Every call is timed under its statement name. Forwarded calls include
+// the round trip to the coordinator; fire-and-forget ones are only timed
+// where they run.
+function timed(name, callback) {
+    const done = startQuery(name);
+    return function(...args) {
+        done();
+        if (callback) {
+            callback.apply(this, args);
+        }
+    };
+}
+
+function get(name, params, callback) {
+    if (coordinator.isWorker() && !definitionFor(name).reader) {
+        return forwardToCoordinator('get', name, params, callback && timed(name, callback));
+    }
+
+    const finish = timed(name, callback);
+
+    const statement = lookup(name);
+    if (!statement) {
+        return fallbackConnection(name).get(definitions[name].sql, params, finish);
+    }
+
+    statement.get(params, (err, row) => {
+        // Release the read snapshot instead of holding it until the next call
+        statement.reset();
+        finish(err, row);
+    });
+}
+
+function all(name, params, callback) {
+    if (coordinator.isWorker() && !definitionFor(name).reader) {
+        return forwardToCoordinator('all', name, params, callback && timed(name, callback));
+    }
+
+    const finish = timed(name, callback);
+
+    const statement = lookup(name);
+    if (!statement) {
+        return fallbackConnection(name).all(definitions[name].sql, params, finish);
+    }
+
+    statement.all(params, finish);
+}
+
+function each(name, params, rowCallback, completeCallback) {
+    const finish = timed(name, completeCallback);
+
+    const statement = lookup(name);
+    if (!statement) {
+        return fallbackConnection(name).each(definitions[name].sql, params, rowCallback, finish);
+    }
+
+    statement.each(params, rowCallback, finish);
+}
+
+// The callback is invoked with `this` bound to the statement, so
+// `this.lastID` and `this.changes` work as with db.run
+function run(name, params, callback) {
+    if (coordinator.isWorker() && !definitionFor(name).reader) {
+        return forwardToCoordinator('run', name, params, callback && timed(name, callback));
+    }
+
+    const finish = timed(name, callback);
+
+    const statement = lookup(name);
+    if (!statement) {
+        return fallbackConnection(name).run(definitions[name].sql, params, finish);
+    }
+
+    statement.run(params, finish);
+}
+
+coordinator.handle('statement', ({ method, name, params }, reply) => {
+    if (method === 'run') {
+        return run(name, params, function(err) {
+            reply(err, err ? null : { lastID: this.lastID, changes: this.changes });
+        });
+    }
+
+    (method === 'all' ? all : get)(name, params, reply);
+});
+
+function finalizeStatements(callback) {
+    const statements = [
+        ...writerStatements.values(),
+        ...readerStatements.flatMap((prepared) => [...prepared.values()])
+    ];
+    let remaining = statements.length;
+
+    writerStatements = new Map();
+    readerStatements = [];
+
+    if (remaining === 0) {
+        return callback && callback();
+    }
+
+    statements.forEach((statement) => statement.finalize(() => {
+        if (--remaining === 0 && callback) {
+            callback();
+        }
+    }));
+}
+
+module.exports = {
+    currentEnergySql,
+    energyClockSql,
+    prepareStatements,
+    finalizeStatements,
+    get,
+    all,
+    each,
+    run
+};
@@ -0,0 +1,186 @@
+
+const { getDatabase } = require('./init');
+const coordinator = require('./coordinator');
+const { currentEnergySql, energyClockSql } = require('./statements');
+const { updateScores } = require('../services/rankIndex');
+const { evaluateTasks } = require('../services/taskEngine');
+const { startQuery } = require('../services/metrics');
+
+const FLUSH_INTERVAL = parseInt(process.env.TAP_FLUSH_INTERVAL) || 1000;
+const ROWS_PER_STATEMENT = 400; // 2 bound parameters per row, stays under SQLite's 999 limit
+
+let pending = new Map();
+let activeUsers = new Set();
+let flushTimer = null;
+let flushing = false;
+
+// Fold a tap delta into the pending buffer, coalescing per user. Cluster
+// workers hand the delta to the coordinator, which owns the buffer.
+function queueTaps(userId, taps) {
+    if (coordinator.isWorker()) {
+        return coordinator.request('taps', { userId, taps });
+    }
+
+    pending.set(userId, (pending.get(userId) || 0) + taps);
+}
+
+coordinator.handle('taps', ({ userId, taps }) => queueTaps(userId, taps));
+
+// Mark a player as seen; last_active is written with the next flush
+function queueLastActive(userId) {
+    if (coordinator.isWorker()) {
+        return coordinator.request('active', userId);
+    }
+
+    activeUsers.add(userId);
+}
+
+coordinator.handle('active', queueLastActive);
+
+// Apply many users' tap deltas in one statement; taps beyond the
+// player's current (regenerated) energy are discarded server-side
+function buildFlushStatement(rowCount) {
+    const values = new Array(rowCount).fill('(?, ?)').join(', ');
+    const energy = currentEnergySql();
+    const spent = `MIN(d.column2, ${energy})`;
+
+    return `
+        UPDATE game_progress
+        SET coins = coins + ${spent} * coins_per_tap,
+            total_earned = total_earned + ${spent} * coins_per_tap,
+            total_taps = total_taps + ${spent},
+            energy = ${energy} - ${spent},
+            energy_updated_at = ${energyClockSql()},
+            version = version + 1,
+            last_save = CURRENT_TIMESTAMP
+        FROM (VALUES ${values}) AS d
+        WHERE game_progress.user_id = d.column1
+        RETURNING user_id, total_earned, total_taps
+    `;
+}
+
+// Callers waiting for a flush that starts after the one in progress
+let waiting = [];
+
+function publishApplied(batch, updated) {
+    updateScores(updated.map((row) => ({
+        userId: row.user_id,
+        totalEarned: row.total_earned,
+        totalTaps: row.total_taps
+    })));
+
+    // At most the buffered taps were applied, so the counter started no
+    // lower than that
+    evaluateTasks(updated.map((row) => ({
+        userId: row.user_id,
+        input: 'total_taps',
+        from: row.total_taps - batch.get(row.user_id),
+        to: row.total_taps
+    })));
+}
+
+// Write every buffered delta and last_active mark to SQLite. Each chunk is
+// a single UPDATE, atomic on its own; no explicit transaction is opened,
+// since the writer connection is shared with the prepared statements and
+// their writes would otherwise land inside it. A chunk that fails is
+// queued again. With a callback, a call made while a flush is running
+// waits for it and then flushes again, so nothing buffered meanwhile is
+// left out.
+function flushTaps(callback) {
+    const done = callback || (() => {});
+
+    if (flushing) {
+        if (callback) {
+            waiting.push(callback);
+        }
+        return;
+    }
+
+    if (pending.size === 0 && activeUsers.size === 0) {
+        return done();
+    }
+
+    const batch = pending;
+    const active = Array.from(activeUsers);
+    pending = new Map();
+    activeUsers = new Set();
+    flushing = true;
+
+    const rows = Array.from(batch.entries());
+    const db = getDatabase();
+    const finishQuery = startQuery('tapFlush');
+    const applied = [];
+    let firstError = null;
+    let remaining = Math.ceil(rows.length / ROWS_PER_STATEMENT) + (active.length > 0 ? 1 : 0);
+
+    const settle = (err) => {
+        if (err && !firstError) {
+            firstError = err;
+        }
+        if (--remaining > 0) {
+            return;
+        }
+
+        finishQuery();
+        if (applied.length > 0) {
+            publishApplied(batch, applied);
+        }
+
+        flushing = false;
+        done(firstError);
+
+        const callbacks = waiting;
+        waiting = [];
+        if (callbacks.length > 0) {
+            flushTaps((flushErr) => callbacks.forEach((waiter) => waiter(flushErr)));
+        }
+    };
+
+    if (active.length > 0) {
+        db.run(
+            'UPDATE users SET last_active = CURRENT_TIMESTAMP WHERE id IN (SELECT value FROM json_each(?))',
+            [JSON.stringify(active)],
+            (err) => {
+                if (err) {
+                    console.error('Last active flush error:', err);
+                    active.forEach(queueLastActive);
+                }
+                settle(err);
+            }
+        );
+    }
+
+    for (let i = 0; i < rows.length; i += ROWS_PER_STATEMENT) {
+        const chunk = rows.slice(i, i + ROWS_PER_STATEMENT);
+
+        db.all(buildFlushStatement(chunk.length), chunk.flat(), (err, updated) => {
+            if (err) {
+                // Nothing in the chunk was applied: queue its deltas again
+                console.error('Tap flush error:', err);
+                chunk.forEach(([userId, taps]) => queueTaps(userId, taps));
+            } else {
+                applied.push(...updated);
+            }
+            settle(err);
+        });
+    }
+}
+
+function startTapFlusher() {
+    if (!flushTimer) {
+        flushTimer = setInterval(flushTaps, FLUSH_INTERVAL);
+    }
+}
+
+function stopTapFlusher() {
+    clearInterval(flushTimer);
+    flushTimer = null;
+}
+
+module.exports = {
+    queueTaps,
+    queueLastActive,
+    flushTaps,
+    startTapFlusher,
+    stopTapFlusher
+};
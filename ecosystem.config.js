@@ -3,13 +3,17 @@ module.exports = {
   apps: [{
     name: 'nzi-coin-backend',
     script: 'server.js',
+    // Keep a single PM2 instance: server.js forks its own HTTP workers
+    // (CLUSTER_WORKERS) and funnels their writes through one coordinator
     instances: 1,
+    exec_mode: 'fork',
     autorestart: true,
     watch: false,
     max_memory_restart: '1G',
     env: {
       NODE_ENV: 'production',
-      PORT: 3000
+      PORT: 3000,
+      CLUSTER_WORKERS: 'max'
     },
     error_file: './logs/err.log',
     out_file: './logs/out.log',
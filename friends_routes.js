@@ -1,80 +1,190 @@
 
 const express = require('express');
-const { getDatabase } = require('../database/init');
+const statements = require('../database/statements');
+const { importReferrals } = require('../database/referrals');
+const { evaluateTasks } = require('../services/taskEngine');
+const { resolveUserId } = require('../services/userCache');
+const { cacheResponse, invalidate } = require('../middleware/cache');
+const { streamJsonArray } = require('../services/jsonStream');
+const { jsonBody } = require('../middleware/validate');
+const { compileSerializer } = require('../services/schema');
+const { requireAuth, requireAdmin } = require('../middleware/auth');
 const router = express.Router();
 
-// Add friend (referral)
-router.post('/add', (req, res) => {
+const CACHE_TTL = parseInt(process.env.FRIENDS_CACHE_TTL) || 30000;
+const STREAM_CHUNK_SIZE = 500;
+const MAX_REFERRALS_PER_IMPORT = parseInt(process.env.MAX_REFERRALS_PER_IMPORT) || 1000;
+const MAX_REFERRAL_DEPTH = 10;
+
+// Telegram ids arrive as numbers or numeric strings
+const telegramId = { type: ['integer', 'string'], minimum: 1, pattern: '^[0-9]{1,20}$' };
+
+const referral = {
+    type: 'object',
+    properties: { user_telegram_id: telegramId, friend_telegram_id: telegramId },
+    required: ['user_telegram_id', 'friend_telegram_id'],
+    additionalProperties: false
+};
+
+// The referrer is the signed-in player, never a field of the body
+const addBody = jsonBody({
+    type: 'object',
+    properties: { friend_telegram_id: telegramId },
+    required: ['friend_telegram_id'],
+    additionalProperties: false
+}, { error: 'Invalid referral' });
+
+const importBody = jsonBody({
+    type: 'object',
+    properties: {
+        referrals: { type: 'array', items: referral, minItems: 1, maxItems: MAX_REFERRALS_PER_IMPORT }
+    },
+    required: ['referrals'],
+    additionalProperties: false
+}, { limit: MAX_REFERRALS_PER_IMPORT * 128, error: 'Invalid referrals' });
+
+const serializeAdd = compileSerializer({
+    type: 'object',
+    properties: { success: { type: 'boolean' }, bonus_given: { type: 'boolean' } }
+});
+
+// Friend rows go out without the internal user id used for paging
+function toFriend({ user_id, ...friend }) {
+    return friend;
+}
+
+// Add friend (referral) for the signed-in player
+router.post('/add', requireAuth, addBody, (req, res) => {
     try {
-        const { user_telegram_id, friend_telegram_id } = req.body;
-        const db = getDatabase();
+        const { friend_telegram_id } = req.body;
+        const userId = req.user.id;
+
+        resolveUserId(friend_telegram_id, (err, friendId) => {
+            if (err || !friendId) {
+                return res.status(404).json({ error: 'Friend not found' });
+            }
+
+            if (friendId === userId) {
+                return res.status(400).json({ error: 'Cannot add yourself as a friend' });
+            }
+
+            // Add friendship; the referral bonus (500 coins each) is
+            // credited by a trigger in the same statement
+            statements.run(
+                'insertFriend',
+                [userId, friendId],
+                function(err) {
+                    if (err) {
+                        return res.status(500).json({ error: 'Failed to add friend' });
+                    }
+
+                    if (this.changes > 0) {
+                        invalidate('friends', String(req.user.telegramId));
+                        statements.get('friendCount', [userId], (err, friends) => {
+                            if (!err && friends) {
+                                evaluateTasks([{ userId, input: 'friends', from: friends.count - 1, to: friends.count }]);
+                            }
+                        });
+                    }
+
+                    res.type('json').send(serializeAdd({ success: true, bonus_given: this.changes > 0 }));
+                }
+            );
+        });
+    } catch (error) {
+        console.error('Add friend error:', error);
+        res.status(500).json({ error: 'Server error' });
+    }
+});
 
-        // Get user IDs
-        db.get('SELECT id FROM users WHERE telegram_id = ?', [user_telegram_id], (err, user) => {
-            if (err || !user) {
+// Import a batch of referrals in one transaction; operators only, since
+// every pair credits both players
+router.post('/import', requireAdmin, importBody, (req, res) => {
+    try {
+        const pairs = req.body.referrals.map((entry) => [entry.user_telegram_id, entry.friend_telegram_id]);
+
+        importReferrals(pairs, (err, imported) => {
+            if (err) {
+                return res.status(500).json({ error: 'Failed to import referrals' });
+            }
+
+            const referrers = [...new Set(pairs.map(([userTelegramId]) => String(userTelegramId)))];
+            referrers.forEach((telegramId) => invalidate('friends', telegramId));
+
+            statements.all('friendCountsByTelegramId', [JSON.stringify(referrers)], (err, counts) => {
+                if (!err) {
+                    evaluateTasks(counts.map((row) => ({ userId: row.user_id, input: 'friends', from: 0, to: row.count })));
+                }
+            });
+
+            res.json({ success: true, received: pairs.length, imported });
+        });
+    } catch (error) {
+        console.error('Import referrals error:', error);
+        res.status(500).json({ error: 'Server error' });
+    }
+});
+
+// Referral stats per level of a player's referral tree; level 1 is the
+// players they referred themselves
+router.get('/referrals/:telegram_id', cacheResponse('referrals', CACHE_TTL), (req, res) => {
+    try {
+        const depth = Math.min(Math.max(parseInt(req.query.depth) || 3, 1), MAX_REFERRAL_DEPTH);
+
+        resolveUserId(req.params.telegram_id, (err, userId) => {
+            if (err || !userId) {
                 return res.status(404).json({ error: 'User not found' });
             }
 
-            db.get('SELECT id FROM users WHERE telegram_id = ?', [friend_telegram_id], (err, friend) => {
-                if (err || !friend) {
-                    return res.status(404).json({ error: 'Friend not found' });
+            statements.all('referralLevels', [userId, depth], (err, levels) => {
+                if (err) {
+                    return res.status(500).json({ error: 'Database error' });
                 }
 
-                // Add friendship
-                db.run(
-                    'INSERT OR IGNORE INTO friends (user_id, friend_id) VALUES (?, ?)',
-                    [user.id, friend.id],
-                    function(err) {
-                        if (err) {
-                            return res.status(500).json({ error: 'Failed to add friend' });
-                        }
-
-                        // Give referral bonus (500 coins each)
-                        if (this.changes > 0) {
-                            db.run('UPDATE game_progress SET coins = coins + 500 WHERE user_id = ?', [user.id]);
-                            db.run('UPDATE game_progress SET coins = coins + 500 WHERE user_id = ?', [friend.id]);
-                        }
-
-                        res.json({ success: true, bonus_given: this.changes > 0 });
-                    }
-                );
+                res.json({
+                    players: levels.reduce((sum, level) => sum + level.players, 0),
+                    total_earned: levels.reduce((sum, level) => sum + level.total_earned, 0),
+                    levels
+                });
             });
         });
     } catch (error) {
-        console.error('Add friend error:', error);
+        console.error('Get referrals error:', error);
         res.status(500).json({ error: 'Server error' });
     }
 });
 
 // Get user's friends
-router.get('/list/:telegram_id', (req, res) => {
+router.get('/list/:telegram_id', cacheResponse('friends', CACHE_TTL, {
+    key: (req) => req.params.telegram_id
+}), (req, res) => {
     try {
         const { telegram_id } = req.params;
-        const db = getDatabase();
 
-        db.get('SELECT id FROM users WHERE telegram_id = ?', [telegram_id], (err, user) => {
-            if (err || !user) {
+        resolveUserId(telegram_id, (err, userId) => {
+            if (err || !userId) {
                 return res.status(404).json({ error: 'User not found' });
             }
 
-            db.all(`
-                SELECT 
-                    u.telegram_id,
-                    u.username,
-                    u.first_name,
-                    gp.total_earned,
-                    f.created_at as friend_since
-                FROM friends f
-                JOIN users u ON f.friend_id = u.id
-                JOIN game_progress gp ON u.id = gp.user_id
-                WHERE f.user_id = ?
-                ORDER BY gp.total_earned DESC
-            `, [user.id], (err, friends) => {
+            const fetchPage = (after, callback) => statements.all('friendsPage', [
+                userId,
+                after ? after.total_earned : null,
+                after ? after.user_id : null,
+                STREAM_CHUNK_SIZE
+            ], callback);
+
+            fetchPage(null, (err, friends) => {
                 if (err) {
                     return res.status(500).json({ error: 'Database error' });
                 }
 
-                res.json(friends);
+                // Lists that fit in one chunk are sent (and cached) whole;
+                // longer ones are streamed a chunk at a time
+                if (friends.length < STREAM_CHUNK_SIZE) {
+                    return res.json(friends.map(toFriend));
+                }
+
+                streamJsonArray(res, friends, fetchPage, toFriend);
             });
         });
     } catch (error) {
@@ -0,0 +1,43 @@
+
+// Server-side copy of the balance tables in the client's GameState.config.
+// The server's values are authoritative; clients only display them.
+const maxEnergyLevels = [100, 150, 200, 300, 500];
+const regenRateLevels = [1800000, 1500000, 1200000, 900000, 600000]; // 30min, 25min, 20min, 15min, 10min
+const coinsPerTapLevels = [1, 2, 3, 5, 10];
+
+// Each booster raises one game_progress column to the next entry in
+// `levels`; costs[n] is the price of going from level n to n + 1
+const boosters = {
+    energyCapacity: {
+        column: 'max_energy',
+        levels: maxEnergyLevels,
+        costs: [100, 250, 500, 1000]
+    },
+    energyRegen: {
+        column: 'energy_regen_rate',
+        levels: regenRateLevels,
+        costs: [150, 300, 600, 1200]
+    },
+    coinsPerTap: {
+        column: 'coins_per_tap',
+        levels: coinsPerTapLevels,
+        costs: [200, 400, 800, 1600]
+    }
+};
+
+// Task catalogue. A task completes once its input counter reaches the
+// target; daily tasks can be completed again on a later (UTC) day.
+const tasks = {
+    dailyLogin: { input: 'logins', target: 1, reward: 100, daily: true },
+    tapChampion: { input: 'total_taps', target: 1000, reward: 500 },
+    recruit: { input: 'friends', target: 1, reward: 1000 },
+    energyMaster: { input: 'max_energy', target: 500, reward: 2000 }
+};
+
+module.exports = {
+    tasks,
+    maxEnergyLevels,
+    regenRateLevels,
+    coinsPerTapLevels,
+    boosters
+};
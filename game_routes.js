@@ -1,69 +1,100 @@
 
 const express = require('express');
-const { getDatabase } = require('../database/init');
+const statements = require('../database/statements');
+const { queueTaps } = require('../database/writeBuffer');
+const { evaluateTasks, describeTasks } = require('../services/taskEngine');
+const { requireAuth } = require('../middleware/auth');
+const { userRateLimit } = require('../middleware/rateLimit');
+const { jsonBody } = require('../middleware/validate');
+const { compileSerializer } = require('../services/schema');
+const { boosters: boosterTable } = require('../config/game');
 const router = express.Router();
 
-// Save game progress
-router.post('/save', (req, res) => {
-    try {
-        const {
-            telegram_id,
-            coins,
-            energy,
-            max_energy,
-            coins_per_tap,
-            energy_regen_rate,
-            total_earned,
-            total_taps,
-            boosters
-        } = req.body;
-
-        const db = getDatabase();
-
-        // First, get user ID from telegram_id
-        db.get('SELECT id FROM users WHERE telegram_id = ?', [telegram_id], (err, user) => {
-            if (err || !user) {
-                return res.status(404).json({ error: 'User not found' });
-            }
+const MAX_TAPS_PER_BATCH = parseInt(process.env.MAX_TAPS_PER_BATCH) || 500;
 
-            // Update game progress
-            db.run(`
-                UPDATE game_progress 
-                SET coins = ?, energy = ?, max_energy = ?, coins_per_tap = ?, 
-                    energy_regen_rate = ?, total_earned = ?, total_taps = ?, 
-                    boosters = ?, last_save = CURRENT_TIMESTAMP
-                WHERE user_id = ?
-            `, [
-                coins, energy, max_energy, coins_per_tap,
-                energy_regen_rate, total_earned, total_taps,
-                JSON.stringify(boosters), user.id
-            ], function(err) {
-                if (err) {
-                    console.error('Save error:', err);
-                    return res.status(500).json({ error: 'Failed to save progress' });
-                }
+const boosterTypes = Object.keys(boosterTable);
+
+// Booster levels from the stored JSON; missing or corrupt values read as
+// level 0 instead of throwing inside a database callback
+function parseBoosters(text) {
+    const levels = Object.fromEntries(boosterTypes.map((type) => [type, 0]));
 
-                res.json({ success: true, saved_at: new Date().toISOString() });
+    try {
+        const stored = JSON.parse(text);
+        if (stored && typeof stored === 'object') {
+            boosterTypes.forEach((type) => {
+                if (Number.isInteger(stored[type])) {
+                    levels[type] = stored[type];
+                }
             });
-        });
+        }
+    } catch {
+        // Keep the defaults
+    }
+    return levels;
+}
+
+// Request bodies
+const tapsBody = jsonBody({
+    type: 'object',
+    properties: { taps: { type: 'integer', minimum: 1, maximum: MAX_TAPS_PER_BATCH } },
+    required: ['taps'],
+    additionalProperties: false
+}, { error: 'Invalid tap count' });
+
+const purchaseBody = jsonBody({
+    type: 'object',
+    properties: { booster_type: { type: 'string', enum: boosterTypes } },
+    required: ['booster_type'],
+    additionalProperties: false
+}, { error: 'Unknown booster type' });
+
+// Responses of the write routes, which are called most often
+const serializeTaps = compileSerializer({
+    type: 'object',
+    properties: { success: { type: 'boolean' }, accepted: { type: 'integer' } }
+});
+
+const serializePurchase = compileSerializer({
+    type: 'object',
+    properties: {
+        success: { type: 'boolean' },
+        new_coins: { type: 'integer' },
+        boosters: {
+            type: 'object',
+            properties: Object.fromEntries(boosterTypes.map((type) => [type, { type: 'integer' }]))
+        },
+        energy: { type: 'integer' },
+        max_energy: { type: 'integer' },
+        energy_regen_rate: { type: 'integer' },
+        coins_per_tap: { type: 'integer' },
+        version: { type: 'integer' }
+    }
+});
+
+// Per-user request budgets: sustained requests per second and burst size.
+// Purchases share one budget across cluster workers; taps are limited per
+// worker, since the energy check already caps what they can earn.
+const tapsLimit = userRateLimit({ perSecond: 5, burst: 20 });
+const purchaseLimit = userRateLimit({ perSecond: 1, burst: 5, shared: true, name: 'purchase' });
+
+// Submit a batch of taps; applied server-side on the next buffer flush
+router.post('/taps', requireAuth, tapsLimit, tapsBody, (req, res) => {
+    try {
+        const { taps } = req.body;
+
+        queueTaps(req.user.id, taps);
+        res.status(202).type('json').send(serializeTaps({ success: true, accepted: taps }));
     } catch (error) {
-        console.error('Save game error:', error);
+        console.error('Taps error:', error);
         res.status(500).json({ error: 'Server error' });
     }
 });
 
 // Load game progress
-router.get('/load/:telegram_id', (req, res) => {
+router.get('/load', requireAuth, (req, res) => {
     try {
-        const { telegram_id } = req.params;
-        const db = getDatabase();
-
-        db.get(`
-            SELECT gp.*, u.username, u.first_name 
-            FROM game_progress gp
-            JOIN users u ON gp.user_id = u.id
-            WHERE u.telegram_id = ?
-        `, [telegram_id], (err, progress) => {
+        statements.get('loadProgress', [req.user.id], (err, progress) => {
             if (err) {
                 return res.status(500).json({ error: 'Database error' });
             }
@@ -72,12 +103,7 @@ router.get('/load/:telegram_id', (req, res) => {
                 return res.status(404).json({ error: 'Progress not found' });
             }
 
-            // Parse boosters JSON
-            try {
-                progress.boosters = JSON.parse(progress.boosters);
-            } catch {
-                progress.boosters = { energyCapacity: 0, energyRegen: 0, coinsPerTap: 0 };
-            }
+            progress.boosters = parseBoosters(progress.boosters);
 
             res.json(progress);
         });
@@ -87,47 +113,80 @@ router.get('/load/:telegram_id', (req, res) => {
     }
 });
 
-// Purchase booster
-router.post('/purchase-booster', (req, res) => {
+// Get task progress and completions
+router.get('/tasks', requireAuth, (req, res) => {
     try {
-        const { telegram_id, booster_type, cost } = req.body;
-        const db = getDatabase();
+        const userId = req.user.id;
+
+        statements.get('progressByUserId', [userId], (err, progress) => {
+            if (err) {
+                return res.status(500).json({ error: 'Database error' });
+            }
+
+            if (!progress) {
+                return res.status(404).json({ error: 'Progress not found' });
+            }
+
+            statements.all('userTasks', [userId], (err, completed) => {
+                if (err) {
+                    return res.status(500).json({ error: 'Database error' });
+                }
+
+                const counters = {
+                    logins: 0,
+                    total_taps: progress.total_taps,
+                    friends: progress.friend_count,
+                    max_energy: progress.max_energy
+                };
+                res.json(describeTasks(counters, completed));
+            });
+        });
+    } catch (error) {
+        console.error('Tasks error:', error);
+        res.status(500).json({ error: 'Server error' });
+    }
+});
+
+// Purchase booster; the price is taken from the server's table, not the client
+router.post('/purchase-booster', requireAuth, purchaseLimit, purchaseBody, (req, res) => {
+    try {
+        const { booster_type } = req.body;
+        const userId = req.user.id;
+
+        statements.get(`purchaseBooster:${booster_type}`, [userId], (err, progress) => {
+            if (err) {
+                console.error('Purchase error:', err);
+                return res.status(500).json({ error: 'Purchase failed' });
+            }
 
-        db.get('SELECT id FROM users WHERE telegram_id = ?', [telegram_id], (err, user) => {
-            if (err || !user) {
-                return res.status(404).json({ error: 'User not found' });
+            if (progress) {
+                const { column } = boosterTable[booster_type];
+                evaluateTasks([{ userId, input: column, from: 0, to: progress[column] }]);
+
+                return res.type('json').send(serializePurchase({
+                    success: true,
+                    new_coins: progress.coins,
+                    boosters: parseBoosters(progress.boosters),
+                    energy: progress.energy,
+                    max_energy: progress.max_energy,
+                    energy_regen_rate: progress.energy_regen_rate,
+                    coins_per_tap: progress.coins_per_tap,
+                    version: progress.version
+                }));
             }
 
-            // Get current progress
-            db.get('SELECT * FROM game_progress WHERE user_id = ?', [user.id], (err, progress) => {
-                if (err || !progress) {
+            // Nothing was updated; read the row only to explain why
+            statements.get('progressForUpdate', [userId], (err, current) => {
+                if (err || !current) {
                     return res.status(404).json({ error: 'Progress not found' });
                 }
 
-                if (progress.coins < cost) {
-                    return res.status(400).json({ error: 'Insufficient coins' });
+                const level = parseBoosters(current.boosters)[booster_type];
+                if (level >= boosterTable[booster_type].costs.length) {
+                    return res.status(400).json({ error: 'Booster already at max level' });
                 }
 
-                const boosters = JSON.parse(progress.boosters);
-                boosters[booster_type] = (boosters[booster_type] || 0) + 1;
-
-                const newCoins = progress.coins - cost;
-
-                db.run(
-                    'UPDATE game_progress SET coins = ?, boosters = ? WHERE user_id = ?',
-                    [newCoins, JSON.stringify(boosters), user.id],
-                    function(err) {
-                        if (err) {
-                            return res.status(500).json({ error: 'Purchase failed' });
-                        }
-
-                        res.json({
-                            success: true,
-                            new_coins: newCoins,
-                            boosters: boosters
-                        });
-                    }
-                );
+                res.status(400).json({ error: 'Insufficient coins' });
             });
         });
     } catch (error) {
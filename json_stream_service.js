@@ -0,0 +1,56 @@
+
+// Write a large result as a chunked JSON array without holding it in
+// memory. `fetchNext(lastRow, callback)` returns the page after `lastRow`
+// (keyset paging); the next page is only fetched once the socket has
+// drained, and an empty page ends the array.
+function streamJsonArray(res, firstRows, fetchNext, transform = (row) => row) {
+    let first = true;
+    let closed = false;
+
+    res.on('close', () => {
+        closed = true;
+    });
+
+    const writeRows = (rows) => {
+        let body = '';
+        rows.forEach((row) => {
+            body += (first ? '' : ',') + JSON.stringify(transform(row));
+            first = false;
+        });
+        return res.write(body);
+    };
+
+    const pump = (rows) => {
+        if (closed) {
+            return;
+        }
+        if (rows.length === 0) {
+            return res.end(']');
+        }
+
+        const lastRow = rows[rows.length - 1];
+        const next = () => fetchNext(lastRow, (err, more) => {
+            if (err) {
+                // Headers are already sent; cut the response short
+                console.error('Stream error:', err);
+                return res.destroy(err);
+            }
+            pump(more);
+        });
+
+        if (writeRows(rows)) {
+            next();
+        } else {
+            res.once('drain', next);
+        }
+    };
+
+    res.status(200);
+    res.set('Content-Type', 'application/json; charset=utf-8');
+    res.write('[');
+    pump(firstRows);
+}
+
+module.exports = {
+    streamJsonArray
+};
@@ -1,48 +1,132 @@
 
 const express = require('express');
-const { getDatabase } = require('../database/init');
+const statements = require('../database/statements');
+const rankIndex = require('../services/rankIndex');
+const { useSnapshot } = require('../services/leaderboardSnapshot');
+const { cacheResponse, invalidateOn } = require('../middleware/cache');
 const router = express.Router();
 
-// Get top players
-router.get('/top/:limit?', (req, res) => {
+const CACHE_TTL = parseInt(process.env.LEADERBOARD_CACHE_TTL) || 5000;
+const MAX_PAGE_SIZE = parseInt(process.env.LEADERBOARD_MAX_PAGE_SIZE) || 100;
+const MAX_AROUND = Math.floor(MAX_PAGE_SIZE / 2); // keeps /around within one page
+
+// Snapshot refreshes and live score changes both reach every worker as
+// coordinator events
+if (useSnapshot()) {
+    invalidateOn('leaderboard:snapshot', 'leaderboard');
+} else {
+    invalidateOn('rank:scores', 'leaderboard');
+    invalidateOn('rank:player', 'leaderboard');
+}
+
+function encodeCursor(row) {
+    return Buffer.from(`${row.total_earned}:${row.user_id}`).toString('base64url');
+}
+
+function decodeCursor(cursor) {
+    const [totalEarned, userId] = Buffer.from(String(cursor), 'base64url').toString().split(':').map(Number);
+    if (!Number.isInteger(totalEarned) || !Number.isInteger(userId)) {
+        return null;
+    }
+    return { totalEarned, userId };
+}
+
+// Rows are fetched one past the page size to know whether another page
+// follows; the internal user_id only leaves the server inside the cursor
+function toPage(rows, limit) {
+    const players = rows.slice(0, limit).map(({ user_id, ...player }) => player);
+    return {
+        players,
+        next_cursor: rows.length > limit ? encodeCursor(rows[limit - 1]) : null
+    };
+}
+
+// Get top players, one page at a time: pass `after` from the previous
+// page's next_cursor to continue
+router.get('/top/:limit?', cacheResponse('leaderboard', CACHE_TTL), (req, res) => {
     try {
-        const limit = parseInt(req.params.limit) || 50;
-        const db = getDatabase();
-
-        db.all(`
-            SELECT 
-                telegram_id,
-                username,
-                first_name,
-                total_earned,
-                total_taps,
-                rank
-            FROM leaderboard
-            LIMIT ?
-        `, [limit], (err, results) => {
+        const limit = Math.min(Math.max(parseInt(req.params.limit) || 50, 1), MAX_PAGE_SIZE);
+        const after = req.query.after ? decodeCursor(req.query.after) : null;
+
+        if (req.query.after && !after) {
+            return res.status(400).json({ error: 'Invalid cursor' });
+        }
+
+        if (!useSnapshot() && rankIndex.isReady()) {
+            return res.json(toPage(rankIndex.getPage(after, limit + 1), limit));
+        }
+
+        const respond = (err, rows) => {
             if (err) {
                 return res.status(500).json({ error: 'Database error' });
             }
 
-            res.json(results);
-        });
+            res.json(toPage(rows, limit));
+        };
+
+        if (useSnapshot()) {
+            return after
+                ? statements.all('snapshotPage', [after.totalEarned, after.userId, limit + 1], respond)
+                : statements.all('snapshotTop', [limit + 1], respond);
+        }
+
+        // Only the first page is served live while the rank index loads
+        if (after) {
+            return res.status(503).json({ error: 'Leaderboard is loading' });
+        }
+        statements.all('leaderboardTop', [limit + 1], respond);
     } catch (error) {
         console.error('Leaderboard error:', error);
         res.status(500).json({ error: 'Server error' });
     }
 });
 
+// Get the players ranked just above and below a user
+router.get('/around/:telegram_id/:distance?', cacheResponse('leaderboard', CACHE_TTL), (req, res) => {
+    try {
+        const { telegram_id } = req.params;
+        const distance = Math.min(Math.max(parseInt(req.params.distance) || 5, 1), MAX_AROUND);
+
+        const respond = (err, rows) => {
+            if (err) {
+                return res.status(500).json({ error: 'Database error' });
+            }
+
+            if (!rows || rows.length === 0) {
+                return res.status(404).json({ error: 'User not found' });
+            }
+
+            res.json(rows.map(({ user_id, ...player }) => player));
+        };
+
+        if (useSnapshot()) {
+            return statements.all('snapshotAround', [telegram_id, distance], respond);
+        }
+
+        if (!rankIndex.isReady()) {
+            return res.status(503).json({ error: 'Leaderboard is loading' });
+        }
+        respond(null, rankIndex.getAround(telegram_id, distance));
+    } catch (error) {
+        console.error('Around error:', error);
+        res.status(500).json({ error: 'Server error' });
+    }
+});
+
 // Get user rank
-router.get('/rank/:telegram_id', (req, res) => {
+router.get('/rank/:telegram_id', cacheResponse('leaderboard', CACHE_TTL), (req, res) => {
     try {
         const { telegram_id } = req.params;
-        const db = getDatabase();
 
-        db.get(`
-            SELECT rank, total_earned, total_taps
-            FROM leaderboard
-            WHERE telegram_id = ?
-        `, [telegram_id], (err, result) => {
+        if (!useSnapshot() && rankIndex.isReady()) {
+            const result = rankIndex.getRank(telegram_id);
+            if (!result) {
+                return res.status(404).json({ error: 'User not found' });
+            }
+            return res.json(result);
+        }
+
+        statements.get(useSnapshot() ? 'snapshotRank' : 'leaderboardRank', [telegram_id], (err, result) => {
             if (err) {
                 return res.status(500).json({ error: 'Database error' });
             }
@@ -0,0 +1,93 @@
+
+const statements = require('../database/statements');
+const coordinator = require('../database/coordinator');
+
+// 'snapshot' serves /top and /rank from the materialized table; 'index'
+// serves them live from the in-memory rank index
+const SOURCE = process.env.LEADERBOARD_SOURCE === 'index' ? 'index' : 'snapshot';
+const SNAPSHOT_INTERVAL = parseInt(process.env.LEADERBOARD_SNAPSHOT_INTERVAL) || 60000;
+
+let snapshotTimer = null;
+let refreshing = false;
+
+function useSnapshot() {
+    return SOURCE === 'snapshot';
+}
+
+// Rebuild the inactive slot, then switch readers to it with a single-row
+// UPDATE. Readers see either the old or the new snapshot, never a mix.
+function refreshSnapshot(callback) {
+    const done = callback || (() => {});
+
+    if (refreshing) {
+        return done();
+    }
+    refreshing = true;
+
+    const fail = (err) => {
+        refreshing = false;
+        console.error('Leaderboard snapshot error:', err);
+        done(err);
+    };
+
+    statements.get('snapshotMeta', [], (err, meta) => {
+        if (err || !meta) {
+            return fail(err || new Error('Missing leaderboard_snapshot_meta row'));
+        }
+
+        const slot = meta.slot === 0 ? 1 : 0;
+
+        statements.run('clearSnapshotSlot', [slot], (err) => {
+            if (err) {
+                return fail(err);
+            }
+
+            statements.run('fillSnapshotSlot', [slot], function(err) {
+                if (err) {
+                    return fail(err);
+                }
+
+                const playerCount = this.changes;
+                const takenAt = Date.now();
+
+                statements.run('activateSnapshotSlot', [slot, takenAt, playerCount], (err) => {
+                    if (err) {
+                        return fail(err);
+                    }
+
+                    refreshing = false;
+                    coordinator.publish('leaderboard:snapshot', { takenAt, playerCount });
+                    done(null);
+                });
+            });
+        });
+    });
+}
+
+// Runs on the process that owns the writer. The first refresh happens
+// straight away unless the stored snapshot is still within the interval.
+function startSnapshotJob() {
+    if (!useSnapshot() || snapshotTimer) {
+        return;
+    }
+
+    snapshotTimer = setInterval(refreshSnapshot, SNAPSHOT_INTERVAL);
+
+    statements.get('snapshotMeta', [], (err, meta) => {
+        if (err || !meta || !meta.taken_at || Date.now() - meta.taken_at >= SNAPSHOT_INTERVAL) {
+            refreshSnapshot();
+        }
+    });
+}
+
+function stopSnapshotJob() {
+    clearInterval(snapshotTimer);
+    snapshotTimer = null;
+}
+
+module.exports = {
+    useSnapshot,
+    refreshSnapshot,
+    startSnapshotJob,
+    stopSnapshotJob
+};
@@ -0,0 +1,163 @@
+
+const { monitorEventLoopDelay } = require('perf_hooks');
+const coordinator = require('../database/coordinator');
+
+// In-process metrics in Prometheus text format. In cluster mode every
+// process keeps its own and series carry the pid; a worker's /metrics
+// adds the coordinator's series to its own.
+
+const BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5]; // seconds
+
+const requestDurations = new Map();
+const requestCounts = new Map();
+const statementDurations = new Map();
+let pendingQueries = 0;
+
+const eventLoopDelay = monitorEventLoopDelay({ resolution: 20 });
+eventLoopDelay.enable();
+
+function observe(histograms, labels, seconds) {
+    let histogram = histograms.get(labels);
+    if (!histogram) {
+        histogram = { counts: new Array(BUCKETS.length).fill(0), sum: 0, count: 0 };
+        histograms.set(labels, histogram);
+    }
+
+    for (let i = 0; i < BUCKETS.length; i++) {
+        if (seconds <= BUCKETS[i]) {
+            histogram.counts[i]++;
+            break;
+        }
+    }
+    histogram.sum += seconds;
+    histogram.count++;
+}
+
+function label(value) {
+    return String(value).replace(/\\/g, '\\\\').replace(/"/g, '\\"');
+}
+
+// Record every request against its route pattern, not its raw URL
+function requestMetrics(req, res, next) {
+    const started = process.hrtime.bigint();
+
+    res.on('finish', () => {
+        const route = req.route ? req.baseUrl + req.route.path : 'unmatched';
+        const seconds = Number(process.hrtime.bigint() - started) / 1e9;
+        const labels = `route="${label(route)}",method="${req.method}"`;
+
+        observe(requestDurations, labels, seconds);
+
+        const countLabels = `${labels},status="${res.statusCode}"`;
+        requestCounts.set(countLabels, (requestCounts.get(countLabels) || 0) + 1);
+    });
+
+    next();
+}
+
+// Time one database call; the returned function ends it
+function startQuery(name) {
+    const started = process.hrtime.bigint();
+    pendingQueries++;
+
+    return () => {
+        pendingQueries--;
+        observe(statementDurations, `statement="${label(name)}"`, Number(process.hrtime.bigint() - started) / 1e9);
+    };
+}
+
+function histogramSamples(name, histograms) {
+    const samples = [];
+
+    histograms.forEach((histogram, labels) => {
+        let cumulative = 0;
+        BUCKETS.forEach((bound, i) => {
+            cumulative += histogram.counts[i];
+            samples.push(`${name}_bucket{${labels},pid="${process.pid}",le="${bound}"} ${cumulative}`);
+        });
+        samples.push(`${name}_bucket{${labels},pid="${process.pid}",le="+Inf"} ${histogram.count}`);
+        samples.push(`${name}_sum{${labels},pid="${process.pid}"} ${histogram.sum}`);
+        samples.push(`${name}_count{${labels},pid="${process.pid}"} ${histogram.count}`);
+    });
+    return samples;
+}
+
+// This process's metric families as { name, help, type, samples }; plain
+// data, so the coordinator can send its own to a worker
+function collectFamilies() {
+    const pid = `pid="${process.pid}"`;
+    const families = [];
+    const family = (name, type, help, samples) => families.push({ name, type, help, samples });
+
+    family('http_request_duration_seconds', 'histogram', 'HTTP request latency by route',
+        histogramSamples('http_request_duration_seconds', requestDurations));
+
+    const counts = [];
+    requestCounts.forEach((count, labels) => counts.push(`http_requests_total{${labels},${pid}} ${count}`));
+    family('http_requests_total', 'counter', 'HTTP requests by route and status', counts);
+
+    family('sqlite_statement_duration_seconds', 'histogram', 'SQLite statement latency by statement name',
+        histogramSamples('sqlite_statement_duration_seconds', statementDurations));
+
+    family('sqlite_pending_queries', 'gauge', 'Database calls waiting for their callback',
+        [`sqlite_pending_queries{${pid}} ${pendingQueries}`]);
+
+    // Event loop delay since the previous scrape
+    family('nodejs_eventloop_lag_seconds', 'gauge', 'Event loop delay since the last scrape', [
+        ...[50, 99].map((percentile) =>
+            `nodejs_eventloop_lag_seconds{quantile="0.${percentile}",${pid}} ${eventLoopDelay.percentile(percentile) / 1e9}`),
+        `nodejs_eventloop_lag_seconds{quantile="1",${pid}} ${eventLoopDelay.max / 1e9}`
+    ]);
+    eventLoopDelay.reset();
+
+    family('process_resident_memory_bytes', 'gauge', 'Resident set size',
+        [`process_resident_memory_bytes{${pid}} ${process.memoryUsage().rss}`]);
+
+    return families;
+}
+
+// The writer's statements, background jobs and queue depth live on the
+// coordinator, which serves no HTTP
+coordinator.handle('metrics', (payload, reply) => reply(null, collectFamilies()));
+
+// Merge families by name so each gets a single HELP and TYPE line
+function render(families) {
+    const merged = new Map();
+    families.forEach((family) => {
+        const existing = merged.get(family.name);
+        if (existing) {
+            existing.samples.push(...family.samples);
+        } else {
+            merged.set(family.name, { ...family, samples: [...family.samples] });
+        }
+    });
+
+    const lines = [];
+    merged.forEach(({ name, type, help, samples }) => {
+        lines.push(`# HELP ${name} ${help}`, `# TYPE ${name} ${type}`, ...samples);
+    });
+    return lines.join('\n') + '\n';
+}
+
+// Calls back with the Prometheus text for this process and, on a cluster
+// worker, the coordinator's series too
+function renderMetrics(callback) {
+    const families = collectFamilies();
+
+    if (!coordinator.isWorker()) {
+        return callback(render(families));
+    }
+
+    coordinator.request('metrics', null, (err, coordinatorFamilies) => {
+        if (err) {
+            console.error('Coordinator metrics error:', err);
+        }
+        callback(render(err ? families : families.concat(coordinatorFamilies)));
+    });
+}
+
+module.exports = {
+    requestMetrics,
+    startQuery,
+    renderMetrics
+};
@@ -0,0 +1,502 @@
+
+const sqlite3 = require('sqlite3').verbose();
+const path = require('path');
+
+// Link a referred player (and anyone they referred) under a referrer and
+// all of the referrer's ancestors. A player keeps their first referrer,
+// and a link that would make someone their own ancestor is skipped. With
+// `maxDepth`, pairs more than that many levels apart are not stored; the
+// stored pairs then no longer show every ancestor, so `walkReferrers`
+// checks for a cycle by following the referrer's depth-1 links instead.
+function attachReferralSql(referrer, referred, { maxDepth, walkReferrers } = {}) {
+    const depthLimit = maxDepth ? `\n                    AND a.depth + d.depth + 1 <= ${maxDepth}` : '';
+    const cycleGuard = walkReferrers
+        ? `AND NOT EXISTS (
+                        WITH RECURSIVE referrers(id) AS (
+                            SELECT ${referrer}
+                            UNION
+                            SELECT t.ancestor_id FROM referral_tree t, referrers
+                            WHERE t.descendant_id = referrers.id AND t.depth = 1
+                        )
+                        SELECT 1 FROM referrers WHERE id = ${referred}
+                    )`
+        : `AND NOT EXISTS (
+                        SELECT 1 FROM referral_tree WHERE ancestor_id = ${referred} AND descendant_id = ${referrer}
+                    )`;
+    return `INSERT INTO referral_tree (ancestor_id, descendant_id, depth)
+                SELECT a.ancestor_id, d.descendant_id, a.depth + d.depth + 1
+                FROM (
+                    SELECT ${referrer} AS ancestor_id, 0 AS depth
+                    UNION ALL
+                    SELECT ancestor_id, depth FROM referral_tree WHERE descendant_id = ${referrer}
+                ) a, (
+                    SELECT ${referred} AS descendant_id, 0 AS depth
+                    UNION ALL
+                    SELECT descendant_id, depth FROM referral_tree WHERE ancestor_id = ${referred}
+                ) d
+                WHERE ${referrer} != ${referred}
+                    AND NOT EXISTS (SELECT 1 FROM referral_tree WHERE descendant_id = ${referred} AND depth = 1)
+                    ${cycleGuard}${depthLimit}`;
+}
+
+// Deepest level /friends/referrals can ask for (MAX_REFERRAL_DEPTH there)
+const MAX_REFERRAL_DEPTH = 10;
+
+// Ordered schema changes. Never edit a migration once it has shipped;
+// append a new version instead.
+const migrations = [
+    {
+        version: 1,
+        name: 'initial_schema',
+        statements: [
+            `CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                telegram_id TEXT UNIQUE NOT NULL,
+                username TEXT,
+                first_name TEXT,
+                last_name TEXT,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                last_active DATETIME DEFAULT CURRENT_TIMESTAMP
+            )`,
+            `CREATE TABLE IF NOT EXISTS game_progress (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                coins INTEGER DEFAULT 0,
+                energy INTEGER DEFAULT 100,
+                max_energy INTEGER DEFAULT 100,
+                coins_per_tap INTEGER DEFAULT 1,
+                energy_regen_rate INTEGER DEFAULT 1800000,
+                total_earned INTEGER DEFAULT 0,
+                total_taps INTEGER DEFAULT 0,
+                last_save DATETIME DEFAULT CURRENT_TIMESTAMP,
+                boosters TEXT DEFAULT '{"energyCapacity":0,"energyRegen":0,"coinsPerTap":0}',
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )`,
+            `CREATE TABLE IF NOT EXISTS friends (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                friend_id INTEGER NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                bonus_claimed BOOLEAN DEFAULT FALSE,
+                FOREIGN KEY (user_id) REFERENCES users (id),
+                FOREIGN KEY (friend_id) REFERENCES users (id),
+                UNIQUE(user_id, friend_id)
+            )`,
+            `CREATE TABLE IF NOT EXISTS user_tasks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                task_id TEXT NOT NULL,
+                completed BOOLEAN DEFAULT FALSE,
+                progress INTEGER DEFAULT 0,
+                completed_at DATETIME,
+                FOREIGN KEY (user_id) REFERENCES users (id),
+                UNIQUE(user_id, task_id)
+            )`,
+            `CREATE VIEW IF NOT EXISTS leaderboard AS
+            SELECT
+                u.telegram_id,
+                u.username,
+                u.first_name,
+                gp.total_earned,
+                gp.total_taps,
+                RANK() OVER (ORDER BY gp.total_earned DESC) as rank
+            FROM users u
+            JOIN game_progress gp ON u.id = gp.user_id
+            ORDER BY gp.total_earned DESC`
+        ]
+    },
+    {
+        version: 2,
+        name: 'hot_path_indexes',
+        statements: [
+            // Keep the oldest progress row per user before enforcing uniqueness
+            `DELETE FROM game_progress
+            WHERE id NOT IN (SELECT MIN(id) FROM game_progress GROUP BY user_id)`,
+            `CREATE UNIQUE INDEX IF NOT EXISTS idx_game_progress_user_id
+            ON game_progress (user_id)`,
+            // Covers the leaderboard ordering without touching the table rows
+            `CREATE INDEX IF NOT EXISTS idx_game_progress_total_earned
+            ON game_progress (total_earned DESC, user_id, total_taps)`,
+            // friends(user_id) is already covered by UNIQUE(user_id, friend_id)
+            `CREATE INDEX IF NOT EXISTS idx_friends_friend_id
+            ON friends (friend_id, user_id)`
+        ]
+    },
+    {
+        version: 3,
+        name: 'progress_version',
+        statements: [
+            // Bumped by every write to the row; /save compares and sets it
+            `ALTER TABLE game_progress ADD COLUMN version INTEGER NOT NULL DEFAULT 0`
+        ]
+    },
+    {
+        version: 4,
+        name: 'energy_clock',
+        statements: [
+            // Unix time in ms that the stored energy value is current as of
+            `ALTER TABLE game_progress ADD COLUMN energy_updated_at INTEGER NOT NULL DEFAULT 0`,
+            `UPDATE game_progress
+            SET energy_updated_at = CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER)`
+        ]
+    },
+    {
+        version: 5,
+        name: 'leaderboard_snapshot',
+        statements: [
+            // Two slots: the job refills the inactive one, then points
+            // leaderboard_snapshot_meta.slot at it
+            `CREATE TABLE leaderboard_snapshot (
+                slot INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                rank INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                telegram_id TEXT NOT NULL,
+                username TEXT,
+                first_name TEXT,
+                total_earned INTEGER NOT NULL,
+                total_taps INTEGER NOT NULL,
+                PRIMARY KEY (slot, position)
+            ) WITHOUT ROWID`,
+            `CREATE UNIQUE INDEX idx_leaderboard_snapshot_telegram_id
+            ON leaderboard_snapshot (slot, telegram_id)`,
+            `CREATE TABLE leaderboard_snapshot_meta (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                slot INTEGER NOT NULL,
+                taken_at INTEGER,
+                player_count INTEGER NOT NULL DEFAULT 0
+            )`,
+            `INSERT INTO leaderboard_snapshot_meta (id, slot) VALUES (1, 0)`
+        ]
+    },
+    {
+        version: 6,
+        name: 'leaderboard_keyset',
+        statements: [
+            // Seek target for (total_earned, user_id) page cursors
+            `CREATE INDEX idx_leaderboard_snapshot_score
+            ON leaderboard_snapshot (slot, total_earned DESC, user_id)`
+        ]
+    },
+    {
+        version: 7,
+        name: 'referral_bonus_trigger',
+        statements: [
+            // Credit both players inside the INSERT's own transaction; an
+            // ignored duplicate inserts nothing and credits nothing
+            `CREATE TRIGGER friends_referral_bonus AFTER INSERT ON friends
+            BEGIN
+                UPDATE game_progress
+                SET coins = coins + 500, version = version + 1
+                WHERE user_id IN (NEW.user_id, NEW.friend_id);
+                UPDATE friends SET bonus_claimed = TRUE WHERE id = NEW.id;
+            END`
+        ]
+    },
+    {
+        version: 8,
+        name: 'task_rewards',
+        statements: [
+            // Reward paid for the completion, credited by the triggers below
+            `ALTER TABLE user_tasks ADD COLUMN reward INTEGER NOT NULL DEFAULT 0`,
+            `CREATE TRIGGER user_tasks_reward AFTER INSERT ON user_tasks
+            WHEN NEW.completed
+            BEGIN
+                UPDATE game_progress
+                SET coins = coins + NEW.reward,
+                    total_earned = total_earned + NEW.reward,
+                    version = version + 1
+                WHERE user_id = NEW.user_id;
+            END`,
+            // Daily tasks are completed again by moving completed_at forward
+            `CREATE TRIGGER user_tasks_repeat_reward AFTER UPDATE OF completed_at ON user_tasks
+            WHEN NEW.completed
+            BEGIN
+                UPDATE game_progress
+                SET coins = coins + NEW.reward,
+                    total_earned = total_earned + NEW.reward,
+                    version = version + 1
+                WHERE user_id = NEW.user_id;
+            END`
+        ]
+    },
+    {
+        version: 9,
+        name: 'login_upsert',
+        statements: [
+            // Every player gets their progress row in the INSERT's own
+            // transaction, so login is a single statement
+            `INSERT INTO game_progress (user_id, energy_updated_at)
+            SELECT id, CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER)
+            FROM users
+            WHERE id NOT IN (SELECT user_id FROM game_progress)`,
+            `CREATE TRIGGER users_create_progress AFTER INSERT ON users
+            BEGIN
+                INSERT INTO game_progress (user_id, energy_updated_at)
+                VALUES (NEW.id, CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER))
+                ON CONFLICT (user_id) DO NOTHING;
+            END`
+        ]
+    },
+    {
+        version: 10,
+        name: 'cold_storage',
+        statements: [
+            // Players inactive for a while are moved here by the archive
+            // job, keeping their ids, and moved back when they log in
+            `CREATE TABLE users_archive (
+                id INTEGER PRIMARY KEY,
+                telegram_id TEXT UNIQUE NOT NULL,
+                username TEXT,
+                first_name TEXT,
+                last_name TEXT,
+                created_at DATETIME,
+                last_active DATETIME,
+                archived_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )`,
+            `CREATE TABLE game_progress_archive (
+                user_id INTEGER PRIMARY KEY,
+                id INTEGER NOT NULL,
+                coins INTEGER,
+                energy INTEGER,
+                max_energy INTEGER,
+                coins_per_tap INTEGER,
+                energy_regen_rate INTEGER,
+                total_earned INTEGER,
+                total_taps INTEGER,
+                last_save DATETIME,
+                boosters TEXT,
+                version INTEGER NOT NULL,
+                energy_updated_at INTEGER NOT NULL
+            )`,
+            `CREATE INDEX idx_users_last_active ON users (last_active, id)`,
+            // Re-inserting an archived id brings its progress back before
+            // the row lands, so the login's RETURNING already sees it
+            `CREATE TRIGGER users_restore_progress BEFORE INSERT ON users
+            WHEN NEW.id IN (SELECT user_id FROM game_progress_archive)
+            BEGIN
+                INSERT INTO game_progress (id, user_id, coins, energy, max_energy, coins_per_tap, energy_regen_rate,
+                    total_earned, total_taps, last_save, boosters, version, energy_updated_at)
+                SELECT id, user_id, coins, energy, max_energy, coins_per_tap, energy_regen_rate,
+                    total_earned, total_taps, last_save, boosters, version, energy_updated_at
+                FROM game_progress_archive
+                WHERE user_id = NEW.id;
+                DELETE FROM game_progress_archive WHERE user_id = NEW.id;
+            END`,
+            // Runs after RETURNING, which reports the restore by finding
+            // the archived row still present
+            `CREATE TRIGGER users_restore_cleanup AFTER INSERT ON users
+            BEGIN
+                DELETE FROM users_archive WHERE id = NEW.id;
+            END`
+        ]
+    },
+    {
+        version: 11,
+        name: 'referral_tree',
+        statements: [
+            // Friends the player has added, kept by friends_referral_bonus
+            `ALTER TABLE game_progress ADD COLUMN friend_count INTEGER NOT NULL DEFAULT 0`,
+            `ALTER TABLE game_progress_archive ADD COLUMN friend_count INTEGER NOT NULL DEFAULT 0`,
+            `UPDATE game_progress
+            SET friend_count = (SELECT COUNT(*) FROM friends WHERE friends.user_id = game_progress.user_id)`,
+            `UPDATE game_progress_archive
+            SET friend_count = (SELECT COUNT(*) FROM friends WHERE friends.user_id = game_progress_archive.user_id)`,
+            `DROP TRIGGER friends_referral_bonus`,
+            `CREATE TRIGGER friends_referral_bonus AFTER INSERT ON friends
+            BEGIN
+                UPDATE game_progress
+                SET coins = coins + 500,
+                    friend_count = friend_count + (user_id = NEW.user_id),
+                    version = version + 1
+                WHERE user_id IN (NEW.user_id, NEW.friend_id);
+                UPDATE friends SET bonus_claimed = TRUE WHERE id = NEW.id;
+            END`,
+            `DROP TRIGGER users_restore_progress`,
+            `CREATE TRIGGER users_restore_progress BEFORE INSERT ON users
+            WHEN NEW.id IN (SELECT user_id FROM game_progress_archive)
+            BEGIN
+                INSERT INTO game_progress (id, user_id, coins, energy, max_energy, coins_per_tap, energy_regen_rate,
+                    total_earned, total_taps, last_save, boosters, version, energy_updated_at, friend_count)
+                SELECT id, user_id, coins, energy, max_energy, coins_per_tap, energy_regen_rate,
+                    total_earned, total_taps, last_save, boosters, version, energy_updated_at, friend_count
+                FROM game_progress_archive
+                WHERE user_id = NEW.id;
+                DELETE FROM game_progress_archive WHERE user_id = NEW.id;
+            END`,
+            // Every (ancestor, descendant) pair of the referral tree with
+            // the number of levels between them; depth 1 is the referrer.
+            // Keyed for ranges over one player's descendants by level.
+            `CREATE TABLE referral_tree (
+                ancestor_id INTEGER NOT NULL,
+                descendant_id INTEGER NOT NULL,
+                depth INTEGER NOT NULL,
+                PRIMARY KEY (ancestor_id, depth, descendant_id)
+            ) WITHOUT ROWID`,
+            `CREATE INDEX idx_referral_tree_descendant
+            ON referral_tree (descendant_id, depth, ancestor_id)`,
+            // Rebuild the tree by replaying existing friendships in the
+            // order they were made, through the same rule as the trigger
+            `CREATE TABLE referral_replay (user_id INTEGER NOT NULL, friend_id INTEGER NOT NULL)`,
+            `CREATE TRIGGER referral_replay_attach AFTER INSERT ON referral_replay
+            BEGIN
+                ${attachReferralSql('NEW.user_id', 'NEW.friend_id')};
+            END`,
+            `INSERT INTO referral_replay (user_id, friend_id) SELECT user_id, friend_id FROM friends ORDER BY id`,
+            `DROP TABLE referral_replay`,
+            `CREATE TRIGGER friends_referral_tree AFTER INSERT ON friends
+            BEGIN
+                ${attachReferralSql('NEW.user_id', 'NEW.friend_id')};
+            END`
+        ]
+    },
+    {
+        version: 12,
+        name: 'normalize_boosters',
+        statements: [
+            // Early saves could store NULL, and json_set(NULL, ...) is NULL,
+            // so purchases on those rows charged without levelling up
+            `UPDATE game_progress
+            SET boosters = '{"energyCapacity":0,"energyRegen":0,"coinsPerTap":0}'
+            WHERE boosters IS NULL OR NOT json_valid(boosters)`,
+            `UPDATE game_progress_archive
+            SET boosters = '{"energyCapacity":0,"energyRegen":0,"coinsPerTap":0}'
+            WHERE boosters IS NULL OR NOT json_valid(boosters)`
+        ]
+    },
+    {
+        version: 13,
+        name: 'referral_tree_depth_limit',
+        statements: [
+            // Deeper pairs are never queried, and storing them made a long
+            // referral chain grow the table quadratically
+            `DROP TRIGGER friends_referral_tree`,
+            `CREATE TRIGGER friends_referral_tree AFTER INSERT ON friends
+            BEGIN
+                ${attachReferralSql('NEW.user_id', 'NEW.friend_id', { maxDepth: MAX_REFERRAL_DEPTH })};
+            END`,
+            `DELETE FROM referral_tree WHERE depth > ${MAX_REFERRAL_DEPTH}`
+        ]
+    },
+    {
+        version: 14,
+        name: 'archive_moves',
+        statements: [
+            // Inserting a player here moves them to the archive tables in
+            // the same statement, so the archive job's batch is picked once
+            // and moved completely without an explicit transaction
+            `CREATE TABLE archive_moves (
+                user_id INTEGER PRIMARY KEY,
+                telegram_id TEXT NOT NULL
+            )`,
+            `CREATE TRIGGER archive_moves_apply AFTER INSERT ON archive_moves
+            BEGIN
+                INSERT INTO users_archive (id, telegram_id, username, first_name, last_name, created_at, last_active)
+                SELECT id, telegram_id, username, first_name, last_name, created_at, last_active
+                FROM users
+                WHERE id = NEW.user_id;
+                INSERT INTO game_progress_archive (id, user_id, coins, energy, max_energy, coins_per_tap, energy_regen_rate,
+                    total_earned, total_taps, last_save, boosters, version, energy_updated_at, friend_count)
+                SELECT id, user_id, coins, energy, max_energy, coins_per_tap, energy_regen_rate,
+                    total_earned, total_taps, last_save, boosters, version, energy_updated_at, friend_count
+                FROM game_progress
+                WHERE user_id = NEW.user_id;
+                DELETE FROM game_progress WHERE user_id = NEW.user_id;
+                DELETE FROM users WHERE id = NEW.user_id;
+                DELETE FROM archive_moves WHERE user_id = NEW.user_id;
+            END`
+        ]
+    },
+    {
+        version: 15,
+        name: 'referral_cycle_guard',
+        statements: [
+            // Migration 13's trigger looked for the referrer among the
+            // referred player's stored descendants, which misses cycles
+            // longer than the depth limit
+            `DROP TRIGGER friends_referral_tree`,
+            `CREATE TRIGGER friends_referral_tree AFTER INSERT ON friends
+            BEGIN
+                ${attachReferralSql('NEW.user_id', 'NEW.friend_id', { maxDepth: MAX_REFERRAL_DEPTH, walkReferrers: true })};
+            END`
+        ]
+    }
+];
+
+function applyMigration(db, migration, callback) {
+    const script = [
+        'BEGIN',
+        ...migration.statements,
+        `INSERT INTO schema_migrations (version, name) VALUES (${migration.version}, '${migration.name}')`,
+        'COMMIT'
+    ].join(';\n');
+
+    db.exec(script, (err) => {
+        if (err) {
+            return db.exec('ROLLBACK', () => callback(err));
+        }
+
+        console.log(`Applied migration ${migration.version} (${migration.name})`);
+        callback(null);
+    });
+}
+
+// Apply every migration not yet recorded in schema_migrations, in order.
+// Safe to call on every startup.
+function runMigrations(db, callback) {
+    db.run(`
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    `, (err) => {
+        if (err) {
+            return callback(err);
+        }
+
+        db.all('SELECT version FROM schema_migrations', [], (err, rows) => {
+            if (err) {
+                return callback(err);
+            }
+
+            const applied = new Set(rows.map((row) => row.version));
+            const pending = migrations.filter((migration) => !applied.has(migration.version));
+
+            const next = (index) => {
+                if (index >= pending.length) {
+                    return callback(null);
+                }
+
+                applyMigration(db, pending[index], (err) => {
+                    if (err) {
+                        console.error(`Migration ${pending[index].version} failed:`, err.message);
+                        return callback(err);
+                    }
+                    next(index + 1);
+                });
+            };
+
+            next(0);
+        });
+    });
+}
+
+// npm run migrate
+if (require.main === module) {
+    require('dotenv').config();
+    const dbPath = process.env.DATABASE_PATH || path.join(__dirname, '../nzi_coin.db');
+    const db = new sqlite3.Database(dbPath);
+
+    runMigrations(db, (err) => {
+        if (err) {
+            process.exitCode = 1;
+        }
+        db.close();
+    });
+}
+
+module.exports = {
+    migrations,
+    runMigrations
+};
@@ -0,0 +1,353 @@
+
+const statements = require('../database/statements');
+const coordinator = require('../database/coordinator');
+const { useSnapshot } = require('./leaderboardSnapshot');
+
+const MAX_LEVEL = 32;
+const LEVEL_PROBABILITY = 0.25;
+
+// Indexable skip list ordered by total_earned descending, ties by user id.
+// Every forward pointer stores its span so positions resolve in O(log n).
+const head = createNode(null, MAX_LEVEL);
+const byUserId = new Map();
+const byTelegramId = new Map();
+let level = 1;
+let length = 0;
+let ready = false;
+
+function createNode(player, nodeLevel) {
+    return {
+        player,
+        next: new Array(nodeLevel).fill(null),
+        span: new Array(nodeLevel).fill(0)
+    };
+}
+
+function randomLevel() {
+    let nodeLevel = 1;
+    while (nodeLevel < MAX_LEVEL && Math.random() < LEVEL_PROBABILITY) {
+        nodeLevel++;
+    }
+    return nodeLevel;
+}
+
+function precedes(node, totalEarned, userId) {
+    const player = node.player;
+    return player.totalEarned > totalEarned ||
+        (player.totalEarned === totalEarned && player.userId < userId);
+}
+
+function atOrBefore(node, totalEarned, userId) {
+    const player = node.player;
+    return player.totalEarned > totalEarned ||
+        (player.totalEarned === totalEarned && player.userId <= userId);
+}
+
+function insertNode(player) {
+    const update = new Array(MAX_LEVEL);
+    const position = new Array(MAX_LEVEL);
+    let x = head;
+
+    for (let i = level - 1; i >= 0; i--) {
+        position[i] = i === level - 1 ? 0 : position[i + 1];
+        while (x.next[i] && precedes(x.next[i], player.totalEarned, player.userId)) {
+            position[i] += x.span[i];
+            x = x.next[i];
+        }
+        update[i] = x;
+    }
+
+    const nodeLevel = randomLevel();
+    if (nodeLevel > level) {
+        for (let i = level; i < nodeLevel; i++) {
+            position[i] = 0;
+            update[i] = head;
+            head.span[i] = length;
+        }
+        level = nodeLevel;
+    }
+
+    const node = createNode(player, nodeLevel);
+    for (let i = 0; i < nodeLevel; i++) {
+        node.next[i] = update[i].next[i];
+        update[i].next[i] = node;
+        node.span[i] = update[i].span[i] - (position[0] - position[i]);
+        update[i].span[i] = position[0] - position[i] + 1;
+    }
+    for (let i = nodeLevel; i < level; i++) {
+        update[i].span[i]++;
+    }
+
+    length++;
+    return node;
+}
+
+function removeNode(node) {
+    const update = new Array(MAX_LEVEL);
+    const { totalEarned, userId } = node.player;
+    let x = head;
+
+    for (let i = level - 1; i >= 0; i--) {
+        while (x.next[i] && precedes(x.next[i], totalEarned, userId)) {
+            x = x.next[i];
+        }
+        update[i] = x;
+    }
+
+    for (let i = 0; i < level; i++) {
+        if (update[i].next[i] === node) {
+            update[i].span[i] += node.span[i] - 1;
+            update[i].next[i] = node.next[i];
+        } else {
+            update[i].span[i]--;
+        }
+    }
+
+    while (level > 1 && !head.next[level - 1]) {
+        level--;
+    }
+    length--;
+}
+
+// Competition rank (same as SQL RANK()): 1 + players with a higher score
+function rankOfScore(totalEarned) {
+    let x = head;
+    let ahead = 0;
+
+    for (let i = level - 1; i >= 0; i--) {
+        while (x.next[i] && x.next[i].player.totalEarned > totalEarned) {
+            ahead += x.span[i];
+            x = x.next[i];
+        }
+    }
+    return ahead + 1;
+}
+
+function applyPlayer(player) {
+    const existing = byUserId.get(player.userId);
+
+    if (existing) {
+        if (player.username !== undefined) existing.player.username = player.username;
+        if (player.firstName !== undefined) existing.player.firstName = player.firstName;
+        applyScore(player.userId, player.totalEarned, player.totalTaps);
+        return;
+    }
+
+    const node = insertNode({
+        userId: player.userId,
+        telegramId: String(player.telegramId),
+        username: player.username || null,
+        firstName: player.firstName || null,
+        totalEarned: player.totalEarned || 0,
+        totalTaps: player.totalTaps || 0
+    });
+    byUserId.set(node.player.userId, node);
+    byTelegramId.set(node.player.telegramId, node);
+}
+
+function applyRemoval(userId) {
+    const node = byUserId.get(userId);
+    if (!node) {
+        return;
+    }
+
+    removeNode(node);
+    byUserId.delete(userId);
+    byTelegramId.delete(node.player.telegramId);
+}
+
+// Record a score change; only re-links the node when total_earned moves
+function applyScore(userId, totalEarned, totalTaps) {
+    const node = byUserId.get(userId);
+    if (!node) {
+        return;
+    }
+
+    const player = node.player;
+    if (totalTaps !== undefined) {
+        player.totalTaps = totalTaps;
+    }
+    if (totalEarned === undefined || totalEarned === player.totalEarned) {
+        return;
+    }
+
+    removeNode(node);
+    player.totalEarned = totalEarned;
+
+    const moved = insertNode(player);
+    byUserId.set(userId, moved);
+    byTelegramId.set(player.telegramId, moved);
+}
+
+// Mutations are published so every cluster worker's index stays in step.
+// In snapshot mode the index is never loaded or read, so nothing is sent.
+function upsertPlayer(player) {
+    if (!useSnapshot()) {
+        coordinator.publish('rank:player', player);
+    }
+}
+
+function updateScores(updates) {
+    if (!useSnapshot()) {
+        coordinator.publish('rank:scores', updates);
+    }
+}
+
+function updateScore(userId, totalEarned, totalTaps) {
+    updateScores([{ userId, totalEarned, totalTaps }]);
+}
+
+function removePlayers(userIds) {
+    if (!useSnapshot()) {
+        coordinator.publish('rank:remove', userIds);
+    }
+}
+
+if (!useSnapshot()) {
+    coordinator.subscribe('rank:player', applyPlayer);
+    coordinator.subscribe('rank:scores', (updates) => {
+        updates.forEach((update) => applyScore(update.userId, update.totalEarned, update.totalTaps));
+    });
+    coordinator.subscribe('rank:remove', (userIds) => userIds.forEach(applyRemoval));
+}
+
+// 1-based position of the last player at or before (totalEarned, userId)
+function positionOf(totalEarned, userId) {
+    let x = head;
+    let position = 0;
+
+    for (let i = level - 1; i >= 0; i--) {
+        while (x.next[i] && atOrBefore(x.next[i], totalEarned, userId)) {
+            position += x.span[i];
+            x = x.next[i];
+        }
+    }
+    return { node: x, position };
+}
+
+function nodeAtPosition(position) {
+    let x = head;
+    let traversed = 0;
+
+    for (let i = level - 1; i >= 0; i--) {
+        while (x.next[i] && traversed + x.span[i] <= position) {
+            traversed += x.span[i];
+            x = x.next[i];
+        }
+        if (traversed === position) {
+            return x;
+        }
+    }
+    return null;
+}
+
+function toRow(player, rank) {
+    return {
+        user_id: player.userId,
+        telegram_id: player.telegramId,
+        username: player.username,
+        first_name: player.firstName,
+        total_earned: player.totalEarned,
+        total_taps: player.totalTaps,
+        rank
+    };
+}
+
+// Up to `count` rows starting at `node`, which sits at `position`
+function collectRows(node, position, count) {
+    const rows = [];
+    let rank = node ? rankOfScore(node.player.totalEarned) : 0;
+    let previousScore = node ? node.player.totalEarned : null;
+
+    while (node && rows.length < count) {
+        if (node.player.totalEarned !== previousScore) {
+            rank = position + rows.length;
+            previousScore = node.player.totalEarned;
+        }
+        rows.push(toRow(node.player, rank));
+        node = node.next[0];
+    }
+    return rows;
+}
+
+function getTop(limit) {
+    return collectRows(head.next[0], 1, limit);
+}
+
+// Keyset page: the `limit` players ranked after the (totalEarned, userId)
+// cursor. Costs O(log n + limit) however deep the cursor is.
+function getPage(after, limit) {
+    if (!after) {
+        return getTop(limit);
+    }
+
+    const { node, position } = positionOf(after.totalEarned, after.userId);
+    return collectRows(node.next[0], position + 1, limit);
+}
+
+// The player plus up to `distance` players either side of them
+function getAround(telegramId, distance) {
+    const node = byTelegramId.get(String(telegramId));
+    if (!node) {
+        return null;
+    }
+
+    const { position } = positionOf(node.player.totalEarned, node.player.userId);
+    const start = Math.max(1, position - distance);
+    return collectRows(nodeAtPosition(start), start, position + distance - start + 1);
+}
+
+function getRank(telegramId) {
+    const node = byTelegramId.get(String(telegramId));
+    if (!node) {
+        return null;
+    }
+
+    const { totalEarned, totalTaps } = node.player;
+    return {
+        rank: rankOfScore(totalEarned),
+        total_earned: totalEarned,
+        total_taps: totalTaps
+    };
+}
+
+// Populate the index from the database once at startup
+function loadRankIndex(callback) {
+    statements.each('rankIndexPlayers', [], (err, row) => {
+        if (!err) {
+            applyPlayer({
+                userId: row.id,
+                telegramId: row.telegram_id,
+                username: row.username,
+                firstName: row.first_name,
+                totalEarned: row.total_earned,
+                totalTaps: row.total_taps
+            });
+        }
+    }, (err, count) => {
+        if (err) {
+            console.error('Rank index load error:', err);
+        } else {
+            ready = true;
+            console.log(`Rank index loaded with ${count} players`);
+        }
+        if (callback) callback(err);
+    });
+}
+
+function isReady() {
+    return ready;
+}
+
+module.exports = {
+    loadRankIndex,
+    isReady,
+    upsertPlayer,
+    updateScore,
+    updateScores,
+    removePlayers,
+    getTop,
+    getPage,
+    getAround,
+    getRank
+};
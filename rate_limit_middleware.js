@@ -0,0 +1,153 @@
+
+const coordinator = require('../database/coordinator');
+
+// Per-user token buckets for authenticated routes. Each limiter keeps its
+// buckets in a fixed-size open-addressing table of typed arrays, so memory
+// stays bounded (about 20 bytes per slot) however many users there are.
+//
+// Buckets are per process by default, so in cluster mode a user can reach
+// up to N times the budget across N workers. That is accepted for cheap,
+// high-rate routes such as /taps, whose effect the server caps anyway.
+// Limiters created with `shared` keep their buckets on the coordinator,
+// so each user gets exactly the configured budget at the cost of an IPC
+// round trip per request; use it for low-rate routes like purchases.
+
+const TABLE_BITS = Math.ceil(Math.log2(parseInt(process.env.RATE_LIMIT_TABLE_SIZE) || 262144));
+const TABLE_SIZE = 1 << TABLE_BITS;
+const MAX_PROBE = 16;
+const SWEEP_INTERVAL = 60000;
+
+function createTable() {
+    return {
+        keys: new Int32Array(TABLE_SIZE), // user id, 0 = empty slot
+        tokens: new Float64Array(TABLE_SIZE),
+        updatedAt: new Float64Array(TABLE_SIZE)
+    };
+}
+
+function homeSlot(userId) {
+    return Math.imul(userId, 0x9e3779b1) >>> (32 - TABLE_BITS);
+}
+
+// Buckets allowing `burst` requests at once, refilled at `perSecond` per
+// user. take(userId) spends a token and returns 0, or returns the seconds
+// until one is available.
+function createBuckets({ perSecond, burst }) {
+    let table = createTable();
+
+    const available = (slot, now) =>
+        Math.min(burst, table.tokens[slot] + (now - table.updatedAt[slot]) * perSecond / 1000);
+
+    const claim = (slot, userId, tokens, now) => {
+        table.keys[slot] = userId;
+        table.tokens[slot] = tokens;
+        table.updatedAt[slot] = now;
+        return slot;
+    };
+
+    // Linear probing over a short window; when the window is full the
+    // least recently used bucket in it is reused
+    const findSlot = (userId, now) => {
+        let slot = homeSlot(userId);
+        let victim = slot;
+
+        for (let i = 0; i < MAX_PROBE; i++, slot = (slot + 1) & (TABLE_SIZE - 1)) {
+            if (table.keys[slot] === userId) {
+                return slot;
+            }
+            if (table.keys[slot] === 0) {
+                return claim(slot, userId, burst, now);
+            }
+            if (table.updatedAt[slot] < table.updatedAt[victim]) {
+                victim = slot;
+            }
+        }
+        return claim(victim, userId, burst, now);
+    };
+
+    // Buckets that have refilled completely behave like new ones, so
+    // dropping them loses nothing; the table is rebuilt without them
+    const sweep = () => {
+        const now = Date.now();
+        const previous = table;
+        table = createTable();
+
+        for (let slot = 0; slot < TABLE_SIZE; slot++) {
+            const userId = previous.keys[slot];
+            if (userId === 0) {
+                continue;
+            }
+
+            const tokens = Math.min(burst, previous.tokens[slot] + (now - previous.updatedAt[slot]) * perSecond / 1000);
+            if (tokens < burst) {
+                const moved = findSlot(userId, previous.updatedAt[slot]);
+                table.tokens[moved] = previous.tokens[slot];
+            }
+        }
+    };
+
+    setInterval(sweep, SWEEP_INTERVAL).unref();
+
+    return (userId) => {
+        const now = Date.now();
+        const slot = findSlot(userId, now);
+        const tokens = available(slot, now);
+        table.updatedAt[slot] = now;
+
+        if (tokens < 1) {
+            table.tokens[slot] = tokens;
+            return Math.ceil((1 - tokens) / perSecond);
+        }
+
+        table.tokens[slot] = tokens - 1;
+        return 0;
+    };
+}
+
+// Shared limiters by name; only the coordinator's are ever used
+const sharedBuckets = new Map();
+
+coordinator.handle('rateLimit:take', ({ name, userId }, reply) => {
+    reply(null, sharedBuckets.get(name)(userId));
+});
+
+// Allow `burst` requests at once, refilled at `perSecond` per user. A
+// `shared` limiter needs a `name` that is the same in every process.
+function userRateLimit({ perSecond, burst, shared = false, name }) {
+    const take = createBuckets({ perSecond, burst });
+    if (shared) {
+        sharedBuckets.set(name, take);
+    }
+
+    const respond = (res, next, retryAfter) => {
+        if (retryAfter > 0) {
+            res.set('Retry-After', String(retryAfter));
+            return res.status(429).json({ error: 'Too many requests' });
+        }
+        next();
+    };
+
+    return (req, res, next) => {
+        const userId = req.user && req.user.id;
+        if (!Number.isInteger(userId) || userId <= 0) {
+            return next();
+        }
+
+        if (!shared || !coordinator.isWorker()) {
+            return respond(res, next, take(userId));
+        }
+
+        coordinator.request('rateLimit:take', { name, userId }, (err, retryAfter) => {
+            if (err) {
+                // Let the request through rather than fail it on a limiter error
+                console.error('Rate limit error:', err);
+                return next();
+            }
+            respond(res, next, retryAfter);
+        });
+    };
+}
+
+module.exports = {
+    userRateLimit
+};
@@ -0,0 +1,200 @@
+
+// A small JSON Schema subset compiled once into plain functions: routes
+// build their validators and serializers at require time, so a request
+// only walks closures made for its own shape.
+//
+// Supported keywords: type (a name or an array of names), properties,
+// required, additionalProperties (false), items, minItems, maxItems,
+// minimum, maximum, minLength, maxLength, pattern and enum.
+
+const TYPE_CHECKS = {
+    object: (value) => value !== null && typeof value === 'object' && !Array.isArray(value),
+    array: Array.isArray,
+    string: (value) => typeof value === 'string',
+    integer: Number.isSafeInteger,
+    number: Number.isFinite,
+    boolean: (value) => typeof value === 'boolean',
+    null: (value) => value === null
+};
+
+function typesOf(schema) {
+    if (schema.type === undefined) {
+        return [];
+    }
+    return Array.isArray(schema.type) ? schema.type : [schema.type];
+}
+
+// Returns validate(value) -> null when valid, else a message naming the
+// first offending field
+function compileValidator(schema, path = 'body') {
+    const checks = [];
+    const types = typesOf(schema);
+
+    if (types.length > 0) {
+        const typeChecks = types.map((type) => TYPE_CHECKS[type]);
+        checks.push((value) => (typeChecks.some((check) => check(value)) ? null : `${path} must be ${types.join(' or ')}`));
+    }
+
+    if (schema.enum) {
+        const allowed = new Set(schema.enum);
+        checks.push((value) => (allowed.has(value) ? null : `${path} must be one of ${schema.enum.join(', ')}`));
+    }
+
+    if (schema.minimum !== undefined) {
+        checks.push((value) => (typeof value !== 'number' || value >= schema.minimum ? null : `${path} must be at least ${schema.minimum}`));
+    }
+    if (schema.maximum !== undefined) {
+        checks.push((value) => (typeof value !== 'number' || value <= schema.maximum ? null : `${path} must be at most ${schema.maximum}`));
+    }
+
+    if (schema.minLength !== undefined) {
+        checks.push((value) => (typeof value !== 'string' || value.length >= schema.minLength ? null : `${path} is too short`));
+    }
+    if (schema.maxLength !== undefined) {
+        checks.push((value) => (typeof value !== 'string' || value.length <= schema.maxLength ? null : `${path} is too long`));
+    }
+    if (schema.pattern) {
+        const pattern = new RegExp(schema.pattern);
+        checks.push((value) => (typeof value !== 'string' || pattern.test(value) ? null : `${path} has an invalid format`));
+    }
+
+    if (schema.properties) {
+        const properties = Object.keys(schema.properties).map((key) => ({
+            key,
+            validate: compileValidator(schema.properties[key], `${path}.${key}`)
+        }));
+        const required = new Set(schema.required || []);
+        const known = new Set(Object.keys(schema.properties));
+
+        checks.push((value) => {
+            if (!TYPE_CHECKS.object(value)) {
+                return null;
+            }
+
+            for (const { key, validate } of properties) {
+                const property = value[key];
+                if (property === undefined) {
+                    if (required.has(key)) {
+                        return `${path}.${key} is required`;
+                    }
+                    continue;
+                }
+
+                const error = validate(property);
+                if (error) {
+                    return error;
+                }
+            }
+
+            if (schema.additionalProperties === false) {
+                for (const key in value) {
+                    if (!known.has(key)) {
+                        return `${path}.${key} is not allowed`;
+                    }
+                }
+            }
+            return null;
+        });
+    }
+
+    if (schema.items || schema.minItems !== undefined || schema.maxItems !== undefined) {
+        const validateItem = schema.items ? compileValidator(schema.items, `${path}[]`) : null;
+
+        checks.push((value) => {
+            if (!Array.isArray(value)) {
+                return null;
+            }
+            if (schema.minItems !== undefined && value.length < schema.minItems) {
+                return `${path} must have at least ${schema.minItems} items`;
+            }
+            if (schema.maxItems !== undefined && value.length > schema.maxItems) {
+                return `${path} must have at most ${schema.maxItems} items`;
+            }
+
+            if (validateItem) {
+                for (const item of value) {
+                    const error = validateItem(item);
+                    if (error) {
+                        return error;
+                    }
+                }
+            }
+            return null;
+        });
+    }
+
+    return (value) => {
+        for (const check of checks) {
+            const error = check(value);
+            if (error) {
+                return error;
+            }
+        }
+        return null;
+    };
+}
+
+// Strings without quotes, backslashes, control characters or surrogates
+// need no escaping
+const NEEDS_ESCAPE = /["\\\u0000-\u001f\ud800-\udfff]/;
+
+function serializeString(value) {
+    return NEEDS_ESCAPE.test(value) ? JSON.stringify(value) : `"${value}"`;
+}
+
+function serializeNumber(value) {
+    return Number.isFinite(value) ? String(value) : 'null';
+}
+
+// Returns serialize(value) -> JSON text. Object keys are fixed by the
+// schema, in schema order, and unknown keys are left out. Output matches
+// JSON.stringify for values of the declared types.
+function compileSerializer(schema) {
+    const types = typesOf(schema);
+    const nullable = types.includes('null');
+    const type = types.find((name) => name !== 'null');
+
+    let serialize;
+    if (type === 'string') {
+        serialize = serializeString;
+    } else if (type === 'integer' || type === 'number') {
+        serialize = serializeNumber;
+    } else if (type === 'boolean') {
+        serialize = (value) => (value ? 'true' : 'false');
+    } else if (type === 'array' && schema.items) {
+        const serializeItem = compileSerializer(schema.items);
+        serialize = (value) => {
+            let json = '[';
+            for (let i = 0; i < value.length; i++) {
+                json += (i === 0 ? '' : ',') + serializeItem(value[i]);
+            }
+            return json + ']';
+        };
+    } else if (type === 'object' && schema.properties) {
+        const properties = Object.keys(schema.properties).map((key) => ({
+            key,
+            prefix: `${JSON.stringify(key)}:`,
+            serialize: compileSerializer(schema.properties[key])
+        }));
+
+        serialize = (value) => {
+            let json = '{';
+            for (const { key, prefix, serialize: serializeProperty } of properties) {
+                const property = value[key];
+                if (property !== undefined) {
+                    json += (json.length === 1 ? '' : ',') + prefix + serializeProperty(property);
+                }
+            }
+            return json + '}';
+        };
+    } else {
+        serialize = (value) => JSON.stringify(value);
+    }
+
+    return nullable ? (value) => (value === null ? 'null' : serialize(value)) : serialize;
+}
+
+module.exports = {
+    compileValidator,
+    compileSerializer
+};
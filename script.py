@@ -10,7 +10,10 @@ package_json = """
   "scripts": {
     "start": "node server.js",
     "dev": "nodemon server.js",
-    "migrate": "node migrations/init.js"
+    "migrate": "node migrations/init.js",
+    "bench:seed": "DATABASE_PATH=./bench.db node bench/seed.js",
+    "bench:serve": "DATABASE_PATH=./bench.db RATE_LIMIT_MAX=1000000000 node server.js",
+    "bench": "node bench/run.js"
   },
   "dependencies": {
     "express": "^4.18.2",
@@ -32,6 +35,8 @@ package_json = """
 
 # 2. Server.js - Main backend server
 server_js = """
+const cluster = require('cluster');
+const os = require('os');
 const express = require('express');
 const cors = require('cors');
 const helmet = require('helmet');
@@ -42,30 +47,45 @@ const authRoutes = require('./routes/auth');
 const gameRoutes = require('./routes/game');
 const leaderboardRoutes = require('./routes/leaderboard');
 const friendsRoutes = require('./routes/friends');
-const { initDatabase } = require('./database/init');
+const { initDatabase, initReadPool, closeDatabase } = require('./database/init');
+const coordinator = require('./database/coordinator');
+const { startTapFlusher, stopTapFlusher, flushTaps } = require('./database/writeBuffer');
+const { prepareStatements, finalizeStatements } = require('./database/statements');
+const { loadRankIndex } = require('./services/rankIndex');
+const { useSnapshot, startSnapshotJob, stopSnapshotJob } = require('./services/leaderboardSnapshot');
+const userCache = require('./services/userCache');
+const { startArchiveJob, stopArchiveJob } = require('./services/archive');
+const { requestMetrics, renderMetrics } = require('./services/metrics');
 
 const app = express();
 const PORT = process.env.PORT || 3000;
 
-// Initialize database
-initDatabase();
+// CLUSTER_WORKERS > 1 (or 'max') forks HTTP workers; the primary stays
+// behind as the write coordinator and the only SQLite writer
+const CLUSTER_WORKERS = process.env.CLUSTER_WORKERS === 'max'
+    ? os.cpus().length
+    : parseInt(process.env.CLUSTER_WORKERS) || 0;
+const clusterMode = CLUSTER_WORKERS > 1;
 
 // Middleware
+app.use(requestMetrics);
 app.use(helmet());
 app.use(cors({
     origin: process.env.FRONTEND_URL || 'https://t.me',
     credentials: true
 }));
 
-// Rate limiting
+// Rate limiting per IP. Game routes are authenticated and limited per
+// user instead, so players sharing a carrier NAT don't throttle each other.
 const limiter = rateLimit({
-    windowMs: 15 * 60 * 1000, // 15 minutes
-    max: 100 // limit each IP to 100 requests per windowMs
+    windowMs: parseInt(process.env.RATE_LIMIT_WINDOW) || 15 * 60 * 1000, // 15 minutes
+    max: parseInt(process.env.RATE_LIMIT_MAX) || 100, // limit each IP to 100 requests per windowMs
+    skip: (req) => req.path.startsWith('/api/game/')
 });
 app.use(limiter);
 
-app.use(express.json({ limit: '10mb' }));
-app.use(express.urlencoded({ extended: true }));
+// Request bodies are parsed by each route with its own size limit and
+// schema (middleware/validate.js)
 
 // Routes
 app.use('/api/auth', authRoutes);
@@ -75,7 +95,23 @@ app.use('/api/friends', friendsRoutes);
 
 // Health check
 app.get('/health', (req, res) => {
-    res.json({ status: 'OK', timestamp: new Date().toISOString() });
+    res.json({
+        status: 'OK',
+        timestamp: new Date().toISOString(),
+        userCache: userCache.getStats()
+    });
+});
+
+// Prometheus metrics; set METRICS_TOKEN to require it as a Bearer token
+app.get('/metrics', (req, res) => {
+    if (process.env.METRICS_TOKEN && req.headers.authorization !== `Bearer ${process.env.METRICS_TOKEN}`) {
+        return res.status(401).json({ error: 'Invalid token' });
+    }
+
+    renderMetrics((text) => {
+        res.set('Content-Type', 'text/plain; version=0.0.4');
+        res.send(text);
+    });
 });
 
 // Error handling middleware
@@ -89,9 +125,62 @@ app.use('*', (req, res) => {
     res.status(404).json({ error: 'Route not found' });
 });
 
-app.listen(PORT, () => {
-    console.log(`NZI Coin Backend running on port ${PORT}`);
-});
+// The in-memory rank index is only needed when it serves the leaderboard
+function loadLeaderboard() {
+    if (!useSnapshot()) {
+        loadRankIndex();
+    }
+}
+
+function startHttpServer() {
+    app.listen(PORT, () => {
+        console.log(`NZI Coin Backend running on port ${PORT}`);
+    });
+}
+
+// Initialize database
+if (clusterMode && coordinator.isWorker()) {
+    coordinator.startWorkerChannel();
+    initReadPool(() => prepareStatements(() => {
+        loadLeaderboard();
+        startHttpServer();
+    }));
+} else if (clusterMode) {
+    initDatabase(() => prepareStatements(() => {
+        startTapFlusher();
+        startSnapshotJob();
+        startArchiveJob();
+        coordinator.startCoordinator(CLUSTER_WORKERS);
+    }), { readPoolSize: 0 });
+} else {
+    initDatabase(() => prepareStatements(() => {
+        loadLeaderboard();
+        startSnapshotJob();
+        startArchiveJob();
+    }));
+    startTapFlusher();
+    startHttpServer();
+}
+
+function closeAndExit() {
+    finalizeStatements(() => closeDatabase(() => process.exit(0)));
+}
+
+// Stop workers first so no writes arrive mid-flush, then flush buffered
+// taps, finalize statements and close connections before exiting
+function shutdown() {
+    if (coordinator.isWorker()) {
+        return closeAndExit();
+    }
+
+    stopTapFlusher();
+    stopSnapshotJob();
+    stopArchiveJob();
+    coordinator.stopWorkers(() => flushTaps(closeAndExit));
+}
+
+process.on('SIGTERM', shutdown);
+process.on('SIGINT', shutdown);
 
 module.exports = app;
 """
@@ -100,304 +189,403 @@ module.exports = app;
 database_init = """
 const sqlite3 = require('sqlite3').verbose();
 const path = require('path');
+const { runMigrations } = require('../migrations/init');
+
+const dbPath = process.env.DATABASE_PATH || path.join(__dirname, '../nzi_coin.db');
 
-const dbPath = path.join(__dirname, '../nzi_coin.db');
-let db;
+const READ_POOL_SIZE = parseInt(process.env.DB_READ_POOL_SIZE) || 4;
+const CACHE_SIZE_KB = parseInt(process.env.DB_CACHE_SIZE_KB) || 20000;
+const MMAP_SIZE = parseInt(process.env.DB_MMAP_SIZE) || 268435456;
+const BUSY_TIMEOUT = parseInt(process.env.DB_BUSY_TIMEOUT) || 5000;
+
+let db; // the single writer connection
+let readers = [];
+let nextReader = 0;
+
+function tuneConnection(connection, pragmas, callback) {
+    connection.exec(pragmas.map((pragma) => `PRAGMA ${pragma}`).join('; '), callback);
+}
+
+// Opens the writer, migrates, then opens the read pool. The cluster
+// coordinator passes readPoolSize: 0 since it serves no reads.
+function initDatabase(callback, options = {}) {
+    const readPoolSize = options.readPoolSize !== undefined ? options.readPoolSize : READ_POOL_SIZE;
 
-function initDatabase() {
     db = new sqlite3.Database(dbPath, (err) => {
         if (err) {
             console.error('Error opening database:', err.message);
-        } else {
-            console.log('Connected to SQLite database');
-            createTables();
+            return;
         }
+
+        console.log('Connected to SQLite database');
+
+        // WAL lets the read pool run alongside the writer instead of queueing behind it
+        tuneConnection(db, [
+            'journal_mode = WAL',
+            'synchronous = NORMAL',
+            `cache_size = -${CACHE_SIZE_KB}`,
+            `mmap_size = ${MMAP_SIZE}`,
+            `busy_timeout = ${BUSY_TIMEOUT}`,
+            'temp_store = MEMORY'
+        ], (err) => {
+            if (err) {
+                console.error('Error tuning database:', err.message);
+            }
+
+            createTables((err) => {
+                if (err) {
+                    return callback && callback(err);
+                }
+                openReaders(readPoolSize, callback);
+            });
+        });
     });
 }
 
-function createTables() {
-    // Users table
-    db.run(`
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            telegram_id TEXT UNIQUE NOT NULL,
-            username TEXT,
-            first_name TEXT,
-            last_name TEXT,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            last_active DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    `);
+// Read-only connections are opened after migrations so they see the final schema
+function openReaders(count, callback) {
+    let remaining = count;
+    let failed = null;
 
-    // Game progress table
-    db.run(`
-        CREATE TABLE IF NOT EXISTS game_progress (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            coins INTEGER DEFAULT 0,
-            energy INTEGER DEFAULT 100,
-            max_energy INTEGER DEFAULT 100,
-            coins_per_tap INTEGER DEFAULT 1,
-            energy_regen_rate INTEGER DEFAULT 1800000,
-            total_earned INTEGER DEFAULT 0,
-            total_taps INTEGER DEFAULT 0,
-            last_save DATETIME DEFAULT CURRENT_TIMESTAMP,
-            boosters TEXT DEFAULT '{"energyCapacity":0,"energyRegen":0,"coinsPerTap":0}',
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    `);
+    if (count === 0) {
+        return callback && callback(null);
+    }
 
-    // Friends/referrals table
-    db.run(`
-        CREATE TABLE IF NOT EXISTS friends (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            friend_id INTEGER NOT NULL,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            bonus_claimed BOOLEAN DEFAULT FALSE,
-            FOREIGN KEY (user_id) REFERENCES users (id),
-            FOREIGN KEY (friend_id) REFERENCES users (id),
-            UNIQUE(user_id, friend_id)
-        )
-    `);
+    for (let i = 0; i < count; i++) {
+        const reader = new sqlite3.Database(dbPath, sqlite3.OPEN_READONLY, (err) => {
+            if (err) {
+                failed = err;
+            } else {
+                readers.push(reader);
+            }
 
-    // Tasks/achievements table
-    db.run(`
-        CREATE TABLE IF NOT EXISTS user_tasks (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            task_id TEXT NOT NULL,
-            completed BOOLEAN DEFAULT FALSE,
-            progress INTEGER DEFAULT 0,
-            completed_at DATETIME,
-            FOREIGN KEY (user_id) REFERENCES users (id),
-            UNIQUE(user_id, task_id)
-        )
-    `);
+            tuneConnection(reader, [
+                `cache_size = -${CACHE_SIZE_KB}`,
+                `mmap_size = ${MMAP_SIZE}`,
+                `busy_timeout = ${BUSY_TIMEOUT}`
+            ], () => {
+                if (--remaining === 0) {
+                    if (failed) {
+                        console.error('Error opening read connection:', failed.message);
+                    }
+                    console.log(`Opened ${readers.length} read connections`);
+                    if (callback) callback(null);
+                }
+            });
+        });
+    }
+}
 
-    // Leaderboard view
-    db.run(`
-        CREATE VIEW IF NOT EXISTS leaderboard AS
-        SELECT 
-            u.telegram_id,
-            u.username,
-            u.first_name,
-            gp.total_earned,
-            gp.total_taps,
-            RANK() OVER (ORDER BY gp.total_earned DESC) as rank
-        FROM users u
-        JOIN game_progress gp ON u.id = gp.user_id
-        ORDER BY gp.total_earned DESC
-    `);
-
-    console.log('Database tables created successfully');
+function createTables(callback) {
+    runMigrations(db, (err) => {
+        if (!err) {
+            console.log('Database tables created successfully');
+        }
+        if (callback) callback(err);
+    });
+}
+
+// Cluster workers only open the read pool; writes go to the coordinator
+function initReadPool(callback) {
+    openReaders(READ_POOL_SIZE, callback);
 }
 
 function getDatabase() {
     return db;
 }
 
+// Round-robin over the read pool; falls back to the writer until it is open
+function getReader() {
+    if (readers.length === 0) {
+        return db;
+    }
+
+    nextReader = (nextReader + 1) % readers.length;
+    return readers[nextReader];
+}
+
+function getReaders() {
+    return readers;
+}
+
+function closeDatabase(callback) {
+    const connections = [...readers, db].filter(Boolean);
+    let remaining = connections.length;
+
+    readers = [];
+    if (remaining === 0) {
+        return callback && callback();
+    }
+
+    connections.forEach((connection) => connection.close(() => {
+        if (--remaining === 0 && callback) {
+            callback();
+        }
+    }));
+}
+
 module.exports = {
     initDatabase,
-    getDatabase
+    initReadPool,
+    getDatabase,
+    getReader,
+    getReaders,
+    closeDatabase
 };
 """
 
 # 4. Auth routes
 auth_routes = """
 const express = require('express');
-const crypto = require('crypto');
-const { getDatabase } = require('../database/init');
+const statements = require('../database/statements');
+const { queueLastActive } = require('../database/writeBuffer');
+const { upsertPlayer } = require('../services/rankIndex');
+const { rememberUser } = require('../services/userCache');
+const { evaluateTasks } = require('../services/taskEngine');
+const { verifyInitData } = require('../services/telegramAuth');
+const { signToken } = require('../middleware/auth');
+const { jsonBody } = require('../middleware/validate');
+const { compileSerializer } = require('../services/schema');
 const router = express.Router();
 
-// Validate Telegram WebApp init data
-function validateTelegramWebAppData(initData, botToken) {
-    const urlParams = new URLSearchParams(initData);
-    const hash = urlParams.get('hash');
-    urlParams.delete('hash');
-    
-    const dataCheckString = Array.from(urlParams.entries())
-        .sort(([a], [b]) => a.localeCompare(b))
-        .map(([key, value]) => `${key}=${value}`)
-        .join('\\n');
-    
-    const secretKey = crypto.createHmac('sha256', 'WebAppData').update(botToken).digest();
-    const calculatedHash = crypto.createHmac('sha256', secretKey).update(dataCheckString).digest('hex');
-    
-    return calculatedHash === hash;
-}
+// Telegram's initData is a short query string; 4 KB leaves ample room
+const loginBody = jsonBody({
+    type: 'object',
+    properties: { initData: { type: 'string', minLength: 1, maxLength: 4096 } },
+    required: ['initData'],
+    additionalProperties: false
+}, { limit: '8kb', error: 'No user data found' });
+
+const text = { type: ['string', 'null'] };
+const integer = { type: 'integer' };
+
+const serializeLogin = compileSerializer({
+    type: 'object',
+    properties: {
+        user: {
+            type: 'object',
+            properties: {
+                id: integer,
+                telegram_id: { type: 'string' },
+                username: text,
+                first_name: text,
+                last_name: text,
+                created_at: text,
+                last_active: text
+            }
+        },
+        progress: {
+            type: 'object',
+            properties: {
+                id: integer,
+                user_id: integer,
+                coins: integer,
+                energy: integer,
+                max_energy: integer,
+                coins_per_tap: integer,
+                energy_regen_rate: integer,
+                total_earned: integer,
+                total_taps: integer,
+                last_save: text,
+                boosters: { type: 'string' },
+                version: integer,
+                energy_updated_at: integer,
+                friend_count: integer
+            }
+        },
+        token: { type: 'string' }
+    }
+});
 
 // Login/Register user
-router.post('/login', async (req, res) => {
+router.post('/login', loginBody, async (req, res) => {
     try {
         const { initData } = req.body;
-        
-        // In production, uncomment this validation
-        // if (!validateTelegramWebAppData(initData, process.env.BOT_TOKEN)) {
-        //     return res.status(401).json({ error: 'Invalid Telegram data' });
-        // }
+
+        if (process.env.NODE_ENV === 'production' && !verifyInitData(initData)) {
+            return res.status(401).json({ error: 'Invalid Telegram data' });
+        }
 
         const urlParams = new URLSearchParams(initData);
         const userParam = urlParams.get('user');
-        
+
         if (!userParam) {
             return res.status(400).json({ error: 'No user data found' });
         }
 
         const userData = JSON.parse(userParam);
-        const db = getDatabase();
 
-        // Check if user exists
-        db.get('SELECT * FROM users WHERE telegram_id = ?', [userData.id], (err, existingUser) => {
-            if (err) {
-                return res.status(500).json({ error: 'Database error' });
-            }
+        // Registers new players, restores archived ones and returns every
+        // known player with their progress
+        statements.all(
+            'loginUser',
+            [String(userData.id), userData.username || null, userData.first_name || null, userData.last_name || null],
+            (err, rows) => {
+                if (err) {
+                    return res.status(500).json({ error: 'Database error' });
+                }
 
-            if (existingUser) {
-                // Update last active
-                db.run('UPDATE users SET last_active = CURRENT_TIMESTAMP WHERE id = ?', [existingUser.id]);
-                
-                // Get game progress
-                db.get('SELECT * FROM game_progress WHERE user_id = ?', [existingUser.id], (err, progress) => {
-                    if (err) {
-                        return res.status(500).json({ error: 'Database error' });
+                const { progress, restored, ...user } = rows[0];
+                rememberUser(user.telegram_id, user.id);
+                evaluateTasks([{ userId: user.id, input: 'logins', from: 0, to: 1 }]);
+
+                if (progress) {
+                    const playerProgress = JSON.parse(progress);
+
+                    if (restored) {
+                        // Archiving took the player off the leaderboard
+                        upsertPlayer({
+                            userId: user.id,
+                            telegramId: user.telegram_id,
+                            username: user.username,
+                            firstName: user.first_name,
+                            totalEarned: playerProgress.total_earned,
+                            totalTaps: playerProgress.total_taps
+                        });
+                    } else {
+                        queueLastActive(user.id);
                     }
 
-                    res.json({
-                        user: existingUser,
-                        progress: progress || null,
-                        token: generateToken(existingUser.id)
-                    });
+                    return res.type('json').send(serializeLogin({
+                        user,
+                        progress: playerProgress,
+                        token: signToken(user)
+                    }));
+                }
+
+                upsertPlayer({
+                    userId: user.id,
+                    telegramId: user.telegram_id,
+                    username: user.username,
+                    firstName: user.first_name
                 });
-            } else {
-                // Create new user
-                db.run(
-                    'INSERT INTO users (telegram_id, username, first_name, last_name) VALUES (?, ?, ?, ?)',
-                    [userData.id, userData.username || null, userData.first_name || null, userData.last_name || null],
-                    function(err) {
-                        if (err) {
-                            return res.status(500).json({ error: 'Database error' });
-                        }
-
-                        const userId = this.lastID;
-
-                        // Create initial game progress
-                        db.run(
-                            'INSERT INTO game_progress (user_id) VALUES (?)',
-                            [userId],
-                            (err) => {
-                                if (err) {
-                                    return res.status(500).json({ error: 'Database error' });
-                                }
-
-                                const newUser = {
-                                    id: userId,
-                                    telegram_id: userData.id,
-                                    username: userData.username,
-                                    first_name: userData.first_name,
-                                    last_name: userData.last_name
-                                };
-
-                                res.json({
-                                    user: newUser,
-                                    progress: {
-                                        coins: 0,
-                                        energy: 100,
-                                        max_energy: 100,
-                                        coins_per_tap: 1,
-                                        energy_regen_rate: 1800000,
-                                        total_earned: 0,
-                                        total_taps: 0,
-                                        boosters: '{"energyCapacity":0,"energyRegen":0,"coinsPerTap":0}'
-                                    },
-                                    token: generateToken(userId)
-                                });
-                            }
-                        );
-                    }
-                );
+
+                res.type('json').send(serializeLogin({
+                    user,
+                    progress: {
+                        coins: 0,
+                        energy: 100,
+                        max_energy: 100,
+                        coins_per_tap: 1,
+                        energy_regen_rate: 1800000,
+                        total_earned: 0,
+                        total_taps: 0,
+                        version: 0,
+                        energy_updated_at: Date.now(),
+                        friend_count: 0,
+                        boosters: '{"energyCapacity":0,"energyRegen":0,"coinsPerTap":0}'
+                    },
+                    token: signToken(user)
+                }));
             }
-        });
+        );
     } catch (error) {
         console.error('Auth error:', error);
         res.status(500).json({ error: 'Server error' });
     }
 });
 
-function generateToken(userId) {
-    return crypto.createHash('sha256').update(userId + process.env.JWT_SECRET || 'fallback-secret').digest('hex');
-}
-
 module.exports = router;
 """
 
 # 5. Game routes
 game_routes = """
 const express = require('express');
-const { getDatabase } = require('../database/init');
+const statements = require('../database/statements');
+const { queueTaps } = require('../database/writeBuffer');
+const { evaluateTasks, describeTasks } = require('../services/taskEngine');
+const { requireAuth } = require('../middleware/auth');
+const { userRateLimit } = require('../middleware/rateLimit');
+const { jsonBody } = require('../middleware/validate');
+const { compileSerializer } = require('../services/schema');
+const { boosters: boosterTable } = require('../config/game');
 const router = express.Router();
 
-// Save game progress
-router.post('/save', (req, res) => {
-    try {
-        const {
-            telegram_id,
-            coins,
-            energy,
-            max_energy,
-            coins_per_tap,
-            energy_regen_rate,
-            total_earned,
-            total_taps,
-            boosters
-        } = req.body;
-
-        const db = getDatabase();
-
-        // First, get user ID from telegram_id
-        db.get('SELECT id FROM users WHERE telegram_id = ?', [telegram_id], (err, user) => {
-            if (err || !user) {
-                return res.status(404).json({ error: 'User not found' });
-            }
+const MAX_TAPS_PER_BATCH = parseInt(process.env.MAX_TAPS_PER_BATCH) || 500;
 
-            // Update game progress
-            db.run(`
-                UPDATE game_progress 
-                SET coins = ?, energy = ?, max_energy = ?, coins_per_tap = ?, 
-                    energy_regen_rate = ?, total_earned = ?, total_taps = ?, 
-                    boosters = ?, last_save = CURRENT_TIMESTAMP
-                WHERE user_id = ?
-            `, [
-                coins, energy, max_energy, coins_per_tap,
-                energy_regen_rate, total_earned, total_taps,
-                JSON.stringify(boosters), user.id
-            ], function(err) {
-                if (err) {
-                    console.error('Save error:', err);
-                    return res.status(500).json({ error: 'Failed to save progress' });
-                }
+const boosterTypes = Object.keys(boosterTable);
 
-                res.json({ success: true, saved_at: new Date().toISOString() });
+// Booster levels from the stored JSON; missing or corrupt values read as
+// level 0 instead of throwing inside a database callback
+function parseBoosters(text) {
+    const levels = Object.fromEntries(boosterTypes.map((type) => [type, 0]));
+
+    try {
+        const stored = JSON.parse(text);
+        if (stored && typeof stored === 'object') {
+            boosterTypes.forEach((type) => {
+                if (Number.isInteger(stored[type])) {
+                    levels[type] = stored[type];
+                }
             });
-        });
+        }
+    } catch {
+        // Keep the defaults
+    }
+    return levels;
+}
+
+// Request bodies
+const tapsBody = jsonBody({
+    type: 'object',
+    properties: { taps: { type: 'integer', minimum: 1, maximum: MAX_TAPS_PER_BATCH } },
+    required: ['taps'],
+    additionalProperties: false
+}, { error: 'Invalid tap count' });
+
+const purchaseBody = jsonBody({
+    type: 'object',
+    properties: { booster_type: { type: 'string', enum: boosterTypes } },
+    required: ['booster_type'],
+    additionalProperties: false
+}, { error: 'Unknown booster type' });
+
+// Responses of the write routes, which are called most often
+const serializeTaps = compileSerializer({
+    type: 'object',
+    properties: { success: { type: 'boolean' }, accepted: { type: 'integer' } }
+});
+
+const serializePurchase = compileSerializer({
+    type: 'object',
+    properties: {
+        success: { type: 'boolean' },
+        new_coins: { type: 'integer' },
+        boosters: {
+            type: 'object',
+            properties: Object.fromEntries(boosterTypes.map((type) => [type, { type: 'integer' }]))
+        },
+        energy: { type: 'integer' },
+        max_energy: { type: 'integer' },
+        energy_regen_rate: { type: 'integer' },
+        coins_per_tap: { type: 'integer' },
+        version: { type: 'integer' }
+    }
+});
+
+// Per-user request budgets: sustained requests per second and burst size.
+// Purchases share one budget across cluster workers; taps are limited per
+// worker, since the energy check already caps what they can earn.
+const tapsLimit = userRateLimit({ perSecond: 5, burst: 20 });
+const purchaseLimit = userRateLimit({ perSecond: 1, burst: 5, shared: true, name: 'purchase' });
+
+// Submit a batch of taps; applied server-side on the next buffer flush
+router.post('/taps', requireAuth, tapsLimit, tapsBody, (req, res) => {
+    try {
+        const { taps } = req.body;
+
+        queueTaps(req.user.id, taps);
+        res.status(202).type('json').send(serializeTaps({ success: true, accepted: taps }));
     } catch (error) {
-        console.error('Save game error:', error);
+        console.error('Taps error:', error);
         res.status(500).json({ error: 'Server error' });
     }
 });
 
 // Load game progress
-router.get('/load/:telegram_id', (req, res) => {
+router.get('/load', requireAuth, (req, res) => {
     try {
-        const { telegram_id } = req.params;
-        const db = getDatabase();
-
-        db.get(`
-            SELECT gp.*, u.username, u.first_name 
-            FROM game_progress gp
-            JOIN users u ON gp.user_id = u.id
-            WHERE u.telegram_id = ?
-        `, [telegram_id], (err, progress) => {
+        statements.get('loadProgress', [req.user.id], (err, progress) => {
             if (err) {
                 return res.status(500).json({ error: 'Database error' });
             }
@@ -406,12 +594,7 @@ router.get('/load/:telegram_id', (req, res) => {
                 return res.status(404).json({ error: 'Progress not found' });
             }
 
-            // Parse boosters JSON
-            try {
-                progress.boosters = JSON.parse(progress.boosters);
-            } catch {
-                progress.boosters = { energyCapacity: 0, energyRegen: 0, coinsPerTap: 0 };
-            }
+            progress.boosters = parseBoosters(progress.boosters);
 
             res.json(progress);
         });
@@ -421,47 +604,80 @@ router.get('/load/:telegram_id', (req, res) => {
     }
 });
 
-// Purchase booster
-router.post('/purchase-booster', (req, res) => {
+// Get task progress and completions
+router.get('/tasks', requireAuth, (req, res) => {
     try {
-        const { telegram_id, booster_type, cost } = req.body;
-        const db = getDatabase();
+        const userId = req.user.id;
 
-        db.get('SELECT id FROM users WHERE telegram_id = ?', [telegram_id], (err, user) => {
-            if (err || !user) {
-                return res.status(404).json({ error: 'User not found' });
+        statements.get('progressByUserId', [userId], (err, progress) => {
+            if (err) {
+                return res.status(500).json({ error: 'Database error' });
             }
 
-            // Get current progress
-            db.get('SELECT * FROM game_progress WHERE user_id = ?', [user.id], (err, progress) => {
-                if (err || !progress) {
-                    return res.status(404).json({ error: 'Progress not found' });
-                }
+            if (!progress) {
+                return res.status(404).json({ error: 'Progress not found' });
+            }
 
-                if (progress.coins < cost) {
-                    return res.status(400).json({ error: 'Insufficient coins' });
+            statements.all('userTasks', [userId], (err, completed) => {
+                if (err) {
+                    return res.status(500).json({ error: 'Database error' });
                 }
 
-                const boosters = JSON.parse(progress.boosters);
-                boosters[booster_type] = (boosters[booster_type] || 0) + 1;
+                const counters = {
+                    logins: 0,
+                    total_taps: progress.total_taps,
+                    friends: progress.friend_count,
+                    max_energy: progress.max_energy
+                };
+                res.json(describeTasks(counters, completed));
+            });
+        });
+    } catch (error) {
+        console.error('Tasks error:', error);
+        res.status(500).json({ error: 'Server error' });
+    }
+});
 
-                const newCoins = progress.coins - cost;
+// Purchase booster; the price is taken from the server's table, not the client
+router.post('/purchase-booster', requireAuth, purchaseLimit, purchaseBody, (req, res) => {
+    try {
+        const { booster_type } = req.body;
+        const userId = req.user.id;
 
-                db.run(
-                    'UPDATE game_progress SET coins = ?, boosters = ? WHERE user_id = ?',
-                    [newCoins, JSON.stringify(boosters), user.id],
-                    function(err) {
-                        if (err) {
-                            return res.status(500).json({ error: 'Purchase failed' });
-                        }
+        statements.get(`purchaseBooster:${booster_type}`, [userId], (err, progress) => {
+            if (err) {
+                console.error('Purchase error:', err);
+                return res.status(500).json({ error: 'Purchase failed' });
+            }
 
-                        res.json({
-                            success: true,
-                            new_coins: newCoins,
-                            boosters: boosters
-                        });
-                    }
-                );
+            if (progress) {
+                const { column } = boosterTable[booster_type];
+                evaluateTasks([{ userId, input: column, from: 0, to: progress[column] }]);
+
+                return res.type('json').send(serializePurchase({
+                    success: true,
+                    new_coins: progress.coins,
+                    boosters: parseBoosters(progress.boosters),
+                    energy: progress.energy,
+                    max_energy: progress.max_energy,
+                    energy_regen_rate: progress.energy_regen_rate,
+                    coins_per_tap: progress.coins_per_tap,
+                    version: progress.version
+                }));
+            }
+
+            // Nothing was updated; read the row only to explain why
+            statements.get('progressForUpdate', [userId], (err, current) => {
+                if (err || !current) {
+                    return res.status(404).json({ error: 'Progress not found' });
+                }
+
+                const level = parseBoosters(current.boosters)[booster_type];
+                if (level >= boosterTable[booster_type].costs.length) {
+                    return res.status(400).json({ error: 'Booster already at max level' });
+                }
+
+                res.status(400).json({ error: 'Insufficient coins' });
             });
         });
     } catch (error) {
@@ -476,49 +692,133 @@ module.exports = router;
 # 6. Leaderboard routes
 leaderboard_routes = """
 const express = require('express');
-const { getDatabase } = require('../database/init');
+const statements = require('../database/statements');
+const rankIndex = require('../services/rankIndex');
+const { useSnapshot } = require('../services/leaderboardSnapshot');
+const { cacheResponse, invalidateOn } = require('../middleware/cache');
 const router = express.Router();
 
-// Get top players
-router.get('/top/:limit?', (req, res) => {
+const CACHE_TTL = parseInt(process.env.LEADERBOARD_CACHE_TTL) || 5000;
+const MAX_PAGE_SIZE = parseInt(process.env.LEADERBOARD_MAX_PAGE_SIZE) || 100;
+const MAX_AROUND = Math.floor(MAX_PAGE_SIZE / 2); // keeps /around within one page
+
+// Snapshot refreshes and live score changes both reach every worker as
+// coordinator events
+if (useSnapshot()) {
+    invalidateOn('leaderboard:snapshot', 'leaderboard');
+} else {
+    invalidateOn('rank:scores', 'leaderboard');
+    invalidateOn('rank:player', 'leaderboard');
+}
+
+function encodeCursor(row) {
+    return Buffer.from(`${row.total_earned}:${row.user_id}`).toString('base64url');
+}
+
+function decodeCursor(cursor) {
+    const [totalEarned, userId] = Buffer.from(String(cursor), 'base64url').toString().split(':').map(Number);
+    if (!Number.isInteger(totalEarned) || !Number.isInteger(userId)) {
+        return null;
+    }
+    return { totalEarned, userId };
+}
+
+// Rows are fetched one past the page size to know whether another page
+// follows; the internal user_id only leaves the server inside the cursor
+function toPage(rows, limit) {
+    const players = rows.slice(0, limit).map(({ user_id, ...player }) => player);
+    return {
+        players,
+        next_cursor: rows.length > limit ? encodeCursor(rows[limit - 1]) : null
+    };
+}
+
+// Get top players, one page at a time: pass `after` from the previous
+// page's next_cursor to continue
+router.get('/top/:limit?', cacheResponse('leaderboard', CACHE_TTL), (req, res) => {
     try {
-        const limit = parseInt(req.params.limit) || 50;
-        const db = getDatabase();
-
-        db.all(`
-            SELECT 
-                telegram_id,
-                username,
-                first_name,
-                total_earned,
-                total_taps,
-                rank
-            FROM leaderboard
-            LIMIT ?
-        `, [limit], (err, results) => {
+        const limit = Math.min(Math.max(parseInt(req.params.limit) || 50, 1), MAX_PAGE_SIZE);
+        const after = req.query.after ? decodeCursor(req.query.after) : null;
+
+        if (req.query.after && !after) {
+            return res.status(400).json({ error: 'Invalid cursor' });
+        }
+
+        if (!useSnapshot() && rankIndex.isReady()) {
+            return res.json(toPage(rankIndex.getPage(after, limit + 1), limit));
+        }
+
+        const respond = (err, rows) => {
             if (err) {
                 return res.status(500).json({ error: 'Database error' });
             }
 
-            res.json(results);
-        });
+            res.json(toPage(rows, limit));
+        };
+
+        if (useSnapshot()) {
+            return after
+                ? statements.all('snapshotPage', [after.totalEarned, after.userId, limit + 1], respond)
+                : statements.all('snapshotTop', [limit + 1], respond);
+        }
+
+        // Only the first page is served live while the rank index loads
+        if (after) {
+            return res.status(503).json({ error: 'Leaderboard is loading' });
+        }
+        statements.all('leaderboardTop', [limit + 1], respond);
     } catch (error) {
         console.error('Leaderboard error:', error);
         res.status(500).json({ error: 'Server error' });
     }
 });
 
+// Get the players ranked just above and below a user
+router.get('/around/:telegram_id/:distance?', cacheResponse('leaderboard', CACHE_TTL), (req, res) => {
+    try {
+        const { telegram_id } = req.params;
+        const distance = Math.min(Math.max(parseInt(req.params.distance) || 5, 1), MAX_AROUND);
+
+        const respond = (err, rows) => {
+            if (err) {
+                return res.status(500).json({ error: 'Database error' });
+            }
+
+            if (!rows || rows.length === 0) {
+                return res.status(404).json({ error: 'User not found' });
+            }
+
+            res.json(rows.map(({ user_id, ...player }) => player));
+        };
+
+        if (useSnapshot()) {
+            return statements.all('snapshotAround', [telegram_id, distance], respond);
+        }
+
+        if (!rankIndex.isReady()) {
+            return res.status(503).json({ error: 'Leaderboard is loading' });
+        }
+        respond(null, rankIndex.getAround(telegram_id, distance));
+    } catch (error) {
+        console.error('Around error:', error);
+        res.status(500).json({ error: 'Server error' });
+    }
+});
+
 // Get user rank
-router.get('/rank/:telegram_id', (req, res) => {
+router.get('/rank/:telegram_id', cacheResponse('leaderboard', CACHE_TTL), (req, res) => {
     try {
         const { telegram_id } = req.params;
-        const db = getDatabase();
 
-        db.get(`
-            SELECT rank, total_earned, total_taps
-            FROM leaderboard
-            WHERE telegram_id = ?
-        `, [telegram_id], (err, result) => {
+        if (!useSnapshot() && rankIndex.isReady()) {
+            const result = rankIndex.getRank(telegram_id);
+            if (!result) {
+                return res.status(404).json({ error: 'User not found' });
+            }
+            return res.json(result);
+        }
+
+        statements.get(useSnapshot() ? 'snapshotRank' : 'leaderboardRank', [telegram_id], (err, result) => {
             if (err) {
                 return res.status(500).json({ error: 'Database error' });
             }
@@ -541,45 +841,96 @@ module.exports = router;
 # 7. Friends routes
 friends_routes = """
 const express = require('express');
-const { getDatabase } = require('../database/init');
+const statements = require('../database/statements');
+const { importReferrals } = require('../database/referrals');
+const { evaluateTasks } = require('../services/taskEngine');
+const { resolveUserId } = require('../services/userCache');
+const { cacheResponse, invalidate } = require('../middleware/cache');
+const { streamJsonArray } = require('../services/jsonStream');
+const { jsonBody } = require('../middleware/validate');
+const { compileSerializer } = require('../services/schema');
+const { requireAuth, requireAdmin } = require('../middleware/auth');
 const router = express.Router();
 
-// Add friend (referral)
-router.post('/add', (req, res) => {
+const CACHE_TTL = parseInt(process.env.FRIENDS_CACHE_TTL) || 30000;
+const STREAM_CHUNK_SIZE = 500;
+const MAX_REFERRALS_PER_IMPORT = parseInt(process.env.MAX_REFERRALS_PER_IMPORT) || 1000;
+const MAX_REFERRAL_DEPTH = 10;
+
+// Telegram ids arrive as numbers or numeric strings
+const telegramId = { type: ['integer', 'string'], minimum: 1, pattern: '^[0-9]{1,20}$' };
+
+const referral = {
+    type: 'object',
+    properties: { user_telegram_id: telegramId, friend_telegram_id: telegramId },
+    required: ['user_telegram_id', 'friend_telegram_id'],
+    additionalProperties: false
+};
+
+// The referrer is the signed-in player, never a field of the body
+const addBody = jsonBody({
+    type: 'object',
+    properties: { friend_telegram_id: telegramId },
+    required: ['friend_telegram_id'],
+    additionalProperties: false
+}, { error: 'Invalid referral' });
+
+const importBody = jsonBody({
+    type: 'object',
+    properties: {
+        referrals: { type: 'array', items: referral, minItems: 1, maxItems: MAX_REFERRALS_PER_IMPORT }
+    },
+    required: ['referrals'],
+    additionalProperties: false
+}, { limit: MAX_REFERRALS_PER_IMPORT * 128, error: 'Invalid referrals' });
+
+const serializeAdd = compileSerializer({
+    type: 'object',
+    properties: { success: { type: 'boolean' }, bonus_given: { type: 'boolean' } }
+});
+
+// Friend rows go out without the internal user id used for paging
+function toFriend({ user_id, ...friend }) {
+    return friend;
+}
+
+// Add friend (referral) for the signed-in player
+router.post('/add', requireAuth, addBody, (req, res) => {
     try {
-        const { user_telegram_id, friend_telegram_id } = req.body;
-        const db = getDatabase();
+        const { friend_telegram_id } = req.body;
+        const userId = req.user.id;
 
-        // Get user IDs
-        db.get('SELECT id FROM users WHERE telegram_id = ?', [user_telegram_id], (err, user) => {
-            if (err || !user) {
-                return res.status(404).json({ error: 'User not found' });
+        resolveUserId(friend_telegram_id, (err, friendId) => {
+            if (err || !friendId) {
+                return res.status(404).json({ error: 'Friend not found' });
             }
 
-            db.get('SELECT id FROM users WHERE telegram_id = ?', [friend_telegram_id], (err, friend) => {
-                if (err || !friend) {
-                    return res.status(404).json({ error: 'Friend not found' });
-                }
+            if (friendId === userId) {
+                return res.status(400).json({ error: 'Cannot add yourself as a friend' });
+            }
 
-                // Add friendship
-                db.run(
-                    'INSERT OR IGNORE INTO friends (user_id, friend_id) VALUES (?, ?)',
-                    [user.id, friend.id],
-                    function(err) {
-                        if (err) {
-                            return res.status(500).json({ error: 'Failed to add friend' });
-                        }
-
-                        // Give referral bonus (500 coins each)
-                        if (this.changes > 0) {
-                            db.run('UPDATE game_progress SET coins = coins + 500 WHERE user_id = ?', [user.id]);
-                            db.run('UPDATE game_progress SET coins = coins + 500 WHERE user_id = ?', [friend.id]);
-                        }
-
-                        res.json({ success: true, bonus_given: this.changes > 0 });
+            // Add friendship; the referral bonus (500 coins each) is
+            // credited by a trigger in the same statement
+            statements.run(
+                'insertFriend',
+                [userId, friendId],
+                function(err) {
+                    if (err) {
+                        return res.status(500).json({ error: 'Failed to add friend' });
                     }
-                );
-            });
+
+                    if (this.changes > 0) {
+                        invalidate('friends', String(req.user.telegramId));
+                        statements.get('friendCount', [userId], (err, friends) => {
+                            if (!err && friends) {
+                                evaluateTasks([{ userId, input: 'friends', from: friends.count - 1, to: friends.count }]);
+                            }
+                        });
+                    }
+
+                    res.type('json').send(serializeAdd({ success: true, bonus_given: this.changes > 0 }));
+                }
+            );
         });
     } catch (error) {
         console.error('Add friend error:', error);
@@ -587,67 +938,173 @@ router.post('/add', (req, res) => {
     }
 });
 
-// Get user's friends
-router.get('/list/:telegram_id', (req, res) => {
+// Import a batch of referrals in one transaction; operators only, since
+// every pair credits both players
+router.post('/import', requireAdmin, importBody, (req, res) => {
     try {
-        const { telegram_id } = req.params;
-        const db = getDatabase();
+        const pairs = req.body.referrals.map((entry) => [entry.user_telegram_id, entry.friend_telegram_id]);
 
-        db.get('SELECT id FROM users WHERE telegram_id = ?', [telegram_id], (err, user) => {
-            if (err || !user) {
-                return res.status(404).json({ error: 'User not found' });
+        importReferrals(pairs, (err, imported) => {
+            if (err) {
+                return res.status(500).json({ error: 'Failed to import referrals' });
             }
 
-            db.all(`
-                SELECT 
-                    u.telegram_id,
-                    u.username,
-                    u.first_name,
-                    gp.total_earned,
-                    f.created_at as friend_since
-                FROM friends f
-                JOIN users u ON f.friend_id = u.id
-                JOIN game_progress gp ON u.id = gp.user_id
-                WHERE f.user_id = ?
-                ORDER BY gp.total_earned DESC
-            `, [user.id], (err, friends) => {
-                if (err) {
-                    return res.status(500).json({ error: 'Database error' });
-                }
+            const referrers = [...new Set(pairs.map(([userTelegramId]) => String(userTelegramId)))];
+            referrers.forEach((telegramId) => invalidate('friends', telegramId));
 
-                res.json(friends);
+            statements.all('friendCountsByTelegramId', [JSON.stringify(referrers)], (err, counts) => {
+                if (!err) {
+                    evaluateTasks(counts.map((row) => ({ userId: row.user_id, input: 'friends', from: 0, to: row.count })));
+                }
             });
+
+            res.json({ success: true, received: pairs.length, imported });
         });
     } catch (error) {
-        console.error('Get friends error:', error);
+        console.error('Import referrals error:', error);
         res.status(500).json({ error: 'Server error' });
     }
 });
 
-module.exports = router;
-"""
+// Referral stats per level of a player's referral tree; level 1 is the
+// players they referred themselves
+router.get('/referrals/:telegram_id', cacheResponse('referrals', CACHE_TTL), (req, res) => {
+    try {
+        const depth = Math.min(Math.max(parseInt(req.query.depth) || 3, 1), MAX_REFERRAL_DEPTH);
 
-# 8. Environment file
-env_file = """
+        resolveUserId(req.params.telegram_id, (err, userId) => {
+            if (err || !userId) {
+                return res.status(404).json({ error: 'User not found' });
+            }
+
+            statements.all('referralLevels', [userId, depth], (err, levels) => {
+                if (err) {
+                    return res.status(500).json({ error: 'Database error' });
+                }
+
+                res.json({
+                    players: levels.reduce((sum, level) => sum + level.players, 0),
+                    total_earned: levels.reduce((sum, level) => sum + level.total_earned, 0),
+                    levels
+                });
+            });
+        });
+    } catch (error) {
+        console.error('Get referrals error:', error);
+        res.status(500).json({ error: 'Server error' });
+    }
+});
+
+// Get user's friends
+router.get('/list/:telegram_id', cacheResponse('friends', CACHE_TTL, {
+    key: (req) => req.params.telegram_id
+}), (req, res) => {
+    try {
+        const { telegram_id } = req.params;
+
+        resolveUserId(telegram_id, (err, userId) => {
+            if (err || !userId) {
+                return res.status(404).json({ error: 'User not found' });
+            }
+
+            const fetchPage = (after, callback) => statements.all('friendsPage', [
+                userId,
+                after ? after.total_earned : null,
+                after ? after.user_id : null,
+                STREAM_CHUNK_SIZE
+            ], callback);
+
+            fetchPage(null, (err, friends) => {
+                if (err) {
+                    return res.status(500).json({ error: 'Database error' });
+                }
+
+                // Lists that fit in one chunk are sent (and cached) whole;
+                // longer ones are streamed a chunk at a time
+                if (friends.length < STREAM_CHUNK_SIZE) {
+                    return res.json(friends.map(toFriend));
+                }
+
+                streamJsonArray(res, friends, fetchPage, toFriend);
+            });
+        });
+    } catch (error) {
+        console.error('Get friends error:', error);
+        res.status(500).json({ error: 'Server error' });
+    }
+});
+
+module.exports = router;
+"""
+
+# 8. Environment file
+env_file = """
 # Server Configuration
 PORT=3000
 NODE_ENV=production
 
+# Cluster mode: number of HTTP workers ('max' = one per CPU, 0 = single process)
+CLUSTER_WORKERS=0
+
 # Telegram Bot Configuration
 BOT_TOKEN=your_bot_token_here
+# Seconds a signed initData stays valid after its auth_date
+INIT_DATA_MAX_AGE=86400
+INIT_DATA_CACHE_SIZE=20000
 
 # Frontend URL (Telegram WebApp)
 FRONTEND_URL=https://t.me
 
 # JWT Secret for token generation
 JWT_SECRET=your-super-secret-jwt-key-change-this-in-production
+JWT_EXPIRES_IN=7d
+
+# Bearer token for operator routes such as POST /api/friends/import (empty = disabled)
+ADMIN_TOKEN=
 
 # Database Configuration
 DATABASE_PATH=./nzi_coin.db
+DB_READ_POOL_SIZE=4
+DB_CACHE_SIZE_KB=20000
+DB_MMAP_SIZE=268435456
+DB_BUSY_TIMEOUT=5000
+
+# Caching
+USER_CACHE_SIZE=100000
+RESPONSE_CACHE_SIZE=10000
+LEADERBOARD_CACHE_TTL=5000
+FRIENDS_CACHE_TTL=30000
+
+# Leaderboard
+# snapshot: periodic materialized table; index: live in-memory ranking
+LEADERBOARD_SOURCE=snapshot
+LEADERBOARD_SNAPSHOT_INTERVAL=60000
+LEADERBOARD_MAX_PAGE_SIZE=100
+
+# Archiving: players inactive this many days move to cold tables until they log in
+ARCHIVE_INACTIVE_DAYS=30
+ARCHIVE_INTERVAL=3600000
+ARCHIVE_BATCH_SIZE=1000
 
 # Rate Limiting
 RATE_LIMIT_WINDOW=900000
 RATE_LIMIT_MAX=100
+RATE_LIMIT_TABLE_SIZE=262144
+
+# Tap Ingestion
+TAP_FLUSH_INTERVAL=1000
+MAX_TAPS_PER_BATCH=500
+MAX_REFERRALS_PER_IMPORT=1000
+
+# Benchmark (npm run bench:seed / npm run bench)
+BENCH_USERS=10000
+BENCH_FRIENDS_PER_USER=5
+BENCH_URL=http://localhost:3000
+BENCH_DURATION=30000
+BENCH_CONCURRENCY=50
+
+# Monitoring (leave empty to serve /metrics without a token)
+METRICS_TOKEN=
 
 # Security
 CORS_ORIGIN=https://t.me
@@ -659,13 +1116,17 @@ module.exports = {
   apps: [{
     name: 'nzi-coin-backend',
     script: 'server.js',
+    // Keep a single PM2 instance: server.js forks its own HTTP workers
+    // (CLUSTER_WORKERS) and funnels their writes through one coordinator
     instances: 1,
+    exec_mode: 'fork',
     autorestart: true,
     watch: false,
     max_memory_restart: '1G',
     env: {
       NODE_ENV: 'production',
-      PORT: 3000
+      PORT: 3000,
+      CLUSTER_WORKERS: 'max'
     },
     error_file: './logs/err.log',
     out_file: './logs/out.log',
@@ -675,44 +1136,3572 @@ module.exports = {
 };
 """
 
-# Write all files
-files_created = []
+# 10. Tap write-behind buffer
+write_buffer = """
+const { getDatabase } = require('./init');
+const coordinator = require('./coordinator');
+const { currentEnergySql, energyClockSql } = require('./statements');
+const { updateScores } = require('../services/rankIndex');
+const { evaluateTasks } = require('../services/taskEngine');
+const { startQuery } = require('../services/metrics');
 
-with open('package.json', 'w') as f:
-    f.write(package_json)
-    files_created.append('package.json')
+const FLUSH_INTERVAL = parseInt(process.env.TAP_FLUSH_INTERVAL) || 1000;
+const ROWS_PER_STATEMENT = 400; // 2 bound parameters per row, stays under SQLite's 999 limit
 
-with open('server.js', 'w') as f:
-    f.write(server_js)
-    files_created.append('server.js')
+let pending = new Map();
+let activeUsers = new Set();
+let flushTimer = null;
+let flushing = false;
 
-with open('database_init.js', 'w') as f:
-    f.write(database_init)
-    files_created.append('database_init.js')
+// Fold a tap delta into the pending buffer, coalescing per user. Cluster
+// workers hand the delta to the coordinator, which owns the buffer.
+function queueTaps(userId, taps) {
+    if (coordinator.isWorker()) {
+        return coordinator.request('taps', { userId, taps });
+    }
 
-with open('auth_routes.js', 'w') as f:
-    f.write(auth_routes)
-    files_created.append('auth_routes.js')
+    pending.set(userId, (pending.get(userId) || 0) + taps);
+}
 
-with open('game_routes.js', 'w') as f:
-    f.write(game_routes)
-    files_created.append('game_routes.js')
+coordinator.handle('taps', ({ userId, taps }) => queueTaps(userId, taps));
 
-with open('leaderboard_routes.js', 'w') as f:
-    f.write(leaderboard_routes)
-    files_created.append('leaderboard_routes.js')
+// Mark a player as seen; last_active is written with the next flush
+function queueLastActive(userId) {
+    if (coordinator.isWorker()) {
+        return coordinator.request('active', userId);
+    }
 
-with open('friends_routes.js', 'w') as f:
-    f.write(friends_routes)
-    files_created.append('friends_routes.js')
+    activeUsers.add(userId);
+}
 
-with open('.env.example', 'w') as f:
-    f.write(env_file)
-    files_created.append('.env.example')
+coordinator.handle('active', queueLastActive);
 
-with open('ecosystem.config.js', 'w') as f:
-    f.write(ecosystem_file)
-    files_created.append('ecosystem.config.js')
+// Apply many users' tap deltas in one statement; taps beyond the
+// player's current (regenerated) energy are discarded server-side
+function buildFlushStatement(rowCount) {
+    const values = new Array(rowCount).fill('(?, ?)').join(', ');
+    const energy = currentEnergySql();
+    const spent = `MIN(d.column2, ${energy})`;
+
+    return `
+        UPDATE game_progress
+        SET coins = coins + ${spent} * coins_per_tap,
+            total_earned = total_earned + ${spent} * coins_per_tap,
+            total_taps = total_taps + ${spent},
+            energy = ${energy} - ${spent},
+            energy_updated_at = ${energyClockSql()},
+            version = version + 1,
+            last_save = CURRENT_TIMESTAMP
+        FROM (VALUES ${values}) AS d
+        WHERE game_progress.user_id = d.column1
+        RETURNING user_id, total_earned, total_taps
+    `;
+}
+
+// Callers waiting for a flush that starts after the one in progress
+let waiting = [];
+
+function publishApplied(batch, updated) {
+    updateScores(updated.map((row) => ({
+        userId: row.user_id,
+        totalEarned: row.total_earned,
+        totalTaps: row.total_taps
+    })));
+
+    // At most the buffered taps were applied, so the counter started no
+    // lower than that
+    evaluateTasks(updated.map((row) => ({
+        userId: row.user_id,
+        input: 'total_taps',
+        from: row.total_taps - batch.get(row.user_id),
+        to: row.total_taps
+    })));
+}
+
+// Write every buffered delta and last_active mark to SQLite. Each chunk is
+// a single UPDATE, atomic on its own; no explicit transaction is opened,
+// since the writer connection is shared with the prepared statements and
+// their writes would otherwise land inside it. A chunk that fails is
+// queued again. With a callback, a call made while a flush is running
+// waits for it and then flushes again, so nothing buffered meanwhile is
+// left out.
+function flushTaps(callback) {
+    const done = callback || (() => {});
+
+    if (flushing) {
+        if (callback) {
+            waiting.push(callback);
+        }
+        return;
+    }
+
+    if (pending.size === 0 && activeUsers.size === 0) {
+        return done();
+    }
+
+    const batch = pending;
+    const active = Array.from(activeUsers);
+    pending = new Map();
+    activeUsers = new Set();
+    flushing = true;
+
+    const rows = Array.from(batch.entries());
+    const db = getDatabase();
+    const finishQuery = startQuery('tapFlush');
+    const applied = [];
+    let firstError = null;
+    let remaining = Math.ceil(rows.length / ROWS_PER_STATEMENT) + (active.length > 0 ? 1 : 0);
+
+    const settle = (err) => {
+        if (err && !firstError) {
+            firstError = err;
+        }
+        if (--remaining > 0) {
+            return;
+        }
+
+        finishQuery();
+        if (applied.length > 0) {
+            publishApplied(batch, applied);
+        }
+
+        flushing = false;
+        done(firstError);
+
+        const callbacks = waiting;
+        waiting = [];
+        if (callbacks.length > 0) {
+            flushTaps((flushErr) => callbacks.forEach((waiter) => waiter(flushErr)));
+        }
+    };
+
+    if (active.length > 0) {
+        db.run(
+            'UPDATE users SET last_active = CURRENT_TIMESTAMP WHERE id IN (SELECT value FROM json_each(?))',
+            [JSON.stringify(active)],
+            (err) => {
+                if (err) {
+                    console.error('Last active flush error:', err);
+                    active.forEach(queueLastActive);
+                }
+                settle(err);
+            }
+        );
+    }
+
+    for (let i = 0; i < rows.length; i += ROWS_PER_STATEMENT) {
+        const chunk = rows.slice(i, i + ROWS_PER_STATEMENT);
+
+        db.all(buildFlushStatement(chunk.length), chunk.flat(), (err, updated) => {
+            if (err) {
+                // Nothing in the chunk was applied: queue its deltas again
+                console.error('Tap flush error:', err);
+                chunk.forEach(([userId, taps]) => queueTaps(userId, taps));
+            } else {
+                applied.push(...updated);
+            }
+            settle(err);
+        });
+    }
+}
+
+function startTapFlusher() {
+    if (!flushTimer) {
+        flushTimer = setInterval(flushTaps, FLUSH_INTERVAL);
+    }
+}
+
+function stopTapFlusher() {
+    clearInterval(flushTimer);
+    flushTimer = null;
+}
+
+module.exports = {
+    queueTaps,
+    queueLastActive,
+    flushTaps,
+    startTapFlusher,
+    stopTapFlusher
+};
+"""
+
+# 11. Leaderboard rank index
+rank_index = """
+const statements = require('../database/statements');
+const coordinator = require('../database/coordinator');
+const { useSnapshot } = require('./leaderboardSnapshot');
+
+const MAX_LEVEL = 32;
+const LEVEL_PROBABILITY = 0.25;
+
+// Indexable skip list ordered by total_earned descending, ties by user id.
+// Every forward pointer stores its span so positions resolve in O(log n).
+const head = createNode(null, MAX_LEVEL);
+const byUserId = new Map();
+const byTelegramId = new Map();
+let level = 1;
+let length = 0;
+let ready = false;
+
+function createNode(player, nodeLevel) {
+    return {
+        player,
+        next: new Array(nodeLevel).fill(null),
+        span: new Array(nodeLevel).fill(0)
+    };
+}
+
+function randomLevel() {
+    let nodeLevel = 1;
+    while (nodeLevel < MAX_LEVEL && Math.random() < LEVEL_PROBABILITY) {
+        nodeLevel++;
+    }
+    return nodeLevel;
+}
+
+function precedes(node, totalEarned, userId) {
+    const player = node.player;
+    return player.totalEarned > totalEarned ||
+        (player.totalEarned === totalEarned && player.userId < userId);
+}
+
+function atOrBefore(node, totalEarned, userId) {
+    const player = node.player;
+    return player.totalEarned > totalEarned ||
+        (player.totalEarned === totalEarned && player.userId <= userId);
+}
+
+function insertNode(player) {
+    const update = new Array(MAX_LEVEL);
+    const position = new Array(MAX_LEVEL);
+    let x = head;
+
+    for (let i = level - 1; i >= 0; i--) {
+        position[i] = i === level - 1 ? 0 : position[i + 1];
+        while (x.next[i] && precedes(x.next[i], player.totalEarned, player.userId)) {
+            position[i] += x.span[i];
+            x = x.next[i];
+        }
+        update[i] = x;
+    }
+
+    const nodeLevel = randomLevel();
+    if (nodeLevel > level) {
+        for (let i = level; i < nodeLevel; i++) {
+            position[i] = 0;
+            update[i] = head;
+            head.span[i] = length;
+        }
+        level = nodeLevel;
+    }
+
+    const node = createNode(player, nodeLevel);
+    for (let i = 0; i < nodeLevel; i++) {
+        node.next[i] = update[i].next[i];
+        update[i].next[i] = node;
+        node.span[i] = update[i].span[i] - (position[0] - position[i]);
+        update[i].span[i] = position[0] - position[i] + 1;
+    }
+    for (let i = nodeLevel; i < level; i++) {
+        update[i].span[i]++;
+    }
+
+    length++;
+    return node;
+}
+
+function removeNode(node) {
+    const update = new Array(MAX_LEVEL);
+    const { totalEarned, userId } = node.player;
+    let x = head;
+
+    for (let i = level - 1; i >= 0; i--) {
+        while (x.next[i] && precedes(x.next[i], totalEarned, userId)) {
+            x = x.next[i];
+        }
+        update[i] = x;
+    }
+
+    for (let i = 0; i < level; i++) {
+        if (update[i].next[i] === node) {
+            update[i].span[i] += node.span[i] - 1;
+            update[i].next[i] = node.next[i];
+        } else {
+            update[i].span[i]--;
+        }
+    }
+
+    while (level > 1 && !head.next[level - 1]) {
+        level--;
+    }
+    length--;
+}
+
+// Competition rank (same as SQL RANK()): 1 + players with a higher score
+function rankOfScore(totalEarned) {
+    let x = head;
+    let ahead = 0;
+
+    for (let i = level - 1; i >= 0; i--) {
+        while (x.next[i] && x.next[i].player.totalEarned > totalEarned) {
+            ahead += x.span[i];
+            x = x.next[i];
+        }
+    }
+    return ahead + 1;
+}
+
+function applyPlayer(player) {
+    const existing = byUserId.get(player.userId);
+
+    if (existing) {
+        if (player.username !== undefined) existing.player.username = player.username;
+        if (player.firstName !== undefined) existing.player.firstName = player.firstName;
+        applyScore(player.userId, player.totalEarned, player.totalTaps);
+        return;
+    }
+
+    const node = insertNode({
+        userId: player.userId,
+        telegramId: String(player.telegramId),
+        username: player.username || null,
+        firstName: player.firstName || null,
+        totalEarned: player.totalEarned || 0,
+        totalTaps: player.totalTaps || 0
+    });
+    byUserId.set(node.player.userId, node);
+    byTelegramId.set(node.player.telegramId, node);
+}
+
+function applyRemoval(userId) {
+    const node = byUserId.get(userId);
+    if (!node) {
+        return;
+    }
+
+    removeNode(node);
+    byUserId.delete(userId);
+    byTelegramId.delete(node.player.telegramId);
+}
+
+// Record a score change; only re-links the node when total_earned moves
+function applyScore(userId, totalEarned, totalTaps) {
+    const node = byUserId.get(userId);
+    if (!node) {
+        return;
+    }
+
+    const player = node.player;
+    if (totalTaps !== undefined) {
+        player.totalTaps = totalTaps;
+    }
+    if (totalEarned === undefined || totalEarned === player.totalEarned) {
+        return;
+    }
+
+    removeNode(node);
+    player.totalEarned = totalEarned;
+
+    const moved = insertNode(player);
+    byUserId.set(userId, moved);
+    byTelegramId.set(player.telegramId, moved);
+}
+
+// Mutations are published so every cluster worker's index stays in step.
+// In snapshot mode the index is never loaded or read, so nothing is sent.
+function upsertPlayer(player) {
+    if (!useSnapshot()) {
+        coordinator.publish('rank:player', player);
+    }
+}
+
+function updateScores(updates) {
+    if (!useSnapshot()) {
+        coordinator.publish('rank:scores', updates);
+    }
+}
+
+function updateScore(userId, totalEarned, totalTaps) {
+    updateScores([{ userId, totalEarned, totalTaps }]);
+}
+
+function removePlayers(userIds) {
+    if (!useSnapshot()) {
+        coordinator.publish('rank:remove', userIds);
+    }
+}
+
+if (!useSnapshot()) {
+    coordinator.subscribe('rank:player', applyPlayer);
+    coordinator.subscribe('rank:scores', (updates) => {
+        updates.forEach((update) => applyScore(update.userId, update.totalEarned, update.totalTaps));
+    });
+    coordinator.subscribe('rank:remove', (userIds) => userIds.forEach(applyRemoval));
+}
+
+// 1-based position of the last player at or before (totalEarned, userId)
+function positionOf(totalEarned, userId) {
+    let x = head;
+    let position = 0;
+
+    for (let i = level - 1; i >= 0; i--) {
+        while (x.next[i] && atOrBefore(x.next[i], totalEarned, userId)) {
+            position += x.span[i];
+            x = x.next[i];
+        }
+    }
+    return { node: x, position };
+}
+
+function nodeAtPosition(position) {
+    let x = head;
+    let traversed = 0;
+
+    for (let i = level - 1; i >= 0; i--) {
+        while (x.next[i] && traversed + x.span[i] <= position) {
+            traversed += x.span[i];
+            x = x.next[i];
+        }
+        if (traversed === position) {
+            return x;
+        }
+    }
+    return null;
+}
+
+function toRow(player, rank) {
+    return {
+        user_id: player.userId,
+        telegram_id: player.telegramId,
+        username: player.username,
+        first_name: player.firstName,
+        total_earned: player.totalEarned,
+        total_taps: player.totalTaps,
+        rank
+    };
+}
+
+// Up to `count` rows starting at `node`, which sits at `position`
+function collectRows(node, position, count) {
+    const rows = [];
+    let rank = node ? rankOfScore(node.player.totalEarned) : 0;
+    let previousScore = node ? node.player.totalEarned : null;
+
+    while (node && rows.length < count) {
+        if (node.player.totalEarned !== previousScore) {
+            rank = position + rows.length;
+            previousScore = node.player.totalEarned;
+        }
+        rows.push(toRow(node.player, rank));
+        node = node.next[0];
+    }
+    return rows;
+}
+
+function getTop(limit) {
+    return collectRows(head.next[0], 1, limit);
+}
+
+// Keyset page: the `limit` players ranked after the (totalEarned, userId)
+// cursor. Costs O(log n + limit) however deep the cursor is.
+function getPage(after, limit) {
+    if (!after) {
+        return getTop(limit);
+    }
+
+    const { node, position } = positionOf(after.totalEarned, after.userId);
+    return collectRows(node.next[0], position + 1, limit);
+}
+
+// The player plus up to `distance` players either side of them
+function getAround(telegramId, distance) {
+    const node = byTelegramId.get(String(telegramId));
+    if (!node) {
+        return null;
+    }
+
+    const { position } = positionOf(node.player.totalEarned, node.player.userId);
+    const start = Math.max(1, position - distance);
+    return collectRows(nodeAtPosition(start), start, position + distance - start + 1);
+}
+
+function getRank(telegramId) {
+    const node = byTelegramId.get(String(telegramId));
+    if (!node) {
+        return null;
+    }
+
+    const { totalEarned, totalTaps } = node.player;
+    return {
+        rank: rankOfScore(totalEarned),
+        total_earned: totalEarned,
+        total_taps: totalTaps
+    };
+}
+
+// Populate the index from the database once at startup
+function loadRankIndex(callback) {
+    statements.each('rankIndexPlayers', [], (err, row) => {
+        if (!err) {
+            applyPlayer({
+                userId: row.id,
+                telegramId: row.telegram_id,
+                username: row.username,
+                firstName: row.first_name,
+                totalEarned: row.total_earned,
+                totalTaps: row.total_taps
+            });
+        }
+    }, (err, count) => {
+        if (err) {
+            console.error('Rank index load error:', err);
+        } else {
+            ready = true;
+            console.log(`Rank index loaded with ${count} players`);
+        }
+        if (callback) callback(err);
+    });
+}
+
+function isReady() {
+    return ready;
+}
+
+module.exports = {
+    loadRankIndex,
+    isReady,
+    upsertPlayer,
+    updateScore,
+    updateScores,
+    removePlayers,
+    getTop,
+    getPage,
+    getAround,
+    getRank
+};
+"""
+
+# 12. Migration runner
+migrations_init = """
+const sqlite3 = require('sqlite3').verbose();
+const path = require('path');
+
+// Link a referred player (and anyone they referred) under a referrer and
+// all of the referrer's ancestors. A player keeps their first referrer,
+// and a link that would make someone their own ancestor is skipped. With
+// `maxDepth`, pairs more than that many levels apart are not stored; the
+// stored pairs then no longer show every ancestor, so `walkReferrers`
+// checks for a cycle by following the referrer's depth-1 links instead.
+function attachReferralSql(referrer, referred, { maxDepth, walkReferrers } = {}) {
+    const depthLimit = maxDepth ? `\\n                    AND a.depth + d.depth + 1 <= ${maxDepth}` : '';
+    const cycleGuard = walkReferrers
+        ? `AND NOT EXISTS (
+                        WITH RECURSIVE referrers(id) AS (
+                            SELECT ${referrer}
+                            UNION
+                            SELECT t.ancestor_id FROM referral_tree t, referrers
+                            WHERE t.descendant_id = referrers.id AND t.depth = 1
+                        )
+                        SELECT 1 FROM referrers WHERE id = ${referred}
+                    )`
+        : `AND NOT EXISTS (
+                        SELECT 1 FROM referral_tree WHERE ancestor_id = ${referred} AND descendant_id = ${referrer}
+                    )`;
+    return `INSERT INTO referral_tree (ancestor_id, descendant_id, depth)
+                SELECT a.ancestor_id, d.descendant_id, a.depth + d.depth + 1
+                FROM (
+                    SELECT ${referrer} AS ancestor_id, 0 AS depth
+                    UNION ALL
+                    SELECT ancestor_id, depth FROM referral_tree WHERE descendant_id = ${referrer}
+                ) a, (
+                    SELECT ${referred} AS descendant_id, 0 AS depth
+                    UNION ALL
+                    SELECT descendant_id, depth FROM referral_tree WHERE ancestor_id = ${referred}
+                ) d
+                WHERE ${referrer} != ${referred}
+                    AND NOT EXISTS (SELECT 1 FROM referral_tree WHERE descendant_id = ${referred} AND depth = 1)
+                    ${cycleGuard}${depthLimit}`;
+}
+
+// Deepest level /friends/referrals can ask for (MAX_REFERRAL_DEPTH there)
+const MAX_REFERRAL_DEPTH = 10;
+
+// Ordered schema changes. Never edit a migration once it has shipped;
+// append a new version instead.
+const migrations = [
+    {
+        version: 1,
+        name: 'initial_schema',
+        statements: [
+            `CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                telegram_id TEXT UNIQUE NOT NULL,
+                username TEXT,
+                first_name TEXT,
+                last_name TEXT,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                last_active DATETIME DEFAULT CURRENT_TIMESTAMP
+            )`,
+            `CREATE TABLE IF NOT EXISTS game_progress (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                coins INTEGER DEFAULT 0,
+                energy INTEGER DEFAULT 100,
+                max_energy INTEGER DEFAULT 100,
+                coins_per_tap INTEGER DEFAULT 1,
+                energy_regen_rate INTEGER DEFAULT 1800000,
+                total_earned INTEGER DEFAULT 0,
+                total_taps INTEGER DEFAULT 0,
+                last_save DATETIME DEFAULT CURRENT_TIMESTAMP,
+                boosters TEXT DEFAULT '{"energyCapacity":0,"energyRegen":0,"coinsPerTap":0}',
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )`,
+            `CREATE TABLE IF NOT EXISTS friends (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                friend_id INTEGER NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                bonus_claimed BOOLEAN DEFAULT FALSE,
+                FOREIGN KEY (user_id) REFERENCES users (id),
+                FOREIGN KEY (friend_id) REFERENCES users (id),
+                UNIQUE(user_id, friend_id)
+            )`,
+            `CREATE TABLE IF NOT EXISTS user_tasks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                task_id TEXT NOT NULL,
+                completed BOOLEAN DEFAULT FALSE,
+                progress INTEGER DEFAULT 0,
+                completed_at DATETIME,
+                FOREIGN KEY (user_id) REFERENCES users (id),
+                UNIQUE(user_id, task_id)
+            )`,
+            `CREATE VIEW IF NOT EXISTS leaderboard AS
+            SELECT
+                u.telegram_id,
+                u.username,
+                u.first_name,
+                gp.total_earned,
+                gp.total_taps,
+                RANK() OVER (ORDER BY gp.total_earned DESC) as rank
+            FROM users u
+            JOIN game_progress gp ON u.id = gp.user_id
+            ORDER BY gp.total_earned DESC`
+        ]
+    },
+    {
+        version: 2,
+        name: 'hot_path_indexes',
+        statements: [
+            // Keep the oldest progress row per user before enforcing uniqueness
+            `DELETE FROM game_progress
+            WHERE id NOT IN (SELECT MIN(id) FROM game_progress GROUP BY user_id)`,
+            `CREATE UNIQUE INDEX IF NOT EXISTS idx_game_progress_user_id
+            ON game_progress (user_id)`,
+            // Covers the leaderboard ordering without touching the table rows
+            `CREATE INDEX IF NOT EXISTS idx_game_progress_total_earned
+            ON game_progress (total_earned DESC, user_id, total_taps)`,
+            // friends(user_id) is already covered by UNIQUE(user_id, friend_id)
+            `CREATE INDEX IF NOT EXISTS idx_friends_friend_id
+            ON friends (friend_id, user_id)`
+        ]
+    },
+    {
+        version: 3,
+        name: 'progress_version',
+        statements: [
+            // Bumped by every write to the row; /save compares and sets it
+            `ALTER TABLE game_progress ADD COLUMN version INTEGER NOT NULL DEFAULT 0`
+        ]
+    },
+    {
+        version: 4,
+        name: 'energy_clock',
+        statements: [
+            // Unix time in ms that the stored energy value is current as of
+            `ALTER TABLE game_progress ADD COLUMN energy_updated_at INTEGER NOT NULL DEFAULT 0`,
+            `UPDATE game_progress
+            SET energy_updated_at = CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER)`
+        ]
+    },
+    {
+        version: 5,
+        name: 'leaderboard_snapshot',
+        statements: [
+            // Two slots: the job refills the inactive one, then points
+            // leaderboard_snapshot_meta.slot at it
+            `CREATE TABLE leaderboard_snapshot (
+                slot INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                rank INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                telegram_id TEXT NOT NULL,
+                username TEXT,
+                first_name TEXT,
+                total_earned INTEGER NOT NULL,
+                total_taps INTEGER NOT NULL,
+                PRIMARY KEY (slot, position)
+            ) WITHOUT ROWID`,
+            `CREATE UNIQUE INDEX idx_leaderboard_snapshot_telegram_id
+            ON leaderboard_snapshot (slot, telegram_id)`,
+            `CREATE TABLE leaderboard_snapshot_meta (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                slot INTEGER NOT NULL,
+                taken_at INTEGER,
+                player_count INTEGER NOT NULL DEFAULT 0
+            )`,
+            `INSERT INTO leaderboard_snapshot_meta (id, slot) VALUES (1, 0)`
+        ]
+    },
+    {
+        version: 6,
+        name: 'leaderboard_keyset',
+        statements: [
+            // Seek target for (total_earned, user_id) page cursors
+            `CREATE INDEX idx_leaderboard_snapshot_score
+            ON leaderboard_snapshot (slot, total_earned DESC, user_id)`
+        ]
+    },
+    {
+        version: 7,
+        name: 'referral_bonus_trigger',
+        statements: [
+            // Credit both players inside the INSERT's own transaction; an
+            // ignored duplicate inserts nothing and credits nothing
+            `CREATE TRIGGER friends_referral_bonus AFTER INSERT ON friends
+            BEGIN
+                UPDATE game_progress
+                SET coins = coins + 500, version = version + 1
+                WHERE user_id IN (NEW.user_id, NEW.friend_id);
+                UPDATE friends SET bonus_claimed = TRUE WHERE id = NEW.id;
+            END`
+        ]
+    },
+    {
+        version: 8,
+        name: 'task_rewards',
+        statements: [
+            // Reward paid for the completion, credited by the triggers below
+            `ALTER TABLE user_tasks ADD COLUMN reward INTEGER NOT NULL DEFAULT 0`,
+            `CREATE TRIGGER user_tasks_reward AFTER INSERT ON user_tasks
+            WHEN NEW.completed
+            BEGIN
+                UPDATE game_progress
+                SET coins = coins + NEW.reward,
+                    total_earned = total_earned + NEW.reward,
+                    version = version + 1
+                WHERE user_id = NEW.user_id;
+            END`,
+            // Daily tasks are completed again by moving completed_at forward
+            `CREATE TRIGGER user_tasks_repeat_reward AFTER UPDATE OF completed_at ON user_tasks
+            WHEN NEW.completed
+            BEGIN
+                UPDATE game_progress
+                SET coins = coins + NEW.reward,
+                    total_earned = total_earned + NEW.reward,
+                    version = version + 1
+                WHERE user_id = NEW.user_id;
+            END`
+        ]
+    },
+    {
+        version: 9,
+        name: 'login_upsert',
+        statements: [
+            // Every player gets their progress row in the INSERT's own
+            // transaction, so login is a single statement
+            `INSERT INTO game_progress (user_id, energy_updated_at)
+            SELECT id, CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER)
+            FROM users
+            WHERE id NOT IN (SELECT user_id FROM game_progress)`,
+            `CREATE TRIGGER users_create_progress AFTER INSERT ON users
+            BEGIN
+                INSERT INTO game_progress (user_id, energy_updated_at)
+                VALUES (NEW.id, CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER))
+                ON CONFLICT (user_id) DO NOTHING;
+            END`
+        ]
+    },
+    {
+        version: 10,
+        name: 'cold_storage',
+        statements: [
+            // Players inactive for a while are moved here by the archive
+            // job, keeping their ids, and moved back when they log in
+            `CREATE TABLE users_archive (
+                id INTEGER PRIMARY KEY,
+                telegram_id TEXT UNIQUE NOT NULL,
+                username TEXT,
+                first_name TEXT,
+                last_name TEXT,
+                created_at DATETIME,
+                last_active DATETIME,
+                archived_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )`,
+            `CREATE TABLE game_progress_archive (
+                user_id INTEGER PRIMARY KEY,
+                id INTEGER NOT NULL,
+                coins INTEGER,
+                energy INTEGER,
+                max_energy INTEGER,
+                coins_per_tap INTEGER,
+                energy_regen_rate INTEGER,
+                total_earned INTEGER,
+                total_taps INTEGER,
+                last_save DATETIME,
+                boosters TEXT,
+                version INTEGER NOT NULL,
+                energy_updated_at INTEGER NOT NULL
+            )`,
+            `CREATE INDEX idx_users_last_active ON users (last_active, id)`,
+            // Re-inserting an archived id brings its progress back before
+            // the row lands, so the login's RETURNING already sees it
+            `CREATE TRIGGER users_restore_progress BEFORE INSERT ON users
+            WHEN NEW.id IN (SELECT user_id FROM game_progress_archive)
+            BEGIN
+                INSERT INTO game_progress (id, user_id, coins, energy, max_energy, coins_per_tap, energy_regen_rate,
+                    total_earned, total_taps, last_save, boosters, version, energy_updated_at)
+                SELECT id, user_id, coins, energy, max_energy, coins_per_tap, energy_regen_rate,
+                    total_earned, total_taps, last_save, boosters, version, energy_updated_at
+                FROM game_progress_archive
+                WHERE user_id = NEW.id;
+                DELETE FROM game_progress_archive WHERE user_id = NEW.id;
+            END`,
+            // Runs after RETURNING, which reports the restore by finding
+            // the archived row still present
+            `CREATE TRIGGER users_restore_cleanup AFTER INSERT ON users
+            BEGIN
+                DELETE FROM users_archive WHERE id = NEW.id;
+            END`
+        ]
+    },
+    {
+        version: 11,
+        name: 'referral_tree',
+        statements: [
+            // Friends the player has added, kept by friends_referral_bonus
+            `ALTER TABLE game_progress ADD COLUMN friend_count INTEGER NOT NULL DEFAULT 0`,
+            `ALTER TABLE game_progress_archive ADD COLUMN friend_count INTEGER NOT NULL DEFAULT 0`,
+            `UPDATE game_progress
+            SET friend_count = (SELECT COUNT(*) FROM friends WHERE friends.user_id = game_progress.user_id)`,
+            `UPDATE game_progress_archive
+            SET friend_count = (SELECT COUNT(*) FROM friends WHERE friends.user_id = game_progress_archive.user_id)`,
+            `DROP TRIGGER friends_referral_bonus`,
+            `CREATE TRIGGER friends_referral_bonus AFTER INSERT ON friends
+            BEGIN
+                UPDATE game_progress
+                SET coins = coins + 500,
+                    friend_count = friend_count + (user_id = NEW.user_id),
+                    version = version + 1
+                WHERE user_id IN (NEW.user_id, NEW.friend_id);
+                UPDATE friends SET bonus_claimed = TRUE WHERE id = NEW.id;
+            END`,
+            `DROP TRIGGER users_restore_progress`,
+            `CREATE TRIGGER users_restore_progress BEFORE INSERT ON users
+            WHEN NEW.id IN (SELECT user_id FROM game_progress_archive)
+            BEGIN
+                INSERT INTO game_progress (id, user_id, coins, energy, max_energy, coins_per_tap, energy_regen_rate,
+                    total_earned, total_taps, last_save, boosters, version, energy_updated_at, friend_count)
+                SELECT id, user_id, coins, energy, max_energy, coins_per_tap, energy_regen_rate,
+                    total_earned, total_taps, last_save, boosters, version, energy_updated_at, friend_count
+                FROM game_progress_archive
+                WHERE user_id = NEW.id;
+                DELETE FROM game_progress_archive WHERE user_id = NEW.id;
+            END`,
+            // Every (ancestor, descendant) pair of the referral tree with
+            // the number of levels between them; depth 1 is the referrer.
+            // Keyed for ranges over one player's descendants by level.
+            `CREATE TABLE referral_tree (
+                ancestor_id INTEGER NOT NULL,
+                descendant_id INTEGER NOT NULL,
+                depth INTEGER NOT NULL,
+                PRIMARY KEY (ancestor_id, depth, descendant_id)
+            ) WITHOUT ROWID`,
+            `CREATE INDEX idx_referral_tree_descendant
+            ON referral_tree (descendant_id, depth, ancestor_id)`,
+            // Rebuild the tree by replaying existing friendships in the
+            // order they were made, through the same rule as the trigger
+            `CREATE TABLE referral_replay (user_id INTEGER NOT NULL, friend_id INTEGER NOT NULL)`,
+            `CREATE TRIGGER referral_replay_attach AFTER INSERT ON referral_replay
+            BEGIN
+                ${attachReferralSql('NEW.user_id', 'NEW.friend_id')};
+            END`,
+            `INSERT INTO referral_replay (user_id, friend_id) SELECT user_id, friend_id FROM friends ORDER BY id`,
+            `DROP TABLE referral_replay`,
+            `CREATE TRIGGER friends_referral_tree AFTER INSERT ON friends
+            BEGIN
+                ${attachReferralSql('NEW.user_id', 'NEW.friend_id')};
+            END`
+        ]
+    },
+    {
+        version: 12,
+        name: 'normalize_boosters',
+        statements: [
+            // Early saves could store NULL, and json_set(NULL, ...) is NULL,
+            // so purchases on those rows charged without levelling up
+            `UPDATE game_progress
+            SET boosters = '{"energyCapacity":0,"energyRegen":0,"coinsPerTap":0}'
+            WHERE boosters IS NULL OR NOT json_valid(boosters)`,
+            `UPDATE game_progress_archive
+            SET boosters = '{"energyCapacity":0,"energyRegen":0,"coinsPerTap":0}'
+            WHERE boosters IS NULL OR NOT json_valid(boosters)`
+        ]
+    },
+    {
+        version: 13,
+        name: 'referral_tree_depth_limit',
+        statements: [
+            // Deeper pairs are never queried, and storing them made a long
+            // referral chain grow the table quadratically
+            `DROP TRIGGER friends_referral_tree`,
+            `CREATE TRIGGER friends_referral_tree AFTER INSERT ON friends
+            BEGIN
+                ${attachReferralSql('NEW.user_id', 'NEW.friend_id', { maxDepth: MAX_REFERRAL_DEPTH })};
+            END`,
+            `DELETE FROM referral_tree WHERE depth > ${MAX_REFERRAL_DEPTH}`
+        ]
+    },
+    {
+        version: 14,
+        name: 'archive_moves',
+        statements: [
+            // Inserting a player here moves them to the archive tables in
+            // the same statement, so the archive job's batch is picked once
+            // and moved completely without an explicit transaction
+            `CREATE TABLE archive_moves (
+                user_id INTEGER PRIMARY KEY,
+                telegram_id TEXT NOT NULL
+            )`,
+            `CREATE TRIGGER archive_moves_apply AFTER INSERT ON archive_moves
+            BEGIN
+                INSERT INTO users_archive (id, telegram_id, username, first_name, last_name, created_at, last_active)
+                SELECT id, telegram_id, username, first_name, last_name, created_at, last_active
+                FROM users
+                WHERE id = NEW.user_id;
+                INSERT INTO game_progress_archive (id, user_id, coins, energy, max_energy, coins_per_tap, energy_regen_rate,
+                    total_earned, total_taps, last_save, boosters, version, energy_updated_at, friend_count)
+                SELECT id, user_id, coins, energy, max_energy, coins_per_tap, energy_regen_rate,
+                    total_earned, total_taps, last_save, boosters, version, energy_updated_at, friend_count
+                FROM game_progress
+                WHERE user_id = NEW.user_id;
+                DELETE FROM game_progress WHERE user_id = NEW.user_id;
+                DELETE FROM users WHERE id = NEW.user_id;
+                DELETE FROM archive_moves WHERE user_id = NEW.user_id;
+            END`
+        ]
+    },
+    {
+        version: 15,
+        name: 'referral_cycle_guard',
+        statements: [
+            // Migration 13's trigger looked for the referrer among the
+            // referred player's stored descendants, which misses cycles
+            // longer than the depth limit
+            `DROP TRIGGER friends_referral_tree`,
+            `CREATE TRIGGER friends_referral_tree AFTER INSERT ON friends
+            BEGIN
+                ${attachReferralSql('NEW.user_id', 'NEW.friend_id', { maxDepth: MAX_REFERRAL_DEPTH, walkReferrers: true })};
+            END`
+        ]
+    }
+];
+
+function applyMigration(db, migration, callback) {
+    const script = [
+        'BEGIN',
+        ...migration.statements,
+        `INSERT INTO schema_migrations (version, name) VALUES (${migration.version}, '${migration.name}')`,
+        'COMMIT'
+    ].join(';\\n');
+
+    db.exec(script, (err) => {
+        if (err) {
+            return db.exec('ROLLBACK', () => callback(err));
+        }
+
+        console.log(`Applied migration ${migration.version} (${migration.name})`);
+        callback(null);
+    });
+}
+
+// Apply every migration not yet recorded in schema_migrations, in order.
+// Safe to call on every startup.
+function runMigrations(db, callback) {
+    db.run(`
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    `, (err) => {
+        if (err) {
+            return callback(err);
+        }
+
+        db.all('SELECT version FROM schema_migrations', [], (err, rows) => {
+            if (err) {
+                return callback(err);
+            }
+
+            const applied = new Set(rows.map((row) => row.version));
+            const pending = migrations.filter((migration) => !applied.has(migration.version));
+
+            const next = (index) => {
+                if (index >= pending.length) {
+                    return callback(null);
+                }
+
+                applyMigration(db, pending[index], (err) => {
+                    if (err) {
+                        console.error(`Migration ${pending[index].version} failed:`, err.message);
+                        return callback(err);
+                    }
+                    next(index + 1);
+                });
+            };
+
+            next(0);
+        });
+    });
+}
+
+// npm run migrate
+if (require.main === module) {
+    require('dotenv').config();
+    const dbPath = process.env.DATABASE_PATH || path.join(__dirname, '../nzi_coin.db');
+    const db = new sqlite3.Database(dbPath);
+
+    runMigrations(db, (err) => {
+        if (err) {
+            process.exitCode = 1;
+        }
+        db.close();
+    });
+}
+
+module.exports = {
+    migrations,
+    runMigrations
+};
+"""
+
+# 13. Prepared statement registry
+database_statements = """
+const { getDatabase, getReader, getReaders } = require('./init');
+const coordinator = require('./coordinator');
+const { startQuery } = require('../services/metrics');
+const { boosters } = require('../config/game');
+
+// Energy is stored as of energy_updated_at (Unix ms) and regenerates one
+// point per energy_regen_rate ms up to max_energy. It is only brought up to
+// date when a row is read or written, so there are no per-player timers.
+const NOW_MS = "CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER)";
+
+function regeneratedSql(prefix = '') {
+    return `((${NOW_MS} - ${prefix}energy_updated_at) / ${prefix}energy_regen_rate)`;
+}
+
+function currentEnergySql(prefix = '') {
+    return `MIN(${prefix}max_energy, ${prefix}energy + ${regeneratedSql(prefix)})`;
+}
+
+// New value for energy_updated_at when energy is materialized. The clock
+// only advances by whole regenerated points so progress towards the next
+// one is kept; a full bar restarts it from now.
+function energyClockSql() {
+    const regenerated = regeneratedSql();
+    return `CASE WHEN energy + ${regenerated} >= max_energy THEN ${NOW_MS}
+        ELSE energy_updated_at + ${regenerated} * energy_regen_rate END`;
+}
+
+const PROGRESS_COLUMNS = [
+    'id', 'user_id', 'coins', 'max_energy', 'coins_per_tap', 'energy_regen_rate',
+    'total_earned', 'total_taps', 'last_save', 'boosters', 'version', 'energy_updated_at', 'friend_count'
+];
+
+function progressColumns(prefix = '') {
+    return PROGRESS_COLUMNS.map((column) => prefix + column).concat(`${currentEnergySql(prefix)} AS energy`).join(', ');
+}
+
+// The same columns as one JSON object, for returning a row alongside another
+function progressObjectSql(prefix = '') {
+    return `json_object(${PROGRESS_COLUMNS.map((column) => `'${column}', ${prefix}${column}`).join(', ')}, 'energy', ${currentEnergySql(prefix)})`;
+}
+
+const SNAPSHOT_COLUMNS =
+    's.user_id, s.telegram_id, s.username, s.first_name, s.total_earned, s.total_taps, s.rank';
+
+// Every fixed query the routes run, prepared once per connection at startup.
+// Reader statements are prepared on each read-only connection; writer
+// statements only on the writer.
+const definitions = {
+    // Users
+    userIdByTelegramId: {
+        reader: true,
+        sql: 'SELECT id FROM users WHERE telegram_id = ?'
+    },
+    // Register, refresh or restore a player in one statement. Existing and
+    // archived players keep their id, so no AUTOINCREMENT value is spent on
+    // a conflict. RETURNING runs before the AFTER INSERT triggers, so
+    // progress is NULL exactly when the player was just created and
+    // restored is set when they came back from users_archive.
+    // last_active is normally left to the write buffer, but a player away
+    // for over a day is marked at once so the archive job cannot take them.
+    loginUser: {
+        sql: `
+            INSERT INTO users (id, telegram_id, username, first_name, last_name, created_at)
+            VALUES (
+                COALESCE(
+                    (SELECT id FROM users WHERE telegram_id = ?1),
+                    (SELECT id FROM users_archive WHERE telegram_id = ?1)
+                ),
+                ?1, ?2, ?3, ?4,
+                COALESCE((SELECT created_at FROM users_archive WHERE telegram_id = ?1), CURRENT_TIMESTAMP)
+            )
+            ON CONFLICT (id) DO UPDATE
+            SET username = excluded.username,
+                first_name = excluded.first_name,
+                last_name = excluded.last_name,
+                last_active = CASE WHEN users.last_active < datetime('now', '-1 day')
+                    THEN CURRENT_TIMESTAMP ELSE users.last_active END
+            RETURNING id, telegram_id, username, first_name, last_name, created_at, last_active,
+                (SELECT ${progressObjectSql('gp.')} FROM game_progress gp WHERE gp.user_id = users.id) AS progress,
+                EXISTS (SELECT 1 FROM users_archive a WHERE a.id = users.id) AS restored
+        `
+    },
+
+    // Game progress
+    progressByUserId: {
+        reader: true,
+        sql: `SELECT ${progressColumns()} FROM game_progress WHERE user_id = ?`
+    },
+    progressForUpdate: {
+        sql: 'SELECT * FROM game_progress WHERE user_id = ?'
+    },
+    loadProgress: {
+        reader: true,
+        sql: `
+            SELECT ${progressColumns('gp.')}, u.username, u.first_name
+            FROM game_progress gp
+            JOIN users u ON gp.user_id = u.id
+            WHERE gp.user_id = ?
+        `
+    },
+
+    // Leaderboard
+    leaderboardTop: {
+        reader: true,
+        sql: `
+            SELECT
+                gp.user_id,
+                u.telegram_id,
+                u.username,
+                u.first_name,
+                gp.total_earned,
+                gp.total_taps,
+                RANK() OVER (ORDER BY gp.total_earned DESC) as rank
+            FROM users u
+            JOIN game_progress gp ON u.id = gp.user_id
+            ORDER BY gp.total_earned DESC, gp.user_id
+            LIMIT ?
+        `
+    },
+    leaderboardRank: {
+        reader: true,
+        sql: `
+            SELECT rank, total_earned, total_taps
+            FROM leaderboard
+            WHERE telegram_id = ?
+        `
+    },
+    snapshotTop: {
+        reader: true,
+        sql: `
+            SELECT ${SNAPSHOT_COLUMNS}
+            FROM leaderboard_snapshot_meta m
+            JOIN leaderboard_snapshot s ON s.slot = m.slot
+            WHERE m.id = 1 AND s.position <= ?
+            ORDER BY s.position
+        `
+    },
+    // Rows after a (total_earned, user_id) cursor: the rest of the cursor's
+    // score tie, then lower scores. Both halves are index seeks, so deep
+    // pages cost the same as the first.
+    snapshotPage: {
+        reader: true,
+        sql: `
+            SELECT * FROM (
+                SELECT ${SNAPSHOT_COLUMNS} FROM leaderboard_snapshot s
+                WHERE s.slot = (SELECT slot FROM leaderboard_snapshot_meta WHERE id = 1)
+                    AND s.total_earned = ?1 AND s.user_id > ?2
+                ORDER BY s.user_id
+                LIMIT ?3
+            )
+            UNION ALL
+            SELECT * FROM (
+                SELECT ${SNAPSHOT_COLUMNS} FROM leaderboard_snapshot s
+                WHERE s.slot = (SELECT slot FROM leaderboard_snapshot_meta WHERE id = 1)
+                    AND s.total_earned < ?1
+                ORDER BY s.total_earned DESC, s.user_id
+                LIMIT ?3
+            )
+            ORDER BY total_earned DESC, user_id
+            LIMIT ?3
+        `
+    },
+    snapshotAround: {
+        reader: true,
+        sql: `
+            SELECT ${SNAPSHOT_COLUMNS}
+            FROM leaderboard_snapshot_meta m
+            JOIN leaderboard_snapshot me ON me.slot = m.slot AND me.telegram_id = ?1
+            JOIN leaderboard_snapshot s ON s.slot = m.slot
+                AND s.position BETWEEN me.position - ?2 AND me.position + ?2
+            WHERE m.id = 1
+            ORDER BY s.position
+        `
+    },
+    snapshotRank: {
+        reader: true,
+        sql: `
+            SELECT s.rank, s.total_earned, s.total_taps
+            FROM leaderboard_snapshot_meta m
+            JOIN leaderboard_snapshot s ON s.slot = m.slot
+            WHERE m.id = 1 AND s.telegram_id = ?
+        `
+    },
+    snapshotMeta: {
+        sql: 'SELECT slot, taken_at, player_count FROM leaderboard_snapshot_meta WHERE id = 1'
+    },
+    clearSnapshotSlot: {
+        sql: 'DELETE FROM leaderboard_snapshot WHERE slot = ?'
+    },
+    // One sorted pass: ties share a RANK() but get consecutive positions in
+    // user id order, which is the order page cursors follow
+    fillSnapshotSlot: {
+        sql: `
+            INSERT INTO leaderboard_snapshot
+                (slot, position, rank, user_id, telegram_id, username, first_name, total_earned, total_taps)
+            SELECT ?, ROW_NUMBER() OVER (ORDER BY gp.total_earned DESC, gp.user_id),
+                RANK() OVER (ORDER BY gp.total_earned DESC),
+                u.id, u.telegram_id, u.username, u.first_name, gp.total_earned, gp.total_taps
+            FROM game_progress gp
+            JOIN users u ON u.id = gp.user_id
+        `
+    },
+    activateSnapshotSlot: {
+        sql: 'UPDATE leaderboard_snapshot_meta SET slot = ?, taken_at = ?, player_count = ? WHERE id = 1'
+    },
+    rankIndexPlayers: {
+        reader: true,
+        sql: `
+            SELECT u.id, u.telegram_id, u.username, u.first_name, gp.total_earned, gp.total_taps
+            FROM users u
+            JOIN game_progress gp ON u.id = gp.user_id
+        `
+    },
+
+    // Friends
+    // Both players must be live: an archived id can still be cached in a
+    // worker until the eviction reaches it
+    insertFriend: {
+        sql: `
+            INSERT OR IGNORE INTO friends (user_id, friend_id)
+            SELECT ?1, ?2
+            WHERE EXISTS (SELECT 1 FROM game_progress WHERE user_id = ?1)
+                AND EXISTS (SELECT 1 FROM game_progress WHERE user_id = ?2)
+        `
+    },
+    // friend_count is kept up to date by the friends_referral_bonus trigger
+    friendCount: {
+        reader: true,
+        sql: 'SELECT friend_count AS count FROM game_progress WHERE user_id = ?'
+    },
+    friendCountsByTelegramId: {
+        reader: true,
+        sql: `
+            SELECT gp.user_id, gp.friend_count AS count
+            FROM users u
+            JOIN game_progress gp ON gp.user_id = u.id
+            WHERE u.telegram_id IN (SELECT value FROM json_each(?)) AND gp.friend_count > 0
+        `
+    },
+    // Players referred directly (depth 1) or through others, per level up
+    // to the given depth. Archived players count but earn nothing.
+    referralLevels: {
+        reader: true,
+        sql: `
+            SELECT rt.depth, COUNT(*) AS players, COALESCE(SUM(gp.total_earned), 0) AS total_earned
+            FROM referral_tree rt
+            LEFT JOIN game_progress gp ON gp.user_id = rt.descendant_id
+            WHERE rt.ancestor_id = ? AND rt.depth <= ?
+            GROUP BY rt.depth
+            ORDER BY rt.depth
+        `
+    },
+
+    // Tasks
+    userTasks: {
+        reader: true,
+        sql: `
+            SELECT task_id, completed_at, date(completed_at) = date('now') AS completed_today
+            FROM user_tasks
+            WHERE user_id = ? AND completed
+        `
+    },
+    // Scores of a JSON array of user ids, read back after rewards are paid
+    progressTotals: {
+        sql: `
+            SELECT user_id, total_earned, total_taps
+            FROM game_progress
+            WHERE user_id IN (SELECT value FROM json_each(?))
+        `
+    },
+
+    // Keyset page of a user's friends after the (total_earned, user_id) of
+    // the previous page's last row; pass NULLs for the first page
+    friendsPage: {
+        reader: true,
+        sql: `
+            SELECT
+                gp.user_id,
+                u.telegram_id,
+                u.username,
+                u.first_name,
+                gp.total_earned,
+                f.created_at as friend_since
+            FROM friends f
+            JOIN users u ON f.friend_id = u.id
+            JOIN game_progress gp ON u.id = gp.user_id
+            WHERE f.user_id = ?1
+                AND (?2 IS NULL OR gp.total_earned < ?2 OR (gp.total_earned = ?2 AND gp.user_id > ?3))
+            ORDER BY gp.total_earned DESC, gp.user_id
+            LIMIT ?4
+        `
+    }
+};
+
+// Buying a booster is a single conditional UPDATE per booster type: the
+// price and the new stat value are looked up from the current level inside
+// SQLite, so no read-modify-write window exists. An empty result means the
+// player cannot afford it or the booster is maxed out.
+function purchaseBoosterSql(type) {
+    const { column, levels, costs } = boosters[type];
+    const level = `COALESCE(json_extract(COALESCE(boosters, '{}'), '$.${type}'), 0)`;
+    const cost = `CASE ${level} ${costs.map((price, i) => `WHEN ${i} THEN ${price}`).join(' ')} END`;
+    const nextValue = `CASE ${level} ${levels.slice(1).map((value, i) => `WHEN ${i} THEN ${value}`).join(' ')} END`;
+    const energy = currentEnergySql();
+
+    const assignments = [
+        `coins = coins - (${cost})`,
+        `boosters = json_set(COALESCE(boosters, '{}'), '$.${type}', ${level} + 1)`,
+        `${column} = ${nextValue}`,
+        'version = version + 1',
+        `energy_updated_at = ${energyClockSql()}`
+    ];
+
+    // Energy is settled at the old rate and capacity first. A full energy
+    // bar stays full when capacity grows, as on the client.
+    if (column === 'max_energy') {
+        assignments.push(`energy = CASE WHEN ${energy} = max_energy THEN ${nextValue} ELSE ${energy} END`);
+    } else {
+        assignments.push(`energy = ${energy}`);
+    }
+
+    return `
+        UPDATE game_progress
+        SET ${assignments.join(', ')}
+        WHERE user_id = ? AND coins >= (${cost})
+        RETURNING coins, boosters, energy, max_energy, energy_regen_rate, coins_per_tap, version
+    `;
+}
+
+Object.keys(boosters).forEach((type) => {
+    definitions[`purchaseBooster:${type}`] = { sql: purchaseBoosterSql(type) };
+});
+
+let writerStatements = new Map();
+let readerStatements = [];
+let nextReader = 0;
+
+function prepareOn(connection, names, callback) {
+    const prepared = new Map();
+    let remaining = names.length;
+    let failed = null;
+
+    if (remaining === 0) {
+        return callback(null, prepared);
+    }
+
+    names.forEach((name) => {
+        const statement = connection.prepare(definitions[name].sql, (err) => {
+            if (err) {
+                failed = failed || new Error(`Failed to prepare ${name}: ${err.message}`);
+            } else {
+                prepared.set(name, statement);
+            }
+
+            if (--remaining === 0) {
+                callback(failed, prepared);
+            }
+        });
+    });
+}
+
+// Prepare every definition on the connections this process owns. Call once
+// the schema is migrated and the read pool is open. Cluster workers have no
+// writer connection; their writer statements run on the coordinator.
+function prepareStatements(callback) {
+    const names = Object.keys(definitions);
+    const readerNames = names.filter((name) => definitions[name].reader);
+    const writerNames = getDatabase() ? names.filter((name) => !definitions[name].reader) : [];
+    const readers = getReaders();
+    let remaining = readers.length + 1;
+    let failed = null;
+
+    const preparedReaders = new Array(readers.length);
+    const finish = (err) => {
+        failed = failed || err;
+        if (--remaining > 0) {
+            return;
+        }
+
+        readerStatements = preparedReaders.filter(Boolean);
+        if (failed) {
+            console.error('Statement preparation error:', failed.message);
+        } else {
+            console.log(`Prepared ${names.length} statements`);
+        }
+        if (callback) callback(failed);
+    };
+
+    prepareOn(getDatabase(), writerNames, (err, prepared) => {
+        writerStatements = prepared;
+        finish(err);
+    });
+
+    readers.forEach((reader, i) => {
+        prepareOn(reader, readerNames, (err, prepared) => {
+            preparedReaders[i] = prepared;
+            finish(err);
+        });
+    });
+}
+
+function definitionFor(name) {
+    const definition = definitions[name];
+    if (!definition) {
+        throw new Error(`Unknown statement: ${name}`);
+    }
+    return definition;
+}
+
+function lookup(name) {
+    const definition = definitionFor(name);
+
+    if (!definition.reader) {
+        return writerStatements.get(name);
+    }
+    if (readerStatements.length === 0) {
+        return undefined;
+    }
+
+    nextReader = (nextReader + 1) % readerStatements.length;
+    return readerStatements[nextReader].get(name);
+}
+
+// Until statements are prepared, queries run as raw SQL
+function fallbackConnection(name) {
+    return definitions[name].reader ? getReader() : getDatabase();
+}
+
+// Writer statements in a cluster worker are forwarded to the coordinator
+function forwardToCoordinator(method, name, params, callback) {
+    if (!callback) {
+        return coordinator.request('statement', { method, name, params });
+    }
+
+    coordinator.request('statement', { method, name, params }, (err, result) => {
+        if (method === 'run') {
+            return callback.call(result || {}, err);
+        }
+        callback(err, result);
+    });
+}
+
+// Every call is timed under its statement name. Forwarded calls include
+// the round trip to the coordinator; fire-and-forget ones are only timed
+// where they run.
+function timed(name, callback) {
+    const done = startQuery(name);
+    return function(...args) {
+        done();
+        if (callback) {
+            callback.apply(this, args);
+        }
+    };
+}
+
+function get(name, params, callback) {
+    if (coordinator.isWorker() && !definitionFor(name).reader) {
+        return forwardToCoordinator('get', name, params, callback && timed(name, callback));
+    }
+
+    const finish = timed(name, callback);
+
+    const statement = lookup(name);
+    if (!statement) {
+        return fallbackConnection(name).get(definitions[name].sql, params, finish);
+    }
+
+    statement.get(params, (err, row) => {
+        // Release the read snapshot instead of holding it until the next call
+        statement.reset();
+        finish(err, row);
+    });
+}
+
+function all(name, params, callback) {
+    if (coordinator.isWorker() && !definitionFor(name).reader) {
+        return forwardToCoordinator('all', name, params, callback && timed(name, callback));
+    }
+
+    const finish = timed(name, callback);
+
+    const statement = lookup(name);
+    if (!statement) {
+        return fallbackConnection(name).all(definitions[name].sql, params, finish);
+    }
+
+    statement.all(params, finish);
+}
+
+function each(name, params, rowCallback, completeCallback) {
+    const finish = timed(name, completeCallback);
+
+    const statement = lookup(name);
+    if (!statement) {
+        return fallbackConnection(name).each(definitions[name].sql, params, rowCallback, finish);
+    }
+
+    statement.each(params, rowCallback, finish);
+}
+
+// The callback is invoked with `this` bound to the statement, so
+// `this.lastID` and `this.changes` work as with db.run
+function run(name, params, callback) {
+    if (coordinator.isWorker() && !definitionFor(name).reader) {
+        return forwardToCoordinator('run', name, params, callback && timed(name, callback));
+    }
+
+    const finish = timed(name, callback);
+
+    const statement = lookup(name);
+    if (!statement) {
+        return fallbackConnection(name).run(definitions[name].sql, params, finish);
+    }
+
+    statement.run(params, finish);
+}
+
+coordinator.handle('statement', ({ method, name, params }, reply) => {
+    if (method === 'run') {
+        return run(name, params, function(err) {
+            reply(err, err ? null : { lastID: this.lastID, changes: this.changes });
+        });
+    }
+
+    (method === 'all' ? all : get)(name, params, reply);
+});
+
+function finalizeStatements(callback) {
+    const statements = [
+        ...writerStatements.values(),
+        ...readerStatements.flatMap((prepared) => [...prepared.values()])
+    ];
+    let remaining = statements.length;
+
+    writerStatements = new Map();
+    readerStatements = [];
+
+    if (remaining === 0) {
+        return callback && callback();
+    }
+
+    statements.forEach((statement) => statement.finalize(() => {
+        if (--remaining === 0 && callback) {
+            callback();
+        }
+    }));
+}
+
+module.exports = {
+    currentEnergySql,
+    energyClockSql,
+    prepareStatements,
+    finalizeStatements,
+    get,
+    all,
+    each,
+    run
+};
+"""
+
+# 14. telegram_id -> user id cache
+user_cache = """
+const statements = require('../database/statements');
+const coordinator = require('../database/coordinator');
+
+const MAX_ENTRIES = parseInt(process.env.USER_CACHE_SIZE) || 100000;
+
+// telegram_id -> users.id never changes once a user exists, so entries are
+// only ever evicted for space. A Map iterates in insertion order, which
+// doubles as the recency list: re-inserting a key moves it to the end.
+const cache = new Map();
+let hits = 0;
+let misses = 0;
+
+function rememberUser(telegramId, userId) {
+    const key = String(telegramId);
+
+    cache.delete(key);
+    cache.set(key, userId);
+
+    if (cache.size > MAX_ENTRIES) {
+        cache.delete(cache.keys().next().value);
+    }
+}
+
+// Calls back synchronously on a hit; unknown users are not cached so a
+// later registration is picked up on the next lookup
+function resolveUserId(telegramId, callback) {
+    const key = String(telegramId);
+    const userId = cache.get(key);
+
+    if (userId !== undefined) {
+        hits++;
+        cache.delete(key);
+        cache.set(key, userId);
+        return callback(null, userId);
+    }
+
+    misses++;
+    statements.get('userIdByTelegramId', [key], (err, user) => {
+        if (err || !user) {
+            return callback(err, null);
+        }
+
+        rememberUser(key, user.id);
+        callback(null, user.id);
+    });
+}
+
+// Archived players resolve again only after they log back in. Published
+// so every cluster worker drops them from its own cache.
+function forgetUsers(telegramIds) {
+    coordinator.publish('users:forget', telegramIds);
+}
+
+coordinator.subscribe('users:forget', (telegramIds) => {
+    telegramIds.forEach((telegramId) => cache.delete(String(telegramId)));
+});
+
+function getStats() {
+    return {
+        size: cache.size,
+        capacity: MAX_ENTRIES,
+        hits,
+        misses
+    };
+}
+
+module.exports = {
+    resolveUserId,
+    rememberUser,
+    forgetUsers,
+    getStats
+};
+"""
+
+# 15. Cluster write coordinator
+database_coordinator = """
+const cluster = require('cluster');
+
+// In cluster mode the primary process is the write coordinator: it owns the
+// only SQLite writer connection and serves no HTTP traffic. Workers send it
+// write operations over IPC and receive replies and broadcast events back.
+// Without cluster mode every call here runs in-process.
+
+const handlers = new Map();
+const subscribers = new Map();
+const pendingReplies = new Map();
+let nextRequestId = 0;
+let shuttingDown = false;
+
+// Workers forked by startCoordinator carry the coordinator's pid; checking
+// it rather than cluster.isWorker keeps PM2 cluster instances standalone
+function isWorker() {
+    return cluster.isWorker && Boolean(process.env.WRITE_COORDINATOR_PID);
+}
+
+// Register an operation workers may invoke; `reply(err, result)` answers it
+function handle(op, handler) {
+    handlers.set(op, handler);
+}
+
+function deliver(event, payload) {
+    (subscribers.get(event) || []).forEach((subscriber) => subscriber(payload));
+}
+
+function subscribe(event, subscriber) {
+    if (!subscribers.has(event)) {
+        subscribers.set(event, []);
+    }
+    subscribers.get(event).push(subscriber);
+}
+
+// Apply an event locally and fan it out to every other process
+function publish(event, payload) {
+    deliver(event, payload);
+
+    if (isWorker()) {
+        process.send({ type: 'publish', event, payload });
+    } else {
+        broadcast(null, event, payload);
+    }
+}
+
+function broadcast(origin, event, payload) {
+    Object.values(cluster.workers || {}).forEach((worker) => {
+        if (worker !== origin && worker.isConnected()) {
+            worker.send({ type: 'event', event, payload });
+        }
+    });
+}
+
+// Run an operation on the coordinator. Omit the callback for fire-and-forget
+// writes; no reply is sent for those.
+function request(op, payload, callback) {
+    if (!isWorker()) {
+        return handlers.get(op)(payload, callback || (() => {}));
+    }
+
+    const message = { type: 'request', op, payload };
+    if (callback) {
+        message.id = ++nextRequestId;
+        pendingReplies.set(message.id, callback);
+    }
+    process.send(message);
+}
+
+function onCoordinatorMessage(worker, message) {
+    if (message.type === 'publish') {
+        deliver(message.event, message.payload);
+        return broadcast(worker, message.event, message.payload);
+    }
+
+    if (message.type !== 'request') {
+        return;
+    }
+
+    const handler = handlers.get(message.op);
+    const reply = (err, result) => {
+        if (message.id !== undefined && worker.isConnected()) {
+            worker.send({
+                type: 'reply',
+                id: message.id,
+                error: err ? err.message : null,
+                result
+            });
+        }
+    };
+
+    if (!handler) {
+        return reply(new Error(`Unknown operation: ${message.op}`));
+    }
+
+    try {
+        handler(message.payload, reply);
+    } catch (error) {
+        console.error('Coordinator operation error:', error);
+        reply(error);
+    }
+}
+
+function forkWorker() {
+    return cluster.fork({ WRITE_COORDINATOR_PID: String(process.pid) });
+}
+
+function startCoordinator(workerCount) {
+    cluster.on('message', onCoordinatorMessage);
+
+    cluster.on('exit', (worker, code, signal) => {
+        if (!shuttingDown) {
+            console.error(`Worker ${worker.process.pid} exited (${signal || code}), restarting`);
+            forkWorker();
+        }
+    });
+
+    for (let i = 0; i < workerCount; i++) {
+        forkWorker();
+    }
+
+    console.log(`Write coordinator ${process.pid} started ${workerCount} workers`);
+}
+
+function stopWorkers(callback) {
+    shuttingDown = true;
+    cluster.disconnect(callback);
+}
+
+function startWorkerChannel() {
+    process.on('message', (message) => {
+        if (message.type === 'reply') {
+            const callback = pendingReplies.get(message.id);
+            pendingReplies.delete(message.id);
+            if (callback) {
+                callback(message.error ? new Error(message.error) : null, message.result);
+            }
+        } else if (message.type === 'event') {
+            deliver(message.event, message.payload);
+        }
+    });
+
+    // Without the coordinator there is nowhere to send writes
+    process.on('disconnect', () => process.exit(1));
+}
+
+module.exports = {
+    isWorker,
+    handle,
+    request,
+    publish,
+    subscribe,
+    startCoordinator,
+    stopWorkers,
+    startWorkerChannel
+};
+"""
+
+# 16. Telegram initData verification
+telegram_auth = """
+const crypto = require('crypto');
+
+const MAX_AGE_SECONDS = parseInt(process.env.INIT_DATA_MAX_AGE) || 86400;
+const MAX_CACHED = parseInt(process.env.INIT_DATA_CACHE_SIZE) || 20000;
+
+// The HMAC key depends only on the bot token, so derive it once at startup
+const secretKey = crypto.createHmac('sha256', 'WebAppData')
+    .update(process.env.BOT_TOKEN || '')
+    .digest();
+
+// Verified initData strings -> expiry (ms). Keyed by the full string, not
+// just its hash, so a known-good hash cannot be replayed with edited fields.
+const verified = new Map();
+
+// Plain code-unit comparison; Telegram's keys are ASCII, so this is byte order
+function byteOrder([a], [b]) {
+    return a < b ? -1 : a > b ? 1 : 0;
+}
+
+function remember(initData, expiresAt) {
+    verified.set(initData, expiresAt);
+
+    if (verified.size > MAX_CACHED) {
+        verified.delete(verified.keys().next().value);
+    }
+}
+
+// Validate Telegram WebApp init data, including its auth_date window
+function verifyInitData(initData) {
+    if (typeof initData !== 'string' || initData.length === 0) {
+        return false;
+    }
+
+    const now = Date.now();
+    const cachedExpiry = verified.get(initData);
+    if (cachedExpiry !== undefined) {
+        if (cachedExpiry > now) {
+            return true;
+        }
+        verified.delete(initData);
+        return false;
+    }
+
+    const urlParams = new URLSearchParams(initData);
+    const hash = urlParams.get('hash');
+    const expiresAt = (Number(urlParams.get('auth_date')) + MAX_AGE_SECONDS) * 1000;
+
+    if (!hash || !(expiresAt > now)) {
+        return false;
+    }
+
+    urlParams.delete('hash');
+
+    const dataCheckString = Array.from(urlParams.entries())
+        .sort(byteOrder)
+        .map(([key, value]) => `${key}=${value}`)
+        .join('\\n');
+
+    const calculatedHash = crypto.createHmac('sha256', secretKey).update(dataCheckString).digest();
+    const providedHash = Buffer.from(hash, 'hex');
+
+    if (providedHash.length !== calculatedHash.length ||
+        !crypto.timingSafeEqual(providedHash, calculatedHash)) {
+        return false;
+    }
+
+    remember(initData, expiresAt);
+    return true;
+}
+
+module.exports = {
+    verifyInitData
+};
+"""
+
+# 17. Session token middleware
+auth_middleware = """
+const jwt = require('jsonwebtoken');
+const crypto = require('crypto');
+
+// The token is the only proof of identity on authenticated routes, so
+// refuse to start rather than sign with a guessable key
+const JWT_SECRET = process.env.JWT_SECRET;
+if (!JWT_SECRET) {
+    throw new Error('JWT_SECRET is not set');
+}
+const TOKEN_EXPIRES_IN = process.env.JWT_EXPIRES_IN || '7d';
+
+// Session token carrying the internal user id, so authenticated routes
+// never need to resolve a telegram_id
+function signToken(user) {
+    return jwt.sign(
+        { sub: String(user.id), tid: String(user.telegram_id) },
+        JWT_SECRET,
+        { algorithm: 'HS256', expiresIn: TOKEN_EXPIRES_IN }
+    );
+}
+
+// Verify the Bearer token in-process and attach the user to the request
+function requireAuth(req, res, next) {
+    const header = req.headers.authorization || '';
+    const token = header.startsWith('Bearer ') ? header.slice(7) : null;
+
+    if (!token) {
+        return res.status(401).json({ error: 'Missing token' });
+    }
+
+    try {
+        const payload = jwt.verify(token, JWT_SECRET, { algorithms: ['HS256'] });
+        req.user = { id: Number(payload.sub), telegramId: payload.tid };
+        next();
+    } catch (error) {
+        res.status(401).json({ error: 'Invalid token' });
+    }
+}
+
+// Operator-only routes: the Bearer token must equal ADMIN_TOKEN. With no
+// ADMIN_TOKEN configured these routes are disabled.
+function requireAdmin(req, res, next) {
+    const expected = Buffer.from(process.env.ADMIN_TOKEN || '');
+    const header = req.headers.authorization || '';
+    const token = Buffer.from(header.startsWith('Bearer ') ? header.slice(7) : '');
+
+    if (expected.length === 0 || token.length !== expected.length || !crypto.timingSafeEqual(token, expected)) {
+        return res.status(403).json({ error: 'Forbidden' });
+    }
+
+    next();
+}
+
+module.exports = {
+    signToken,
+    requireAuth,
+    requireAdmin
+};
+"""
+
+# 18. Server-side game balance tables
+game_config = """
+// Server-side copy of the balance tables in the client's GameState.config.
+// The server's values are authoritative; clients only display them.
+const maxEnergyLevels = [100, 150, 200, 300, 500];
+const regenRateLevels = [1800000, 1500000, 1200000, 900000, 600000]; // 30min, 25min, 20min, 15min, 10min
+const coinsPerTapLevels = [1, 2, 3, 5, 10];
+
+// Each booster raises one game_progress column to the next entry in
+// `levels`; costs[n] is the price of going from level n to n + 1
+const boosters = {
+    energyCapacity: {
+        column: 'max_energy',
+        levels: maxEnergyLevels,
+        costs: [100, 250, 500, 1000]
+    },
+    energyRegen: {
+        column: 'energy_regen_rate',
+        levels: regenRateLevels,
+        costs: [150, 300, 600, 1200]
+    },
+    coinsPerTap: {
+        column: 'coins_per_tap',
+        levels: coinsPerTapLevels,
+        costs: [200, 400, 800, 1600]
+    }
+};
+
+// Task catalogue. A task completes once its input counter reaches the
+// target; daily tasks can be completed again on a later (UTC) day.
+const tasks = {
+    dailyLogin: { input: 'logins', target: 1, reward: 100, daily: true },
+    tapChampion: { input: 'total_taps', target: 1000, reward: 500 },
+    recruit: { input: 'friends', target: 1, reward: 1000 },
+    energyMaster: { input: 'max_energy', target: 500, reward: 2000 }
+};
+
+module.exports = {
+    tasks,
+    maxEnergyLevels,
+    regenRateLevels,
+    coinsPerTapLevels,
+    boosters
+};
+"""
+
+# 19. Shared response cache
+cache_middleware = """
+const crypto = require('crypto');
+const coordinator = require('../database/coordinator');
+
+const MAX_ENTRIES = parseInt(process.env.RESPONSE_CACHE_SIZE) || 10000; // per namespace
+
+// namespace -> Map of key -> { body, etag, expiresAt }. Bodies are kept as
+// serialized Buffers so a hit skips both the query and JSON.stringify.
+const namespaces = new Map();
+
+function entriesFor(namespace) {
+    if (!namespaces.has(namespace)) {
+        namespaces.set(namespace, new Map());
+    }
+    return namespaces.get(namespace);
+}
+
+function etagMatches(req, etag) {
+    const header = req.headers['if-none-match'];
+    if (!header) {
+        return false;
+    }
+    return header === '*' || header.split(',').some((tag) => tag.trim() === etag);
+}
+
+function send(req, res, entry) {
+    res.set('ETag', entry.etag);
+    res.set('Cache-Control', 'no-cache');
+
+    if (etagMatches(req, entry.etag)) {
+        return res.status(304).end();
+    }
+
+    res.set('Content-Type', 'application/json; charset=utf-8');
+    res.end(entry.body);
+}
+
+// Cache successful JSON responses for `ttl` ms. Entries are keyed by the
+// request URL unless `options.key(req)` is given, and are shared by every
+// client, so only use this on routes whose response does not depend on
+// who is asking.
+function cacheResponse(namespace, ttl, options = {}) {
+    const keyFor = options.key || ((req) => req.originalUrl);
+
+    return (req, res, next) => {
+        const entries = entriesFor(namespace);
+        const key = keyFor(req);
+        const cached = entries.get(key);
+
+        if (cached && cached.expiresAt > Date.now()) {
+            return send(req, res, cached);
+        }
+
+        const json = res.json.bind(res);
+        res.json = (payload) => {
+            if (res.statusCode !== 200) {
+                return json(payload);
+            }
+
+            const body = Buffer.from(JSON.stringify(payload));
+            const entry = {
+                body,
+                etag: `"${crypto.createHash('sha1').update(body).digest('base64url')}"`,
+                expiresAt: Date.now() + ttl
+            };
+
+            entries.delete(key);
+            entries.set(key, entry);
+            if (entries.size > MAX_ENTRIES) {
+                entries.delete(entries.keys().next().value);
+            }
+
+            send(req, res, entry);
+        };
+
+        next();
+    };
+}
+
+function dropEntries({ namespace, key }) {
+    const entries = namespaces.get(namespace);
+    if (!entries) {
+        return;
+    }
+
+    if (key === undefined) {
+        entries.clear();
+    } else {
+        entries.delete(key);
+    }
+}
+
+// Drop a whole namespace, or one key of it, in every cluster worker
+function invalidate(namespace, key) {
+    coordinator.publish('cache:invalidate', { namespace, key });
+}
+
+// Drop a namespace whenever `event` is delivered. Use this for coordinator
+// events that already reach every worker, such as rank index updates.
+function invalidateOn(event, namespace) {
+    coordinator.subscribe(event, () => dropEntries({ namespace }));
+}
+
+coordinator.subscribe('cache:invalidate', dropEntries);
+
+module.exports = {
+    cacheResponse,
+    invalidate,
+    invalidateOn
+};
+"""
+
+# 20. Leaderboard snapshot job
+leaderboard_snapshot = """
+const statements = require('../database/statements');
+const coordinator = require('../database/coordinator');
+
+// 'snapshot' serves /top and /rank from the materialized table; 'index'
+// serves them live from the in-memory rank index
+const SOURCE = process.env.LEADERBOARD_SOURCE === 'index' ? 'index' : 'snapshot';
+const SNAPSHOT_INTERVAL = parseInt(process.env.LEADERBOARD_SNAPSHOT_INTERVAL) || 60000;
+
+let snapshotTimer = null;
+let refreshing = false;
+
+function useSnapshot() {
+    return SOURCE === 'snapshot';
+}
+
+// Rebuild the inactive slot, then switch readers to it with a single-row
+// UPDATE. Readers see either the old or the new snapshot, never a mix.
+function refreshSnapshot(callback) {
+    const done = callback || (() => {});
+
+    if (refreshing) {
+        return done();
+    }
+    refreshing = true;
+
+    const fail = (err) => {
+        refreshing = false;
+        console.error('Leaderboard snapshot error:', err);
+        done(err);
+    };
+
+    statements.get('snapshotMeta', [], (err, meta) => {
+        if (err || !meta) {
+            return fail(err || new Error('Missing leaderboard_snapshot_meta row'));
+        }
+
+        const slot = meta.slot === 0 ? 1 : 0;
+
+        statements.run('clearSnapshotSlot', [slot], (err) => {
+            if (err) {
+                return fail(err);
+            }
+
+            statements.run('fillSnapshotSlot', [slot], function(err) {
+                if (err) {
+                    return fail(err);
+                }
+
+                const playerCount = this.changes;
+                const takenAt = Date.now();
+
+                statements.run('activateSnapshotSlot', [slot, takenAt, playerCount], (err) => {
+                    if (err) {
+                        return fail(err);
+                    }
+
+                    refreshing = false;
+                    coordinator.publish('leaderboard:snapshot', { takenAt, playerCount });
+                    done(null);
+                });
+            });
+        });
+    });
+}
+
+// Runs on the process that owns the writer. The first refresh happens
+// straight away unless the stored snapshot is still within the interval.
+function startSnapshotJob() {
+    if (!useSnapshot() || snapshotTimer) {
+        return;
+    }
+
+    snapshotTimer = setInterval(refreshSnapshot, SNAPSHOT_INTERVAL);
+
+    statements.get('snapshotMeta', [], (err, meta) => {
+        if (err || !meta || !meta.taken_at || Date.now() - meta.taken_at >= SNAPSHOT_INTERVAL) {
+            refreshSnapshot();
+        }
+    });
+}
+
+function stopSnapshotJob() {
+    clearInterval(snapshotTimer);
+    snapshotTimer = null;
+}
+
+module.exports = {
+    useSnapshot,
+    refreshSnapshot,
+    startSnapshotJob,
+    stopSnapshotJob
+};
+"""
+
+# 21. Chunked JSON streaming
+json_stream = """
+// Write a large result as a chunked JSON array without holding it in
+// memory. `fetchNext(lastRow, callback)` returns the page after `lastRow`
+// (keyset paging); the next page is only fetched once the socket has
+// drained, and an empty page ends the array.
+function streamJsonArray(res, firstRows, fetchNext, transform = (row) => row) {
+    let first = true;
+    let closed = false;
+
+    res.on('close', () => {
+        closed = true;
+    });
+
+    const writeRows = (rows) => {
+        let body = '';
+        rows.forEach((row) => {
+            body += (first ? '' : ',') + JSON.stringify(transform(row));
+            first = false;
+        });
+        return res.write(body);
+    };
+
+    const pump = (rows) => {
+        if (closed) {
+            return;
+        }
+        if (rows.length === 0) {
+            return res.end(']');
+        }
+
+        const lastRow = rows[rows.length - 1];
+        const next = () => fetchNext(lastRow, (err, more) => {
+            if (err) {
+                // Headers are already sent; cut the response short
+                console.error('Stream error:', err);
+                return res.destroy(err);
+            }
+            pump(more);
+        });
+
+        if (writeRows(rows)) {
+            next();
+        } else {
+            res.once('drain', next);
+        }
+    };
+
+    res.status(200);
+    res.set('Content-Type', 'application/json; charset=utf-8');
+    res.write('[');
+    pump(firstRows);
+}
+
+module.exports = {
+    streamJsonArray
+};
+"""
+
+# 22. Bulk referral import
+database_referrals = """
+const { getDatabase } = require('./init');
+const coordinator = require('./coordinator');
+const { startQuery } = require('../services/metrics');
+
+// Insert every referral pair, given as a JSON array of [user, friend]
+// telegram ids, in one statement. Unknown users are skipped by the joins,
+// existing friendships by OR IGNORE, and the friends_referral_bonus
+// trigger credits every inserted pair. A single statement is atomic, so a
+// failure leaves no pair imported.
+const IMPORT_SQL = `
+    INSERT OR IGNORE INTO friends (user_id, friend_id)
+    SELECT u.id, f.id
+    FROM json_each(?) AS r
+    JOIN users u ON u.telegram_id = json_extract(r.value, '$[0]')
+    JOIN users f ON f.telegram_id = json_extract(r.value, '$[1]')
+    WHERE u.id != f.id
+    ORDER BY r.key
+`;
+
+// Import [userTelegramId, friendTelegramId] pairs all or nothing. Calls
+// back with the number of new friendships. Safe to retry after an error:
+// pairs already imported are ignored.
+function importReferrals(pairs, callback) {
+    if (coordinator.isWorker()) {
+        return coordinator.request('referrals:import', pairs, callback);
+    }
+
+    const finishQuery = startQuery('importReferrals');
+    const json = JSON.stringify(pairs.map((pair) => pair.map(String)));
+
+    getDatabase().run(IMPORT_SQL, [json], function(err) {
+        finishQuery();
+        if (err) {
+            console.error('Referral import error:', err);
+            return callback(err, 0);
+        }
+
+        callback(null, this.changes);
+    });
+}
+
+coordinator.handle('referrals:import', importReferrals);
+
+module.exports = {
+    importReferrals
+};
+"""
+
+# 23. Task engine
+task_engine = """
+const { getDatabase } = require('../database/init');
+const coordinator = require('../database/coordinator');
+const statements = require('../database/statements');
+const { updateScores } = require('./rankIndex');
+const { startQuery } = require('./metrics');
+const { tasks } = require('../config/game');
+
+const ROWS_PER_STATEMENT = 200; // 4 bound parameters per row, stays under SQLite's 999 limit
+
+// input counter -> [{ taskId, target, reward }] sorted by target, so an
+// update only looks at the tasks fed by the counter that moved
+const tasksByInput = new Map();
+Object.keys(tasks).forEach((taskId) => {
+    const { input, target, reward } = tasks[taskId];
+    if (!tasksByInput.has(input)) {
+        tasksByInput.set(input, []);
+    }
+    tasksByInput.get(input).push({ taskId, target, reward });
+});
+tasksByInput.forEach((entries) => entries.sort((a, b) => a.target - b.target));
+
+const dailyTaskIds = Object.keys(tasks).filter((taskId) => tasks[taskId].daily);
+
+// Record many completions in one statement. A task already completed is
+// left alone unless it is a daily task last completed before today; the
+// user_tasks triggers pay the reward for every row inserted or renewed.
+function buildCompletionStatement(rowCount) {
+    const values = new Array(rowCount).fill('(?, ?, TRUE, ?, CURRENT_TIMESTAMP, ?)').join(', ');
+    const daily = dailyTaskIds.map((taskId) => `'${taskId}'`).join(', ');
+
+    return `
+        INSERT INTO user_tasks (user_id, task_id, completed, progress, completed_at, reward)
+        VALUES ${values}
+        ON CONFLICT (user_id, task_id) DO UPDATE
+        SET completed_at = excluded.completed_at, reward = excluded.reward
+        WHERE user_tasks.task_id IN (${daily}) AND date(user_tasks.completed_at) < date('now')
+        RETURNING user_id
+    `;
+}
+
+// Rewards add to total_earned, so push the new totals to the leaderboard
+function publishScores(userIds) {
+    statements.all('progressTotals', [JSON.stringify([...new Set(userIds)])], (err, rows) => {
+        if (err) {
+            return console.error('Task reward score error:', err);
+        }
+
+        updateScores(rows.map((row) => ({
+            userId: row.user_id,
+            totalEarned: row.total_earned,
+            totalTaps: row.total_taps
+        })));
+    });
+}
+
+function recordCompletions(completions) {
+    const db = getDatabase();
+
+    for (let i = 0; i < completions.length; i += ROWS_PER_STATEMENT) {
+        const chunk = completions.slice(i, i + ROWS_PER_STATEMENT);
+        const finishQuery = startQuery('completeTasks');
+
+        db.all(buildCompletionStatement(chunk.length), chunk.flat(), (err, rewarded) => {
+            finishQuery();
+            if (err) {
+                return console.error('Task completion error:', err);
+            }
+            if (rewarded.length > 0) {
+                publishScores(rewarded.map((row) => row.user_id));
+            }
+        });
+    }
+}
+
+// Evaluate the tasks fed by counters that changed. Each update is
+// { userId, input, from, to }: the counter moved from at least `from` to
+// `to`, and only tasks whose target lies in (from, to] are completed.
+// Pass from = 0 when the previous value is unknown.
+function evaluateTasks(updates) {
+    if (coordinator.isWorker()) {
+        return coordinator.request('tasks:evaluate', updates);
+    }
+
+    const completions = [];
+
+    updates.forEach(({ userId, input, from, to }) => {
+        const entries = tasksByInput.get(input) || [];
+
+        for (const { taskId, target, reward } of entries) {
+            if (target > to) {
+                break;
+            }
+            if (target > from) {
+                completions.push([userId, taskId, target, reward]);
+            }
+        }
+    });
+
+    if (completions.length > 0) {
+        recordCompletions(completions);
+    }
+}
+
+coordinator.handle('tasks:evaluate', evaluateTasks);
+
+// Task state for one player: progress is derived from the counters, not
+// stored, so only completions live in user_tasks
+function describeTasks(counters, completedRows) {
+    const completed = new Map(completedRows.map((row) => [row.task_id, row]));
+    const result = {};
+
+    Object.keys(tasks).forEach((taskId) => {
+        const { input, target, reward, daily } = tasks[taskId];
+        const row = completed.get(taskId);
+        const isCompleted = Boolean(row && (!daily || row.completed_today));
+
+        result[taskId] = {
+            target,
+            reward,
+            progress: isCompleted ? target : Math.min(counters[input] || 0, target),
+            completed: isCompleted
+        };
+    });
+
+    return result;
+}
+
+module.exports = {
+    evaluateTasks,
+    describeTasks
+};
+"""
+
+# 24. Per-user rate limiting
+rate_limit_middleware = """
+const coordinator = require('../database/coordinator');
+
+// Per-user token buckets for authenticated routes. Each limiter keeps its
+// buckets in a fixed-size open-addressing table of typed arrays, so memory
+// stays bounded (about 20 bytes per slot) however many users there are.
+//
+// Buckets are per process by default, so in cluster mode a user can reach
+// up to N times the budget across N workers. That is accepted for cheap,
+// high-rate routes such as /taps, whose effect the server caps anyway.
+// Limiters created with `shared` keep their buckets on the coordinator,
+// so each user gets exactly the configured budget at the cost of an IPC
+// round trip per request; use it for low-rate routes like purchases.
+
+const TABLE_BITS = Math.ceil(Math.log2(parseInt(process.env.RATE_LIMIT_TABLE_SIZE) || 262144));
+const TABLE_SIZE = 1 << TABLE_BITS;
+const MAX_PROBE = 16;
+const SWEEP_INTERVAL = 60000;
+
+function createTable() {
+    return {
+        keys: new Int32Array(TABLE_SIZE), // user id, 0 = empty slot
+        tokens: new Float64Array(TABLE_SIZE),
+        updatedAt: new Float64Array(TABLE_SIZE)
+    };
+}
+
+function homeSlot(userId) {
+    return Math.imul(userId, 0x9e3779b1) >>> (32 - TABLE_BITS);
+}
+
+// Buckets allowing `burst` requests at once, refilled at `perSecond` per
+// user. take(userId) spends a token and returns 0, or returns the seconds
+// until one is available.
+function createBuckets({ perSecond, burst }) {
+    let table = createTable();
+
+    const available = (slot, now) =>
+        Math.min(burst, table.tokens[slot] + (now - table.updatedAt[slot]) * perSecond / 1000);
+
+    const claim = (slot, userId, tokens, now) => {
+        table.keys[slot] = userId;
+        table.tokens[slot] = tokens;
+        table.updatedAt[slot] = now;
+        return slot;
+    };
+
+    // Linear probing over a short window; when the window is full the
+    // least recently used bucket in it is reused
+    const findSlot = (userId, now) => {
+        let slot = homeSlot(userId);
+        let victim = slot;
+
+        for (let i = 0; i < MAX_PROBE; i++, slot = (slot + 1) & (TABLE_SIZE - 1)) {
+            if (table.keys[slot] === userId) {
+                return slot;
+            }
+            if (table.keys[slot] === 0) {
+                return claim(slot, userId, burst, now);
+            }
+            if (table.updatedAt[slot] < table.updatedAt[victim]) {
+                victim = slot;
+            }
+        }
+        return claim(victim, userId, burst, now);
+    };
+
+    // Buckets that have refilled completely behave like new ones, so
+    // dropping them loses nothing; the table is rebuilt without them
+    const sweep = () => {
+        const now = Date.now();
+        const previous = table;
+        table = createTable();
+
+        for (let slot = 0; slot < TABLE_SIZE; slot++) {
+            const userId = previous.keys[slot];
+            if (userId === 0) {
+                continue;
+            }
+
+            const tokens = Math.min(burst, previous.tokens[slot] + (now - previous.updatedAt[slot]) * perSecond / 1000);
+            if (tokens < burst) {
+                const moved = findSlot(userId, previous.updatedAt[slot]);
+                table.tokens[moved] = previous.tokens[slot];
+            }
+        }
+    };
+
+    setInterval(sweep, SWEEP_INTERVAL).unref();
+
+    return (userId) => {
+        const now = Date.now();
+        const slot = findSlot(userId, now);
+        const tokens = available(slot, now);
+        table.updatedAt[slot] = now;
+
+        if (tokens < 1) {
+            table.tokens[slot] = tokens;
+            return Math.ceil((1 - tokens) / perSecond);
+        }
+
+        table.tokens[slot] = tokens - 1;
+        return 0;
+    };
+}
+
+// Shared limiters by name; only the coordinator's are ever used
+const sharedBuckets = new Map();
+
+coordinator.handle('rateLimit:take', ({ name, userId }, reply) => {
+    reply(null, sharedBuckets.get(name)(userId));
+});
+
+// Allow `burst` requests at once, refilled at `perSecond` per user. A
+// `shared` limiter needs a `name` that is the same in every process.
+function userRateLimit({ perSecond, burst, shared = false, name }) {
+    const take = createBuckets({ perSecond, burst });
+    if (shared) {
+        sharedBuckets.set(name, take);
+    }
+
+    const respond = (res, next, retryAfter) => {
+        if (retryAfter > 0) {
+            res.set('Retry-After', String(retryAfter));
+            return res.status(429).json({ error: 'Too many requests' });
+        }
+        next();
+    };
+
+    return (req, res, next) => {
+        const userId = req.user && req.user.id;
+        if (!Number.isInteger(userId) || userId <= 0) {
+            return next();
+        }
+
+        if (!shared || !coordinator.isWorker()) {
+            return respond(res, next, take(userId));
+        }
+
+        coordinator.request('rateLimit:take', { name, userId }, (err, retryAfter) => {
+            if (err) {
+                // Let the request through rather than fail it on a limiter error
+                console.error('Rate limit error:', err);
+                return next();
+            }
+            respond(res, next, retryAfter);
+        });
+    };
+}
+
+module.exports = {
+    userRateLimit
+};
+"""
+
+# 25. Benchmark seeding
+bench_seed = """
+require('dotenv').config();
+const sqlite3 = require('sqlite3');
+const path = require('path');
+const { runMigrations } = require('../migrations/init');
+
+// Seed the database at DATABASE_PATH with benchmark players. `npm run
+// bench:seed` points it at a scratch bench.db, never the game's database.
+// Players are recognised by their bench_ username, so re-running only adds
+// what is missing.
+const USERS = parseInt(process.env.BENCH_USERS) || 10000;
+const FRIENDS_PER_USER = parseInt(process.env.BENCH_FRIENDS_PER_USER) || 5;
+const TELEGRAM_ID_BASE = 9000000000;
+
+const dbPath = process.env.DATABASE_PATH || path.join(__dirname, '../bench.db');
+const db = new sqlite3.Database(dbPath);
+
+function fail(err) {
+    console.error('Seed error:', err);
+    process.exitCode = 1;
+    db.close();
+}
+
+function seedUsers(callback) {
+    db.serialize(() => {
+        db.run('BEGIN');
+
+        const insertUser = db.prepare('INSERT OR IGNORE INTO users (telegram_id, username, first_name) VALUES (?, ?, ?)');
+        for (let i = 0; i < USERS; i++) {
+            insertUser.run(String(TELEGRAM_ID_BASE + i), `bench_${i}`, `Bench ${i}`);
+        }
+        insertUser.finalize();
+
+        // Spread scores so the leaderboard has a realistic shape. The
+        // progress rows come from the users trigger; only untouched ones
+        // are scored, so players from an earlier run keep theirs.
+        db.run(`
+            UPDATE game_progress
+            SET coins = abs(random()) % 50000,
+                total_earned = abs(random()) % 100000,
+                total_taps = abs(random()) % 100000
+            WHERE version = 0 AND total_taps = 0
+                AND user_id IN (SELECT id FROM users WHERE username GLOB 'bench_*')
+        `);
+
+        db.run('COMMIT', callback);
+    });
+}
+
+function seedFriends(callback) {
+    db.all("SELECT id FROM users WHERE username GLOB 'bench_*'", (err, rows) => {
+        if (err) {
+            return callback(err);
+        }
+
+        const ids = rows.map((row) => row.id);
+
+        db.serialize(() => {
+            db.run('BEGIN');
+
+            const insertFriend = db.prepare('INSERT OR IGNORE INTO friends (user_id, friend_id) VALUES (?, ?)');
+            ids.forEach((userId) => {
+                for (let i = 0; i < FRIENDS_PER_USER; i++) {
+                    const friendId = ids[Math.floor(Math.random() * ids.length)];
+                    if (friendId !== userId) {
+                        insertFriend.run(userId, friendId);
+                    }
+                }
+            });
+            insertFriend.finalize();
+
+            db.run('COMMIT', callback);
+        });
+    });
+}
+
+runMigrations(db, (err) => {
+    if (err) {
+        return fail(err);
+    }
+
+    const started = Date.now();
+    seedUsers((err) => {
+        if (err) {
+            return fail(err);
+        }
+
+        seedFriends((err) => {
+            if (err) {
+                return fail(err);
+            }
+
+            console.log(`Seeded ${USERS} players with up to ${FRIENDS_PER_USER} friends each in ${Date.now() - started}ms`);
+            db.close();
+        });
+    });
+});
+"""
+
+# 26. Benchmark load driver
+bench_run = """
+require('dotenv').config();
+const http = require('http');
+const crypto = require('crypto');
+
+// Drive a running local server with a weighted mix of API calls from the
+// players created by bench/seed.js, then report throughput and latency
+// percentiles per route. Start the server with `npm run bench:serve`: it
+// uses the scratch bench.db and lifts the per-IP limit, which would
+// otherwise answer most of the unauthenticated calls.
+const BASE_URL = new URL(process.env.BENCH_URL || 'http://localhost:3000');
+const USERS = parseInt(process.env.BENCH_USERS) || 10000;
+const DURATION = parseInt(process.env.BENCH_DURATION) || 30000;
+const CONCURRENCY = parseInt(process.env.BENCH_CONCURRENCY) || 50;
+const TELEGRAM_ID_BASE = 9000000000;
+
+const agent = new http.Agent({ keepAlive: true, maxSockets: CONCURRENCY });
+
+// Same derivation Telegram uses, so login also works with NODE_ENV=production
+const secretKey = crypto.createHmac('sha256', 'WebAppData')
+    .update(process.env.BOT_TOKEN || '')
+    .digest();
+
+function initDataFor(index) {
+    const params = new URLSearchParams({
+        auth_date: String(Math.floor(Date.now() / 1000)),
+        user: JSON.stringify({ id: TELEGRAM_ID_BASE + index, username: `bench_${index}`, first_name: `Bench ${index}` })
+    });
+    const dataCheckString = Array.from(params.entries())
+        .sort(([a], [b]) => (a < b ? -1 : a > b ? 1 : 0))
+        .map(([key, value]) => `${key}=${value}`)
+        .join('\\n');
+
+    params.set('hash', crypto.createHmac('sha256', secretKey).update(dataCheckString).digest('hex'));
+    return params.toString();
+}
+
+function request(method, path, body, token) {
+    return new Promise((resolve) => {
+        const payload = body ? JSON.stringify(body) : null;
+        const headers = {};
+        if (payload) {
+            headers['Content-Type'] = 'application/json';
+            headers['Content-Length'] = Buffer.byteLength(payload);
+        }
+        if (token) {
+            headers.Authorization = `Bearer ${token}`;
+        }
+
+        const started = process.hrtime.bigint();
+        const req = http.request({
+            agent,
+            method,
+            hostname: BASE_URL.hostname,
+            port: BASE_URL.port,
+            path,
+            headers
+        }, (res) => {
+            const chunks = [];
+            res.on('data', (chunk) => chunks.push(chunk));
+            res.on('end', () => {
+                let json = null;
+                try {
+                    json = JSON.parse(Buffer.concat(chunks).toString());
+                } catch {
+                    // Non-JSON bodies are only counted
+                }
+                resolve({ status: res.statusCode, json, ms: Number(process.hrtime.bigint() - started) / 1e6 });
+            });
+        });
+
+        req.on('error', () => resolve({ status: 0, json: null, ms: Number(process.hrtime.bigint() - started) / 1e6 }));
+        if (payload) {
+            req.write(payload);
+        }
+        req.end();
+    });
+}
+
+// Per-player session state kept between calls
+const sessions = new Map();
+
+const results = new Map();
+function record(route, response) {
+    if (!results.has(route)) {
+        results.set(route, { latencies: [], statuses: new Map() });
+    }
+    const result = results.get(route);
+    result.latencies.push(response.ms);
+    result.statuses.set(response.status, (result.statuses.get(response.status) || 0) + 1);
+}
+
+async function login(index) {
+    const response = await request('POST', '/api/auth/login', { initData: initDataFor(index) });
+    record('POST /api/auth/login', response);
+
+    if (response.status === 200 && response.json) {
+        const session = {
+            token: response.json.token,
+            telegramId: String(TELEGRAM_ID_BASE + index)
+        };
+        sessions.set(index, session);
+        return session;
+    }
+    return null;
+}
+
+const randomPlayer = () => Math.floor(Math.random() * USERS);
+const boosterTypes = ['energyCapacity', 'energyRegen', 'coinsPerTap'];
+
+// [weight, route label, action(session, index)]
+const mix = [
+    [25, 'POST /api/game/taps', (s) => request('POST', '/api/game/taps', { taps: 1 + Math.floor(Math.random() * 50) }, s.token)],
+    [10, 'GET /api/game/load', (s) => request('GET', '/api/game/load', null, s.token)],
+    [5, 'POST /api/game/purchase-booster', (s) => request('POST', '/api/game/purchase-booster', {
+        booster_type: boosterTypes[Math.floor(Math.random() * boosterTypes.length)]
+    }, s.token)],
+    [15, 'GET /api/leaderboard/top', () => request('GET', '/api/leaderboard/top/50')],
+    [10, 'GET /api/leaderboard/rank', (s) => request('GET', `/api/leaderboard/rank/${s.telegramId}`)],
+    [5, 'GET /api/leaderboard/around', (s) => request('GET', `/api/leaderboard/around/${s.telegramId}`)],
+    [10, 'GET /api/friends/list', (s) => request('GET', `/api/friends/list/${s.telegramId}`)],
+    [5, 'POST /api/friends/add', (s) => request('POST', '/api/friends/add', {
+        friend_telegram_id: String(TELEGRAM_ID_BASE + randomPlayer())
+    }, s.token)]
+];
+const totalWeight = mix.reduce((sum, [weight]) => sum + weight, 0);
+
+function pickAction() {
+    let roll = Math.random() * totalWeight;
+    for (const entry of mix) {
+        roll -= entry[0];
+        if (roll < 0) {
+            return entry;
+        }
+    }
+    return mix[mix.length - 1];
+}
+
+async function virtualClient(deadline) {
+    while (Date.now() < deadline) {
+        const index = randomPlayer();
+        const session = sessions.get(index) || await login(index);
+        if (!session) {
+            continue;
+        }
+
+        const [, route, action] = pickAction();
+        record(route, await action(session, index));
+    }
+}
+
+function percentile(sorted, p) {
+    return sorted.length === 0 ? 0 : sorted[Math.min(sorted.length - 1, Math.ceil(p / 100 * sorted.length) - 1)];
+}
+
+function report(elapsed) {
+    const rows = [];
+    let total = 0;
+
+    results.forEach(({ latencies, statuses }, route) => {
+        const sorted = latencies.slice().sort((a, b) => a - b);
+        total += sorted.length;
+        rows.push({
+            route,
+            requests: sorted.length,
+            'req/s': Math.round(sorted.length / (elapsed / 1000)),
+            'p50 ms': percentile(sorted, 50).toFixed(2),
+            'p95 ms': percentile(sorted, 95).toFixed(2),
+            'p99 ms': percentile(sorted, 99).toFixed(2),
+            statuses: Array.from(statuses.entries()).map(([status, count]) => `${status}:${count}`).join(' ')
+        });
+    });
+
+    console.table(rows);
+    console.log(`${total} requests in ${(elapsed / 1000).toFixed(1)}s (${Math.round(total / (elapsed / 1000))} req/s) with ${CONCURRENCY} clients`);
+}
+
+async function main() {
+    const health = await request('GET', '/health');
+    if (health.status !== 200) {
+        console.error(`No server answering at ${BASE_URL.href}; start it first`);
+        process.exitCode = 1;
+        return;
+    }
+
+    console.log(`Running ${CONCURRENCY} clients for ${DURATION / 1000}s against ${BASE_URL.href}`);
+    const started = Date.now();
+    const deadline = started + DURATION;
+
+    await Promise.all(Array.from({ length: CONCURRENCY }, () => virtualClient(deadline)));
+    report(Date.now() - started);
+    agent.destroy();
+}
+
+main();
+"""
+
+# 27. Metrics
+metrics_service = """
+const { monitorEventLoopDelay } = require('perf_hooks');
+const coordinator = require('../database/coordinator');
+
+// In-process metrics in Prometheus text format. In cluster mode every
+// process keeps its own and series carry the pid; a worker's /metrics
+// adds the coordinator's series to its own.
+
+const BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5]; // seconds
+
+const requestDurations = new Map();
+const requestCounts = new Map();
+const statementDurations = new Map();
+let pendingQueries = 0;
+
+const eventLoopDelay = monitorEventLoopDelay({ resolution: 20 });
+eventLoopDelay.enable();
+
+function observe(histograms, labels, seconds) {
+    let histogram = histograms.get(labels);
+    if (!histogram) {
+        histogram = { counts: new Array(BUCKETS.length).fill(0), sum: 0, count: 0 };
+        histograms.set(labels, histogram);
+    }
+
+    for (let i = 0; i < BUCKETS.length; i++) {
+        if (seconds <= BUCKETS[i]) {
+            histogram.counts[i]++;
+            break;
+        }
+    }
+    histogram.sum += seconds;
+    histogram.count++;
+}
+
+function label(value) {
+    return String(value).replace(/\\\\/g, '\\\\\\\\').replace(/"/g, '\\\\"');
+}
+
+// Record every request against its route pattern, not its raw URL
+function requestMetrics(req, res, next) {
+    const started = process.hrtime.bigint();
+
+    res.on('finish', () => {
+        const route = req.route ? req.baseUrl + req.route.path : 'unmatched';
+        const seconds = Number(process.hrtime.bigint() - started) / 1e9;
+        const labels = `route="${label(route)}",method="${req.method}"`;
+
+        observe(requestDurations, labels, seconds);
+
+        const countLabels = `${labels},status="${res.statusCode}"`;
+        requestCounts.set(countLabels, (requestCounts.get(countLabels) || 0) + 1);
+    });
+
+    next();
+}
+
+// Time one database call; the returned function ends it
+function startQuery(name) {
+    const started = process.hrtime.bigint();
+    pendingQueries++;
+
+    return () => {
+        pendingQueries--;
+        observe(statementDurations, `statement="${label(name)}"`, Number(process.hrtime.bigint() - started) / 1e9);
+    };
+}
+
+function histogramSamples(name, histograms) {
+    const samples = [];
+
+    histograms.forEach((histogram, labels) => {
+        let cumulative = 0;
+        BUCKETS.forEach((bound, i) => {
+            cumulative += histogram.counts[i];
+            samples.push(`${name}_bucket{${labels},pid="${process.pid}",le="${bound}"} ${cumulative}`);
+        });
+        samples.push(`${name}_bucket{${labels},pid="${process.pid}",le="+Inf"} ${histogram.count}`);
+        samples.push(`${name}_sum{${labels},pid="${process.pid}"} ${histogram.sum}`);
+        samples.push(`${name}_count{${labels},pid="${process.pid}"} ${histogram.count}`);
+    });
+    return samples;
+}
+
+// This process's metric families as { name, help, type, samples }; plain
+// data, so the coordinator can send its own to a worker
+function collectFamilies() {
+    const pid = `pid="${process.pid}"`;
+    const families = [];
+    const family = (name, type, help, samples) => families.push({ name, type, help, samples });
+
+    family('http_request_duration_seconds', 'histogram', 'HTTP request latency by route',
+        histogramSamples('http_request_duration_seconds', requestDurations));
+
+    const counts = [];
+    requestCounts.forEach((count, labels) => counts.push(`http_requests_total{${labels},${pid}} ${count}`));
+    family('http_requests_total', 'counter', 'HTTP requests by route and status', counts);
+
+    family('sqlite_statement_duration_seconds', 'histogram', 'SQLite statement latency by statement name',
+        histogramSamples('sqlite_statement_duration_seconds', statementDurations));
+
+    family('sqlite_pending_queries', 'gauge', 'Database calls waiting for their callback',
+        [`sqlite_pending_queries{${pid}} ${pendingQueries}`]);
+
+    // Event loop delay since the previous scrape
+    family('nodejs_eventloop_lag_seconds', 'gauge', 'Event loop delay since the last scrape', [
+        ...[50, 99].map((percentile) =>
+            `nodejs_eventloop_lag_seconds{quantile="0.${percentile}",${pid}} ${eventLoopDelay.percentile(percentile) / 1e9}`),
+        `nodejs_eventloop_lag_seconds{quantile="1",${pid}} ${eventLoopDelay.max / 1e9}`
+    ]);
+    eventLoopDelay.reset();
+
+    family('process_resident_memory_bytes', 'gauge', 'Resident set size',
+        [`process_resident_memory_bytes{${pid}} ${process.memoryUsage().rss}`]);
+
+    return families;
+}
+
+// The writer's statements, background jobs and queue depth live on the
+// coordinator, which serves no HTTP
+coordinator.handle('metrics', (payload, reply) => reply(null, collectFamilies()));
+
+// Merge families by name so each gets a single HELP and TYPE line
+function render(families) {
+    const merged = new Map();
+    families.forEach((family) => {
+        const existing = merged.get(family.name);
+        if (existing) {
+            existing.samples.push(...family.samples);
+        } else {
+            merged.set(family.name, { ...family, samples: [...family.samples] });
+        }
+    });
+
+    const lines = [];
+    merged.forEach(({ name, type, help, samples }) => {
+        lines.push(`# HELP ${name} ${help}`, `# TYPE ${name} ${type}`, ...samples);
+    });
+    return lines.join('\\n') + '\\n';
+}
+
+// Calls back with the Prometheus text for this process and, on a cluster
+// worker, the coordinator's series too
+function renderMetrics(callback) {
+    const families = collectFamilies();
+
+    if (!coordinator.isWorker()) {
+        return callback(render(families));
+    }
+
+    coordinator.request('metrics', null, (err, coordinatorFamilies) => {
+        if (err) {
+            console.error('Coordinator metrics error:', err);
+        }
+        callback(render(err ? families : families.concat(coordinatorFamilies)));
+    });
+}
+
+module.exports = {
+    requestMetrics,
+    startQuery,
+    renderMetrics
+};
+"""
+
+# 28. Archive
+archive_service = """
+const { getDatabase } = require('../database/init');
+const { removePlayers } = require('./rankIndex');
+const { forgetUsers } = require('./userCache');
+const { startQuery } = require('./metrics');
+
+// Players who have not logged in for INACTIVE_DAYS are moved to
+// users_archive and game_progress_archive, keeping the live tables (and
+// the pages SQLite caches for them) down to the active players. The login
+// statement moves them back, so the archive is invisible to the client.
+const INACTIVE_DAYS = Math.max(1, parseInt(process.env.ARCHIVE_INACTIVE_DAYS) || 30);
+const ARCHIVE_INTERVAL = parseInt(process.env.ARCHIVE_INTERVAL) || 3600000;
+const BATCH_SIZE = parseInt(process.env.ARCHIVE_BATCH_SIZE) || 1000;
+
+// One statement picks the batch and moves it through the archive_moves
+// trigger: the players are chosen once, against a single 'now', and
+// copied and deleted together or not at all. The writer connection is
+// shared with the prepared statements, so no explicit transaction is used.
+const ARCHIVE_SQL = `
+    INSERT INTO archive_moves (user_id, telegram_id)
+    SELECT id, telegram_id FROM users
+    WHERE last_active < datetime('now', ?)
+    ORDER BY last_active, id
+    LIMIT ?
+    RETURNING user_id AS id, telegram_id
+`;
+
+let archiveTimer = null;
+let archiving = false;
+
+// Move one batch; calls back with the archived { id, telegram_id } rows
+function archiveBatch(callback) {
+    getDatabase().all(ARCHIVE_SQL, [`-${INACTIVE_DAYS} days`, BATCH_SIZE], (err, rows) => {
+        callback(err, err ? [] : rows);
+    });
+}
+
+// Archive batches until no inactive players are left
+function archiveInactivePlayers(callback) {
+    const done = callback || (() => {});
+
+    if (archiving) {
+        return done(null, 0);
+    }
+    archiving = true;
+
+    const finishQuery = startQuery('archivePlayers');
+    let total = 0;
+
+    const next = () => archiveBatch((err, archived) => {
+        if (err) {
+            archiving = false;
+            finishQuery();
+            console.error('Player archive error:', err);
+            return done(err, total);
+        }
+
+        if (archived.length > 0) {
+            removePlayers(archived.map((row) => row.id));
+            forgetUsers(archived.map((row) => row.telegram_id));
+        }
+        total += archived.length;
+
+        if (archived.length === BATCH_SIZE) {
+            return setImmediate(next);
+        }
+
+        archiving = false;
+        finishQuery();
+        if (total > 0) {
+            console.log(`Archived ${total} players inactive for over ${INACTIVE_DAYS} days`);
+        }
+        done(null, total);
+    });
+
+    next();
+}
+
+// Runs on the process that owns the writer
+function startArchiveJob() {
+    if (!archiveTimer) {
+        archiveTimer = setInterval(archiveInactivePlayers, ARCHIVE_INTERVAL);
+        archiveInactivePlayers();
+    }
+}
+
+function stopArchiveJob() {
+    clearInterval(archiveTimer);
+    archiveTimer = null;
+}
+
+module.exports = {
+    archiveInactivePlayers,
+    startArchiveJob,
+    stopArchiveJob
+};
+"""
+
+# 29. Schema
+schema_service = """
+// A small JSON Schema subset compiled once into plain functions: routes
+// build their validators and serializers at require time, so a request
+// only walks closures made for its own shape.
+//
+// Supported keywords: type (a name or an array of names), properties,
+// required, additionalProperties (false), items, minItems, maxItems,
+// minimum, maximum, minLength, maxLength, pattern and enum.
+
+const TYPE_CHECKS = {
+    object: (value) => value !== null && typeof value === 'object' && !Array.isArray(value),
+    array: Array.isArray,
+    string: (value) => typeof value === 'string',
+    integer: Number.isSafeInteger,
+    number: Number.isFinite,
+    boolean: (value) => typeof value === 'boolean',
+    null: (value) => value === null
+};
+
+function typesOf(schema) {
+    if (schema.type === undefined) {
+        return [];
+    }
+    return Array.isArray(schema.type) ? schema.type : [schema.type];
+}
+
+// Returns validate(value) -> null when valid, else a message naming the
+// first offending field
+function compileValidator(schema, path = 'body') {
+    const checks = [];
+    const types = typesOf(schema);
+
+    if (types.length > 0) {
+        const typeChecks = types.map((type) => TYPE_CHECKS[type]);
+        checks.push((value) => (typeChecks.some((check) => check(value)) ? null : `${path} must be ${types.join(' or ')}`));
+    }
+
+    if (schema.enum) {
+        const allowed = new Set(schema.enum);
+        checks.push((value) => (allowed.has(value) ? null : `${path} must be one of ${schema.enum.join(', ')}`));
+    }
+
+    if (schema.minimum !== undefined) {
+        checks.push((value) => (typeof value !== 'number' || value >= schema.minimum ? null : `${path} must be at least ${schema.minimum}`));
+    }
+    if (schema.maximum !== undefined) {
+        checks.push((value) => (typeof value !== 'number' || value <= schema.maximum ? null : `${path} must be at most ${schema.maximum}`));
+    }
+
+    if (schema.minLength !== undefined) {
+        checks.push((value) => (typeof value !== 'string' || value.length >= schema.minLength ? null : `${path} is too short`));
+    }
+    if (schema.maxLength !== undefined) {
+        checks.push((value) => (typeof value !== 'string' || value.length <= schema.maxLength ? null : `${path} is too long`));
+    }
+    if (schema.pattern) {
+        const pattern = new RegExp(schema.pattern);
+        checks.push((value) => (typeof value !== 'string' || pattern.test(value) ? null : `${path} has an invalid format`));
+    }
+
+    if (schema.properties) {
+        const properties = Object.keys(schema.properties).map((key) => ({
+            key,
+            validate: compileValidator(schema.properties[key], `${path}.${key}`)
+        }));
+        const required = new Set(schema.required || []);
+        const known = new Set(Object.keys(schema.properties));
+
+        checks.push((value) => {
+            if (!TYPE_CHECKS.object(value)) {
+                return null;
+            }
+
+            for (const { key, validate } of properties) {
+                const property = value[key];
+                if (property === undefined) {
+                    if (required.has(key)) {
+                        return `${path}.${key} is required`;
+                    }
+                    continue;
+                }
+
+                const error = validate(property);
+                if (error) {
+                    return error;
+                }
+            }
+
+            if (schema.additionalProperties === false) {
+                for (const key in value) {
+                    if (!known.has(key)) {
+                        return `${path}.${key} is not allowed`;
+                    }
+                }
+            }
+            return null;
+        });
+    }
+
+    if (schema.items || schema.minItems !== undefined || schema.maxItems !== undefined) {
+        const validateItem = schema.items ? compileValidator(schema.items, `${path}[]`) : null;
+
+        checks.push((value) => {
+            if (!Array.isArray(value)) {
+                return null;
+            }
+            if (schema.minItems !== undefined && value.length < schema.minItems) {
+                return `${path} must have at least ${schema.minItems} items`;
+            }
+            if (schema.maxItems !== undefined && value.length > schema.maxItems) {
+                return `${path} must have at most ${schema.maxItems} items`;
+            }
+
+            if (validateItem) {
+                for (const item of value) {
+                    const error = validateItem(item);
+                    if (error) {
+                        return error;
+                    }
+                }
+            }
+            return null;
+        });
+    }
+
+    return (value) => {
+        for (const check of checks) {
+            const error = check(value);
+            if (error) {
+                return error;
+            }
+        }
+        return null;
+    };
+}
+
+// Strings without quotes, backslashes, control characters or surrogates
+// need no escaping
+const NEEDS_ESCAPE = /["\\\\\\u0000-\\u001f\\ud800-\\udfff]/;
+
+function serializeString(value) {
+    return NEEDS_ESCAPE.test(value) ? JSON.stringify(value) : `"${value}"`;
+}
+
+function serializeNumber(value) {
+    return Number.isFinite(value) ? String(value) : 'null';
+}
+
+// Returns serialize(value) -> JSON text. Object keys are fixed by the
+// schema, in schema order, and unknown keys are left out. Output matches
+// JSON.stringify for values of the declared types.
+function compileSerializer(schema) {
+    const types = typesOf(schema);
+    const nullable = types.includes('null');
+    const type = types.find((name) => name !== 'null');
+
+    let serialize;
+    if (type === 'string') {
+        serialize = serializeString;
+    } else if (type === 'integer' || type === 'number') {
+        serialize = serializeNumber;
+    } else if (type === 'boolean') {
+        serialize = (value) => (value ? 'true' : 'false');
+    } else if (type === 'array' && schema.items) {
+        const serializeItem = compileSerializer(schema.items);
+        serialize = (value) => {
+            let json = '[';
+            for (let i = 0; i < value.length; i++) {
+                json += (i === 0 ? '' : ',') + serializeItem(value[i]);
+            }
+            return json + ']';
+        };
+    } else if (type === 'object' && schema.properties) {
+        const properties = Object.keys(schema.properties).map((key) => ({
+            key,
+            prefix: `${JSON.stringify(key)}:`,
+            serialize: compileSerializer(schema.properties[key])
+        }));
+
+        serialize = (value) => {
+            let json = '{';
+            for (const { key, prefix, serialize: serializeProperty } of properties) {
+                const property = value[key];
+                if (property !== undefined) {
+                    json += (json.length === 1 ? '' : ',') + prefix + serializeProperty(property);
+                }
+            }
+            return json + '}';
+        };
+    } else {
+        serialize = (value) => JSON.stringify(value);
+    }
+
+    return nullable ? (value) => (value === null ? 'null' : serialize(value)) : serialize;
+}
+
+module.exports = {
+    compileValidator,
+    compileSerializer
+};
+"""
+
+# 30. Validate Middleware
+validate_middleware = """
+const express = require('express');
+const { compileValidator } = require('../services/schema');
+
+// Parse a JSON body with the route's own size limit, then check it against
+// the route's schema. Oversized bodies are refused from Content-Length, or
+// as soon as the stream passes the limit, before any JSON is parsed.
+function jsonBody(schema, { limit = '1kb', error = 'Invalid request' } = {}) {
+    const parse = express.json({ limit });
+    const validate = compileValidator(schema);
+
+    return (req, res, next) => {
+        parse(req, res, (err) => {
+            if (err && err.type === 'entity.too.large') {
+                return res.status(413).json({ error: 'Request body too large' });
+            }
+            if (err) {
+                return res.status(err.status || 400).json({ error: 'Malformed request body' });
+            }
+
+            const problem = validate(req.body);
+            if (problem) {
+                return res.status(400).json({ error, details: problem });
+            }
+
+            next();
+        });
+    };
+}
+
+module.exports = {
+    jsonBody
+};
+"""
+
+# Write all files
+files_created = []
+
+with open('package.json', 'w') as f:
+    f.write(package_json)
+    files_created.append('package.json')
+
+with open('server.js', 'w') as f:
+    f.write(server_js)
+    files_created.append('server.js')
+
+with open('database_init.js', 'w') as f:
+    f.write(database_init)
+    files_created.append('database_init.js')
+
+with open('auth_routes.js', 'w') as f:
+    f.write(auth_routes)
+    files_created.append('auth_routes.js')
+
+with open('game_routes.js', 'w') as f:
+    f.write(game_routes)
+    files_created.append('game_routes.js')
+
+with open('leaderboard_routes.js', 'w') as f:
+    f.write(leaderboard_routes)
+    files_created.append('leaderboard_routes.js')
+
+with open('friends_routes.js', 'w') as f:
+    f.write(friends_routes)
+    files_created.append('friends_routes.js')
+
+with open('.env.example', 'w') as f:
+    f.write(env_file)
+    files_created.append('.env.example')
+
+with open('ecosystem.config.js', 'w') as f:
+    f.write(ecosystem_file)
+    files_created.append('ecosystem.config.js')
+
+with open('database_write_buffer.js', 'w') as f:
+    f.write(write_buffer)
+    files_created.append('database_write_buffer.js')
+
+with open('rank_index_service.js', 'w') as f:
+    f.write(rank_index)
+    files_created.append('rank_index_service.js')
+
+with open('migrations_init.js', 'w') as f:
+    f.write(migrations_init)
+    files_created.append('migrations_init.js')
+
+with open('database_statements.js', 'w') as f:
+    f.write(database_statements)
+    files_created.append('database_statements.js')
+
+with open('user_cache_service.js', 'w') as f:
+    f.write(user_cache)
+    files_created.append('user_cache_service.js')
+
+with open('database_coordinator.js', 'w') as f:
+    f.write(database_coordinator)
+    files_created.append('database_coordinator.js')
+
+with open('telegram_auth_service.js', 'w') as f:
+    f.write(telegram_auth)
+    files_created.append('telegram_auth_service.js')
+
+with open('auth_middleware.js', 'w') as f:
+    f.write(auth_middleware)
+    files_created.append('auth_middleware.js')
+
+with open('game_config.js', 'w') as f:
+    f.write(game_config)
+    files_created.append('game_config.js')
+
+with open('cache_middleware.js', 'w') as f:
+    f.write(cache_middleware)
+    files_created.append('cache_middleware.js')
+
+with open('leaderboard_snapshot_service.js', 'w') as f:
+    f.write(leaderboard_snapshot)
+    files_created.append('leaderboard_snapshot_service.js')
+
+with open('json_stream_service.js', 'w') as f:
+    f.write(json_stream)
+    files_created.append('json_stream_service.js')
+
+with open('database_referrals.js', 'w') as f:
+    f.write(database_referrals)
+    files_created.append('database_referrals.js')
+
+with open('task_engine_service.js', 'w') as f:
+    f.write(task_engine)
+    files_created.append('task_engine_service.js')
+
+with open('rate_limit_middleware.js', 'w') as f:
+    f.write(rate_limit_middleware)
+    files_created.append('rate_limit_middleware.js')
+
+with open('bench_seed.js', 'w') as f:
+    f.write(bench_seed)
+    files_created.append('bench_seed.js')
+
+with open('bench_run.js', 'w') as f:
+    f.write(bench_run)
+    files_created.append('bench_run.js')
+
+with open('metrics_service.js', 'w') as f:
+    f.write(metrics_service)
+    files_created.append('metrics_service.js')
+
+with open('archive_service.js', 'w') as f:
+    f.write(archive_service)
+    files_created.append('archive_service.js')
+
+with open('schema_service.js', 'w') as f:
+    f.write(schema_service)
+    files_created.append('schema_service.js')
+
+with open('validate_middleware.js', 'w') as f:
+    f.write(validate_middleware)
+    files_created.append('validate_middleware.js')
 
 print("Backend files created successfully:")
 for file in files_created:
@@ -1,4 +1,6 @@
 
+const cluster = require('cluster');
+const os = require('os');
 const express = require('express');
 const cors = require('cors');
 const helmet = require('helmet');
@@ -9,30 +11,45 @@ const authRoutes = require('./routes/auth');
 const gameRoutes = require('./routes/game');
 const leaderboardRoutes = require('./routes/leaderboard');
 const friendsRoutes = require('./routes/friends');
-const { initDatabase } = require('./database/init');
+const { initDatabase, initReadPool, closeDatabase } = require('./database/init');
+const coordinator = require('./database/coordinator');
+const { startTapFlusher, stopTapFlusher, flushTaps } = require('./database/writeBuffer');
+const { prepareStatements, finalizeStatements } = require('./database/statements');
+const { loadRankIndex } = require('./services/rankIndex');
+const { useSnapshot, startSnapshotJob, stopSnapshotJob } = require('./services/leaderboardSnapshot');
+const userCache = require('./services/userCache');
+const { startArchiveJob, stopArchiveJob } = require('./services/archive');
+const { requestMetrics, renderMetrics } = require('./services/metrics');
 
 const app = express();
 const PORT = process.env.PORT || 3000;
 
-// Initialize database
-initDatabase();
+// CLUSTER_WORKERS > 1 (or 'max') forks HTTP workers; the primary stays
+// behind as the write coordinator and the only SQLite writer
+const CLUSTER_WORKERS = process.env.CLUSTER_WORKERS === 'max'
+    ? os.cpus().length
+    : parseInt(process.env.CLUSTER_WORKERS) || 0;
+const clusterMode = CLUSTER_WORKERS > 1;
 
 // Middleware
+app.use(requestMetrics);
 app.use(helmet());
 app.use(cors({
     origin: process.env.FRONTEND_URL || 'https://t.me',
     credentials: true
 }));
 
-// Rate limiting
+// Rate limiting per IP. Game routes are authenticated and limited per
+// user instead, so players sharing a carrier NAT don't throttle each other.
 const limiter = rateLimit({
-    windowMs: 15 * 60 * 1000, // 15 minutes
-    max: 100 // limit each IP to 100 requests per windowMs
+    windowMs: parseInt(process.env.RATE_LIMIT_WINDOW) || 15 * 60 * 1000, // 15 minutes
+    max: parseInt(process.env.RATE_LIMIT_MAX) || 100, // limit each IP to 100 requests per windowMs
+    skip: (req) => req.path.startsWith('/api/game/')
 });
 app.use(limiter);
 
-app.use(express.json({ limit: '10mb' }));
-app.use(express.urlencoded({ extended: true }));
+// Request bodies are parsed by each route with its own size limit and
+// schema (middleware/validate.js)
 
 // Routes
 app.use('/api/auth', authRoutes);
@@ -42,7 +59,23 @@ app.use('/api/friends', friendsRoutes);
 
 // Health check
 app.get('/health', (req, res) => {
-    res.json({ status: 'OK', timestamp: new Date().toISOString() });
+    res.json({
+        status: 'OK',
+        timestamp: new Date().toISOString(),
+        userCache: userCache.getStats()
+    });
+});
+
+// Prometheus metrics; set METRICS_TOKEN to require it as a Bearer token
+app.get('/metrics', (req, res) => {
+    if (process.env.METRICS_TOKEN && req.headers.authorization !== `Bearer ${process.env.METRICS_TOKEN}`) {
+        return res.status(401).json({ error: 'Invalid token' });
+    }
+
+    renderMetrics((text) => {
+        res.set('Content-Type', 'text/plain; version=0.0.4');
+        res.send(text);
+    });
 });
 
 // Error handling middleware
@@ -56,8 +89,61 @@ app.use('*', (req, res) => {
     res.status(404).json({ error: 'Route not found' });
 });
 
-app.listen(PORT, () => {
-    console.log(`NZI Coin Backend running on port ${PORT}`);
-});
+// The in-memory rank index is only needed when it serves the leaderboard
+function loadLeaderboard() {
+    if (!useSnapshot()) {
+        loadRankIndex();
+    }
+}
+
+function startHttpServer() {
+    app.listen(PORT, () => {
+        console.log(`NZI Coin Backend running on port ${PORT}`);
+    });
+}
+
+// Initialize database
+if (clusterMode && coordinator.isWorker()) {
+    coordinator.startWorkerChannel();
+    initReadPool(() => prepareStatements(() => {
+        loadLeaderboard();
+        startHttpServer();
+    }));
+} else if (clusterMode) {
+    initDatabase(() => prepareStatements(() => {
+        startTapFlusher();
+        startSnapshotJob();
+        startArchiveJob();
+        coordinator.startCoordinator(CLUSTER_WORKERS);
+    }), { readPoolSize: 0 });
+} else {
+    initDatabase(() => prepareStatements(() => {
+        loadLeaderboard();
+        startSnapshotJob();
+        startArchiveJob();
+    }));
+    startTapFlusher();
+    startHttpServer();
+}
+
+function closeAndExit() {
+    finalizeStatements(() => closeDatabase(() => process.exit(0)));
+}
+
+// Stop workers first so no writes arrive mid-flush, then flush buffered
+// taps, finalize statements and close connections before exiting
+function shutdown() {
+    if (coordinator.isWorker()) {
+        return closeAndExit();
+    }
+
+    stopTapFlusher();
+    stopSnapshotJob();
+    stopArchiveJob();
+    coordinator.stopWorkers(() => flushTaps(closeAndExit));
+}
+
+process.on('SIGTERM', shutdown);
+process.on('SIGINT', shutdown);
 
 module.exports = app;
@@ -0,0 +1,132 @@
+
+const { getDatabase } = require('../database/init');
+const coordinator = require('../database/coordinator');
+const statements = require('../database/statements');
+const { updateScores } = require('./rankIndex');
+const { startQuery } = require('./metrics');
+const { tasks } = require('../config/game');
+
+const ROWS_PER_STATEMENT = 200; // 4 bound parameters per row, stays under SQLite's 999 limit
+
+// input counter -> [{ taskId, target, reward }] sorted by target, so an
+// update only looks at the tasks fed by the counter that moved
+const tasksByInput = new Map();
+Object.keys(tasks).forEach((taskId) => {
+    const { input, target, reward } = tasks[taskId];
+    if (!tasksByInput.has(input)) {
+        tasksByInput.set(input, []);
+    }
+    tasksByInput.get(input).push({ taskId, target, reward });
+});
+tasksByInput.forEach((entries) => entries.sort((a, b) => a.target - b.target));
+
+const dailyTaskIds = Object.keys(tasks).filter((taskId) => tasks[taskId].daily);
+
+// Record many completions in one statement. A task already completed is
+// left alone unless it is a daily task last completed before today; the
+// user_tasks triggers pay the reward for every row inserted or renewed.
+function buildCompletionStatement(rowCount) {
+    const values = new Array(rowCount).fill('(?, ?, TRUE, ?, CURRENT_TIMESTAMP, ?)').join(', ');
+    const daily = dailyTaskIds.map((taskId) => `'${taskId}'`).join(', ');
+
+    return `
+        INSERT INTO user_tasks (user_id, task_id, completed, progress, completed_at, reward)
+        VALUES ${values}
+        ON CONFLICT (user_id, task_id) DO UPDATE
+        SET completed_at = excluded.completed_at, reward = excluded.reward
+        WHERE user_tasks.task_id IN (${daily}) AND date(user_tasks.completed_at) < date('now')
+        RETURNING user_id
+    `;
+}
+
+// Rewards add to total_earned, so push the new totals to the leaderboard
+function publishScores(userIds) {
+    statements.all('progressTotals', [JSON.stringify([...new Set(userIds)])], (err, rows) => {
+        if (err) {
+            return console.error('Task reward score error:', err);
+        }
+
+        updateScores(rows.map((row) => ({
+            userId: row.user_id,
+            totalEarned: row.total_earned,
+            totalTaps: row.total_taps
+        })));
+    });
+}
+
+function recordCompletions(completions) {
+    const db = getDatabase();
+
+    for (let i = 0; i < completions.length; i += ROWS_PER_STATEMENT) {
+        const chunk = completions.slice(i, i + ROWS_PER_STATEMENT);
+        const finishQuery = startQuery('completeTasks');
+
+        db.all(buildCompletionStatement(chunk.length), chunk.flat(), (err, rewarded) => {
+            finishQuery();
+            if (err) {
+                return console.error('Task completion error:', err);
+            }
+            if (rewarded.length > 0) {
+                publishScores(rewarded.map((row) => row.user_id));
+            }
+        });
+    }
+}
+
+// Evaluate the tasks fed by counters that changed. Each update is
+// { userId, input, from, to }: the counter moved from at least `from` to
+// `to`, and only tasks whose target lies in (from, to] are completed.
+// Pass from = 0 when the previous value is unknown.
+function evaluateTasks(updates) {
+    if (coordinator.isWorker()) {
+        return coordinator.request('tasks:evaluate', updates);
+    }
+
+    const completions = [];
+
+    updates.forEach(({ userId, input, from, to }) => {
+        const entries = tasksByInput.get(input) || [];
+
+        for (const { taskId, target, reward } of entries) {
+            if (target > to) {
+                break;
+            }
+            if (target > from) {
+                completions.push([userId, taskId, target, reward]);
+            }
+        }
+    });
+
+    if (completions.length > 0) {
+        recordCompletions(completions);
+    }
+}
+
+coordinator.handle('tasks:evaluate', evaluateTasks);
+
+// Task state for one player: progress is derived from the counters, not
+// stored, so only completions live in user_tasks
+function describeTasks(counters, completedRows) {
+    const completed = new Map(completedRows.map((row) => [row.task_id, row]));
+    const result = {};
+
+    Object.keys(tasks).forEach((taskId) => {
+        const { input, target, reward, daily } = tasks[taskId];
+        const row = completed.get(taskId);
+        const isCompleted = Boolean(row && (!daily || row.completed_today));
+
+        result[taskId] = {
+            target,
+            reward,
+            progress: isCompleted ? target : Math.min(counters[input] || 0, target),
+            completed: isCompleted
+        };
+    });
+
+    return result;
+}
+
+module.exports = {
+    evaluateTasks,
+    describeTasks
+};
@@ -0,0 +1,74 @@
+
+const crypto = require('crypto');
+
+const MAX_AGE_SECONDS = parseInt(process.env.INIT_DATA_MAX_AGE) || 86400;
+const MAX_CACHED = parseInt(process.env.INIT_DATA_CACHE_SIZE) || 20000;
+
+// The HMAC key depends only on the bot token, so derive it once at startup
+const secretKey = crypto.createHmac('sha256', 'WebAppData')
+    .update(process.env.BOT_TOKEN || '')
+    .digest();
+
+// Verified initData strings -> expiry (ms). Keyed by the full string, not
+// just its hash, so a known-good hash cannot be replayed with edited fields.
+const verified = new Map();
+
+// Plain code-unit comparison; Telegram's keys are ASCII, so this is byte order
+function byteOrder([a], [b]) {
+    return a < b ? -1 : a > b ? 1 : 0;
+}
+
+function remember(initData, expiresAt) {
+    verified.set(initData, expiresAt);
+
+    if (verified.size > MAX_CACHED) {
+        verified.delete(verified.keys().next().value);
+    }
+}
+
+// Validate Telegram WebApp init data, including its auth_date window
+function verifyInitData(initData) {
+    if (typeof initData !== 'string' || initData.length === 0) {
+        return false;
+    }
+
+    const now = Date.now();
+    const cachedExpiry = verified.get(initData);
+    if (cachedExpiry !== undefined) {
+        if (cachedExpiry > now) {
+            return true;
+        }
+        verified.delete(initData);
+        return false;
+    }
+
+    const urlParams = new URLSearchParams(initData);
+    const hash = urlParams.get('hash');
+    const expiresAt = (Number(urlParams.get('auth_date')) + MAX_AGE_SECONDS) * 1000;
+
+    if (!hash || !(expiresAt > now)) {
+        return false;
+    }
+
+    urlParams.delete('hash');
+
+    const dataCheckString = Array.from(urlParams.entries())
+        .sort(byteOrder)
+        .map(([key, value]) => `${key}=${value}`)
+        .join('\n');
+
+    const calculatedHash = crypto.createHmac('sha256', secretKey).update(dataCheckString).digest();
+    const providedHash = Buffer.from(hash, 'hex');
+
+    if (providedHash.length !== calculatedHash.length ||
+        !crypto.timingSafeEqual(providedHash, calculatedHash)) {
+        return false;
+    }
+
+    remember(initData, expiresAt);
+    return true;
+}
+
+module.exports = {
+    verifyInitData
+};
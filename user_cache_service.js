@@ -0,0 +1,73 @@
+
+const statements = require('../database/statements');
+const coordinator = require('../database/coordinator');
+
+const MAX_ENTRIES = parseInt(process.env.USER_CACHE_SIZE) || 100000;
+
+// telegram_id -> users.id never changes once a user exists, so entries are
+// only ever evicted for space. A Map iterates in insertion order, which
+// doubles as the recency list: re-inserting a key moves it to the end.
+const cache = new Map();
+let hits = 0;
+let misses = 0;
+
+function rememberUser(telegramId, userId) {
+    const key = String(telegramId);
+
+    cache.delete(key);
+    cache.set(key, userId);
+
+    if (cache.size > MAX_ENTRIES) {
+        cache.delete(cache.keys().next().value);
+    }
+}
+
+// Calls back synchronously on a hit; unknown users are not cached so a
+// later registration is picked up on the next lookup
+function resolveUserId(telegramId, callback) {
+    const key = String(telegramId);
+    const userId = cache.get(key);
+
+    if (userId !== undefined) {
+        hits++;
+        cache.delete(key);
+        cache.set(key, userId);
+        return callback(null, userId);
+    }
+
+    misses++;
+    statements.get('userIdByTelegramId', [key], (err, user) => {
+        if (err || !user) {
+            return callback(err, null);
+        }
+
+        rememberUser(key, user.id);
+        callback(null, user.id);
+    });
+}
+
+// Archived players resolve again only after they log back in. Published
+// so every cluster worker drops them from its own cache.
+function forgetUsers(telegramIds) {
+    coordinator.publish('users:forget', telegramIds);
+}
+
+coordinator.subscribe('users:forget', (telegramIds) => {
+    telegramIds.forEach((telegramId) => cache.delete(String(telegramId)));
+});
+
+function getStats() {
+    return {
+        size: cache.size,
+        capacity: MAX_ENTRIES,
+        hits,
+        misses
+    };
+}
+
+module.exports = {
+    resolveUserId,
+    rememberUser,
+    forgetUsers,
+    getStats
+};
@@ -0,0 +1,33 @@
+
+const express = require('express');
+const { compileValidator } = require('../services/schema');
+
+// Parse a JSON body with the route's own size limit, then check it against
+// the route's schema. Oversized bodies are refused from Content-Length, or
+// as soon as the stream passes the limit, before any JSON is parsed.
+function jsonBody(schema, { limit = '1kb', error = 'Invalid request' } = {}) {
+    const parse = express.json({ limit });
+    const validate = compileValidator(schema);
+
+    return (req, res, next) => {
+        parse(req, res, (err) => {
+            if (err && err.type === 'entity.too.large') {
+                return res.status(413).json({ error: 'Request body too large' });
+            }
+            if (err) {
+                return res.status(err.status || 400).json({ error: 'Malformed request body' });
+            }
+
+            const problem = validate(req.body);
+            if (problem) {
+                return res.status(400).json({ error, details: problem });
+            }
+
+            next();
+        });
+    };
+}
+
+module.exports = {
+    jsonBody
+};